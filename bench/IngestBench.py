@@ -0,0 +1,201 @@
+#!/usr/bin/env python2
+
+################################################################################
+## IngestBench.py: Compare push and poll email ingest on a stand-in mailbox.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+
+from __future__ import print_function
+import os
+import json
+import time
+import argparse
+import tempfile
+import threading
+from NotifBench import BenchClient
+
+# Gmail API quota units per request.
+QUOTA_UNITS = {
+    'getProfile': 1,
+    'history.list': 2,
+    'watch': 100,
+    }
+
+class FakeService:
+    def __init__(self, history):
+        """
+        Stand-in for the Gmail service, answering getProfile and the
+        poller's history.list from the fake history, where every
+        history ID is a new message.
+        """
+        self.history = history
+
+    def users(self):
+        history = self.history
+        class History:
+            def list(self, userId, startHistoryId, **kwargs):
+                class Request:
+                    def execute(self):
+                        start = int(startHistoryId)
+                        response = {'historyId': str(history.latest)}
+                        if history.latest > start:
+                            response['history'] = [{'id': str(start + 1)}]
+                        return response
+                return Request()
+        class Users:
+            def getProfile(self, userId):
+                class Request:
+                    def execute(self):
+                        return {'historyId': str(history.latest)}
+                return Request()
+
+            def history(self):
+                return History()
+        return Users()
+
+def arrivals(cycles, idle, n_rush, rush_time):
+    """
+    Email arrival times: an idle period followed by a rush of n_rush
+    emails spread evenly over rush_time seconds, cycles times.
+    """
+    times = []
+    t_cycle = 0.
+    for i in range(cycles):
+        t_rush = t_cycle + idle
+        times.extend([t_rush + rush_time * j / n_rush for j in range(n_rush)])
+        t_cycle = t_rush + rush_time
+    return times, t_cycle + idle
+
+def run_bench(args, ingest):
+    """
+    Deliver emails to the stand-in mailbox on schedule and measure how
+    long the client takes to see each one, and the API requests made.
+    """
+    config = {
+        'token': 'token.json',
+        'credentials': 'credentials.json',
+        'application': 'application.json',
+        'project_id': 'bench',
+        'topic_name': 'bench',
+        'subscription_name': 'bench',
+        'email_name': 'bar@example.com',
+        'send_name': 'Bench',
+        'password': '',
+        'ingest': ingest,
+        'poll_min': args.poll_min,
+        'poll_max': args.poll_max,
+        'poll_backoff': args.poll_backoff,
+        }
+    conf_fd, conf_file = tempfile.mkstemp(suffix='.conf')
+    with os.fdopen(conf_fd, 'w') as f:
+        f.write(json.dumps(config))
+    client = BenchClient(conf_file, args.sync_time / 1000.)
+    os.remove(conf_file)
+    history = client.user_hist
+    if ingest == 'poll':
+        client.watch_time = None
+        driver = client._poller(FakeService(history)).start()
+    else:
+        client._subscribe(client.subscriber)
+        driver = None
+
+    times, duration = arrivals(args.cycles, args.idle, args.rush,
+            args.rush_time)
+    delivered = {}
+    seen = {}
+    def consume():
+        while len(seen) < len(times):
+            for msg in client.wait_new_messages():
+                seen[msg['id']] = time.time()
+    consumer = threading.Thread(target=consume)
+    consumer.daemon = True
+    consumer.start()
+
+    t_start = time.time()
+    for offset in times:
+        delay = t_start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        history.latest += 1
+        delivered['m%d' % history.latest] = time.time()
+        if ingest == 'push':
+            client.subscriber.publish([{'emailAddress': 'bar@example.com',
+                'historyId': history.latest}])
+    delay = t_start + duration - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    consumer.join(args.poll_max + 5)
+    if driver is not None:
+        driver.cancel()
+
+    requests = {}
+    for (name, labels), value in client.metrics.counters.items():
+        if name == 'gmail_requests':
+            requests[dict(labels)['method']] = value
+    if ingest == 'push':
+        # One watch call a day, prorated over the run.
+        requests['watch'] = duration / client.watch_interval
+    units = sum([QUOTA_UNITS.get(m, 0) * n for m, n in requests.items()])
+
+    latency = sorted([seen[m] - delivered[m] for m in seen])
+    def pct(p):
+        return 1000 * latency[min(len(latency)-1, int(p * len(latency)))]
+    return {
+        'ingest': ingest,
+        'emails': len(times),
+        'emails_seen': len(seen),
+        'duration': duration,
+        'requests': requests,
+        'quota_units_per_hour': 3600 * units / duration,
+        'latency_ms': {'p50': pct(0.5), 'p99': pct(0.99),
+            'max': 1000 * latency[-1]} if len(latency) else {},
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare email latency '
+            'and Gmail API quota use of push and poll ingest.')
+    parser.add_argument('--cycles', type=int, default=2,
+            help='number of idle and rush periods')
+    parser.add_argument('--idle', type=float, default=10.,
+            help='seconds without email before each rush')
+    parser.add_argument('--rush', type=int, default=30,
+            help='emails per rush')
+    parser.add_argument('--rush-time', type=float, default=5.,
+            help='seconds each rush lasts')
+    parser.add_argument('--sync-time', type=float, default=30.,
+            help='milliseconds a fake history sync takes')
+    parser.add_argument('--poll-min', type=float, default=0.5,
+            help='shortest poll interval in seconds')
+    parser.add_argument('--poll-max', type=float, default=8.,
+            help='longest poll interval in seconds')
+    parser.add_argument('--poll-backoff', type=float, default=2.,
+            help='poll interval growth per empty poll')
+    parser.add_argument('-o', '--output', default='ingest_bench.json',
+            help='json file to write the results to')
+    args = parser.parse_args()
+
+    results = [run_bench(args, ingest) for ingest in ['push', 'poll']]
+    with open(args.output, 'w') as f:
+        f.write(json.dumps(results, indent=4, sort_keys=True))
+    for result in results:
+        stats = result['latency_ms']
+        print('%s: %d/%d emails, latency p50 %.0f ms p99 %.0f ms max %.0f ms, '
+                '%.0f quota units/hour' % (result['ingest'],
+                    result['emails_seen'], result['emails'],
+                    stats.get('p50', 0), stats.get('p99', 0),
+                    stats.get('max', 0), result['quota_units_per_hour']))
+    print('Results written to', args.output)
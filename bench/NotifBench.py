@@ -0,0 +1,199 @@
+#!/usr/bin/env python2
+
+################################################################################
+## NotifBench.py: Inbox notification coalescing with a fake subscriber.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import multiprocessing as mp
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(os.path.join(root_dir, 'server'))
+import GmailWrapper as gw
+
+class FakeMessage:
+    def __init__(self, data):
+        self.data = data
+
+    def ack(self):
+        pass
+
+class FakeSubscriber:
+    def __init__(self, n_threads=4):
+        """
+        Stand-in for the Pub/Sub subscriber. Published notifications
+        are handed to the callback from several threads, the way the
+        subscriber's callback pool does.
+        """
+        self.n_threads = n_threads
+        self.callback = None
+        self.flow_control = None
+
+    def publish(self, notifs):
+        """
+        Deliver a burst of notifications at once.
+        """
+        def deliver(part):
+            for notif in part:
+                self.callback(FakeMessage(json.dumps(notif).encode()))
+        threads = [threading.Thread(target=deliver,
+            args=(notifs[i::self.n_threads],)) for i in range(self.n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def subscribe(self, path, callback, flow_control=None):
+        self.callback = callback
+        self.flow_control = flow_control
+
+    def subscription_path(self, project_id, sub_name):
+        return 'projects/%s/subscriptions/%s' % (project_id, sub_name)
+
+class FakeHistory:
+    def __init__(self, sync_time):
+        """
+        Stand-in for users.history: every history ID up to the newest
+        one published is a new message.
+        """
+        self.sync_time = sync_time
+        self.latest = 0
+        self.n_syncs = 0
+
+    def list(self, userId, startHistoryId, pageToken=None):
+        history = self
+        class Request:
+            def execute(self):
+                time.sleep(history.sync_time)
+                history.n_syncs += 1
+                start = int(startHistoryId)
+                added = [{'message': {'id': 'm%d' % h, 'threadId': 't%d' % h}}
+                        for h in range(start + 1, history.latest + 1)]
+                return {'history': [{'messagesAdded': added}],
+                        'historyId': str(history.latest)}
+        return Request()
+
+class BenchClient(gw.GmailClient):
+    def __init__(self, conf_file, sync_time):
+        """
+        Gmail client with a fake subscriber and history, so that only
+        the notification path is measured.
+        """
+        gw.GmailClient.__init__(self, conf_file)
+        self.notif_recv, self.notif_send = mp.Pipe(False)
+        self.user_hist = FakeHistory(sync_time)
+        self.subscriber = FakeSubscriber()
+        self.hist_id = '0'
+        self.watch_time = time.time()
+        self.expiration = time.time() + 7 * 86400
+
+    def flow_control(self):
+        return (self.pubsub_max_bytes, self.pubsub_max_messages)
+
+def run_bench(args, debounce):
+    """
+    Publish bursts of notifications and count the history syncs needed
+    to see every message. Returns the results.
+    """
+    config = {
+        'token': 'token.json',
+        'credentials': 'credentials.json',
+        'application': 'application.json',
+        'project_id': 'bench',
+        'topic_name': 'bench',
+        'subscription_name': 'bench',
+        'email_name': 'bar@example.com',
+        'send_name': 'Bench',
+        'password': '',
+        'notif_debounce': debounce,
+        }
+    conf_fd, conf_file = tempfile.mkstemp(suffix='.conf')
+    with os.fdopen(conf_fd, 'w') as f:
+        f.write(json.dumps(config))
+    client = BenchClient(conf_file, args.sync_time / 1000.)
+    os.remove(conf_file)
+    client._subscribe(client.subscriber)
+
+    n_messages = args.bursts * args.burst
+    published = {}
+    seen = {}
+    def consume():
+        while len(seen) < n_messages:
+            for msg in client.wait_new_messages():
+                seen[msg['id']] = time.time()
+    consumer = threading.Thread(target=consume)
+    consumer.daemon = True
+    consumer.start()
+
+    t_start = time.time()
+    history = client.user_hist
+    for i in range(args.bursts):
+        notifs = []
+        for j in range(args.burst):
+            history.latest += 1
+            published['m%d' % history.latest] = time.time()
+            notifs.append({'emailAddress': 'bar@example.com',
+                'historyId': history.latest})
+        client.subscriber.publish(notifs)
+        time.sleep(args.interval / 1000.)
+    consumer.join(args.timeout)
+
+    latency = sorted([seen[m] - published[m] for m in seen])
+    def pct(p):
+        return 1000 * latency[min(len(latency)-1, int(p * len(latency)))]
+    return {
+        'debounce': debounce,
+        'notifications': n_messages,
+        'messages_seen': len(seen),
+        'history_syncs': history.n_syncs,
+        'duration': time.time() - t_start,
+        'latency_ms': {'p50': pct(0.5), 'p99': pct(0.99),
+            'max': 1000 * latency[-1]} if len(latency) else {},
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare history syncs '
+            'per notification burst with and without debouncing.')
+    parser.add_argument('--bursts', type=int, default=20,
+            help='number of notification bursts')
+    parser.add_argument('--burst', type=int, default=20,
+            help='notifications per burst')
+    parser.add_argument('--interval', type=float, default=200.,
+            help='milliseconds between bursts')
+    parser.add_argument('--sync-time', type=float, default=30.,
+            help='milliseconds a fake history sync takes')
+    parser.add_argument('--debounce', type=float, default=0.05,
+            help='debounce in seconds to compare against none')
+    parser.add_argument('--timeout', type=float, default=60.,
+            help='seconds to wait for every message')
+    args = parser.parse_args()
+
+    for debounce in [0., args.debounce]:
+        results = run_bench(args, debounce)
+        stats = results['latency_ms']
+        print('debounce %.3fs: %d/%d messages, %d history syncs, '
+                'latency p50 %.1f ms p99 %.1f ms' % (debounce,
+                    results['messages_seen'], results['notifications'],
+                    results['history_syncs'], stats.get('p50', 0),
+                    stats.get('p99', 0)))
@@ -0,0 +1,354 @@
+#!/usr/bin/env python2
+
+################################################################################
+## OrderBench.py: Load generator and throughput benchmark.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for subdir in ['common', 'server', 'client']:
+    sys.path.append(os.path.join(root_dir, subdir))
+import Handshake as hs
+import WireFraming as wf
+import WireSchema as ws
+import OrderHandler as oh
+from BarEngine import BarEngine
+from OrderReceiver import OrderReceiver
+
+class BenchHandler(oh.OrderHandler):
+    def __init__(self, bar_conf, overrides):
+        """
+        Order handler on an in-memory mailbox, recording when tickets
+        are created from the emails and when notifications from the
+        bar arrive. Everything else is the real handler.
+        """
+        oh.OrderHandler.__init__(self, None, bar_conf, overrides)
+        self.bar_host = '127.0.0.1'
+        self.created = {}
+        self.notif_times = {}
+
+    def dispatch_ticket(self, ticket_id, message):
+        # Count from when the email arrived in the mailbox.
+        self.created.setdefault(ticket_id, message['timeline']['gmail'])
+        oh.OrderHandler.dispatch_ticket(self, ticket_id, message)
+
+    def process_records(self, bar_idx, records):
+        t_recv = time.time()
+        for notif in records:
+            self.notif_times[(notif['id'], notif['status'])] = t_recv
+        oh.OrderHandler.process_records(self, bar_idx, records)
+
+class HeadlessBar(OrderReceiver):
+    def __init__(self, conf_file):
+        """
+        Bartender client driving the bar engine without a user
+        interface. Every order is accepted, sent to the pickup screen
+        and marked as picked up as soon as it arrives, or as soon as a
+        batch of orders has arrived.
+        """
+        OrderReceiver.__init__(self, conf_file)
+        self.engine = BarEngine(self.send_notifs, self.send_pickup, 1)
+        self.received = {}
+        self.notif_sent = {}
+
+    def bartend(self, n_orders, batch=1):
+        """
+        Serve n_orders orders, batch orders at a time.
+        """
+        engine = self.engine
+        while n_orders > 0:
+            n_batch = min(batch, n_orders)
+            for i in range(n_batch):
+                order = self.recv_order()
+                self.received[order['id']] = time.time()
+                engine.add_order(order)
+            engine.accept(n_batch)
+            for i in range(n_batch):
+                engine.send_to_pickup()
+            while len(engine.drinks_pickup):
+                engine.pickup()
+            engine.pop_changes()
+            n_orders -= n_batch
+
+    def cleanup(self):
+        for proc in self.node_procs:
+            proc.terminate()
+        for sock in self.node_sockets:
+            sock.close()
+        if self.pickup_sock is not None:
+            self.pickup_sock.close()
+
+    def send_notifs(self, node_idx, notifs):
+        t_sent = time.time()
+        for notif in notifs:
+            self.notif_sent[(notif['id'], notif['status'])] = t_sent
+        OrderReceiver.send_notifs(self, node_idx, notifs)
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_listening(port, timeout=10):
+    """
+    Wait for the handler to listen. The probe connection has no hello
+    message, so the handler drops it and accepts the next one.
+    """
+    t_end = time.time() + timeout
+    while True:
+        try:
+            probe = socket.create_connection(('127.0.0.1', port))
+        except socket.error:
+            if time.time() > t_end:
+                raise
+            time.sleep(0.01)
+            continue
+        probe.close()
+        return
+
+def percentiles(values):
+    """
+    Summarize a list of latencies in milliseconds.
+    """
+    if not len(values):
+        return {}
+    values = sorted(values)
+    def pct(p):
+        return 1000 * values[min(len(values)-1, int(p * len(values)))]
+    return {
+        'p50': pct(0.50),
+        'p90': pct(0.90),
+        'p99': pct(0.99),
+        'max': 1000 * values[-1],
+        'mean': 1000 * sum(values) / len(values),
+        }
+
+def pickup_stand_in(listen_sock, ack):
+    """
+    Accept the bar's pickup screen connection and decode and discard
+    the drinks.
+    """
+    conn, _ = listen_sock.accept()
+    conn = wf.FramedSocket(conn)
+    word, options = hs.parse_hello(conn.recv_frame())
+    if word != ack:
+        return
+    reply, codec = ws.server_select(options, ws.PickleCodec(compress=False))
+    conn.send_frame(hs.format_hello(ack, reply))
+    while True:
+        drink = conn.recv_frame()
+        if drink is None:
+            return
+        codec.decode(drink)
+
+def schedule(shape, n_orders, rate, burst):
+    """
+    Times, relative to the start, to create each order at. Every shape
+    averages the given rate:
+        steady:     evenly spaced orders
+        burst:      groups of burst orders at once
+        ramp:       rate rising linearly from zero to twice the rate
+    """
+    if shape == 'steady':
+        return [i / rate for i in range(n_orders)]
+    elif shape == 'burst':
+        return [(i // burst) * burst / rate for i in range(n_orders)]
+    elif shape == 'ramp':
+        duration = n_orders / rate
+        return [duration * (float(i) / n_orders) ** 0.5
+                for i in range(n_orders)]
+    raise ValueError('Invalid load shape: %s' % shape)
+
+def run_bench(args):
+    """
+    Run the order handler on an in-memory mailbox and a headless bar in
+    this process and measure how orders flow between them.
+    """
+    ack = 'bench-ack'
+    pickup_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    pickup_sock.bind(('127.0.0.1', 0))
+    pickup_sock.listen(1)
+    config = {
+        'hostname': '127.0.0.1',
+        'port': free_port(),
+        'pickup_port': pickup_sock.getsockname()[1],
+        'buffer_size': args.buffer_size,
+        'bar_acknowledge': ack,
+        'gpg_passwd': 'bench-passwd',
+        'magic_word': 'bench',
+        'ciphers': args.ciphers,
+        'ticket_store': args.ticket_store,
+        }
+    config['ports'] = str(config['port'])
+    conf_fd, conf_file = tempfile.mkstemp(suffix='.conf')
+    with os.fdopen(conf_fd, 'w') as f:
+        f.write(json.dumps(config))
+    menu_fd, menu_file = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(menu_fd, 'w') as f:
+        f.write('Anything you like.\n')
+    overrides = {
+        'backend': 'memory',
+        'email_name': 'bench@localhost',
+        'send_name': 'Bench',
+        'mode': 'single',
+        'menu_file': menu_file,
+        'reply_window': args.reply_window,
+        'timeline_log': os.devnull,
+        }
+
+    handler = BenchHandler(conf_file, overrides)
+    if os.path.exists(handler.active_tickets):
+        os.remove(handler.active_tickets)
+    handler.tickets = oh.ts.open_ticket_store(handler.ticket_store,
+            handler.active_tickets)
+    bar = HeadlessBar(conf_file)
+
+    # Connect everything.
+    threading.Thread(target=pickup_stand_in, args=(pickup_sock, ack)).start()
+    server_init = threading.Thread(target=handler.socket_init)
+    server_init.start()
+    wait_listening(config['port'])
+    bar.socket_init()
+    server_init.join()
+    os.remove(conf_file)
+
+    handler_thread = threading.Thread(target=handler.run_event_loop)
+    handler_thread.start()
+    bar_thread = threading.Thread(target=bar.bartend,
+            args=(args.orders, args.batch))
+    bar_thread.daemon = True
+    bar_thread.start()
+
+    # Generate the load.
+    t_start = time.time()
+    subject = 'Bench order (%s)' % config['magic_word']
+    for i, offset in enumerate(schedule(args.shape, args.orders, args.rate,
+            args.burst)):
+        delay = t_start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        patron = i % args.patrons
+        sender = 'Patron %d <patron%d@localhost>' % (patron, patron)
+        # Patrons order again by replying in their own thread, so that
+        # the reply window has something to merge.
+        handler.mail.deliver(sender, subject, 'One bench order, number %d\n'
+                '\nOn Fri, Dec 14, 2018 at 9:00 PM Bench wrote:\n> Earlier'
+                % i, 'thread-%d' % patron)
+    bar_thread.join(args.timeout)
+
+    # Let the last notifications arrive, then shut down.
+    t_end = time.time() + 5
+    while len(handler.tickets.items()) and time.time() < t_end:
+        time.sleep(0.01)
+    bar.cleanup()
+    handler_thread.join()
+    handler.cleanup()
+    pickup_sock.close()
+    os.remove(menu_file)
+
+    # Collect the results.
+    bar_latency = [bar.received[i] - handler.created[i]
+            for i in bar.received if i in handler.created]
+    notif_latency = [handler.notif_times[k] - bar.notif_sent[k]
+            for k in bar.notif_sent if k in handler.notif_times]
+    done = [handler.notif_times[k] for k in handler.notif_times
+            if k[1] == 'pickup']
+    duration = (max(done) - t_start) if len(done) else 0.
+    return {
+        'config': {
+            'orders': args.orders,
+            'rate': args.rate,
+            'shape': args.shape,
+            'burst': args.burst,
+            'batch': args.batch,
+            'patrons': args.patrons,
+            'reply_window': args.reply_window,
+            'ciphers': args.ciphers,
+            'ticket_store': args.ticket_store,
+            },
+        'orders_completed': len(done),
+        'replies_sent': handler.mail.n_sent,
+        'duration': duration,
+        'orders_per_sec': len(done) / duration if duration else 0.,
+        'bar_latency_ms': percentiles(bar_latency),
+        'notif_latency_ms': percentiles(notif_latency),
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'timestamp': t_start,
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark order '
+            'throughput between the order handler and a headless bar.')
+    parser.add_argument('-n', '--orders', type=int, default=200,
+            help='number of orders to create')
+    parser.add_argument('-r', '--rate', type=float, default=50.,
+            help='average orders per second')
+    parser.add_argument('-s', '--shape', default='steady',
+            choices=['steady', 'burst', 'ramp'], help='load shape')
+    parser.add_argument('-b', '--burst', type=int, default=20,
+            help='orders per burst for the burst shape')
+    parser.add_argument('--batch', type=int, default=1,
+            help='orders the bar accepts and serves at once')
+    parser.add_argument('--patrons', type=int, default=50,
+            help='number of different patrons sending orders')
+    parser.add_argument('--reply-window', type=float, default=0.,
+            help='handler reply_window in seconds')
+    parser.add_argument('-c', '--ciphers', default='gpg',
+            help='ciphers the bar offers, e.g. "aead gpg"')
+    parser.add_argument('--ticket-store', default='journal',
+            help='handler ticket store')
+    parser.add_argument('--buffer-size', type=int, default=4096,
+            help='TCP receive buffer size')
+    parser.add_argument('--timeout', type=float, default=300.,
+            help='seconds to wait for the bar to finish')
+    parser.add_argument('-o', '--output', default='order_bench.json',
+            help='json file to write the results to')
+    args = parser.parse_args()
+
+    # The handler prints every ticket, which would swamp the results.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        results = run_bench(args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    with open(args.output, 'w') as f:
+        f.write(json.dumps(results, indent=4, sort_keys=True))
+    print('Orders completed: %d' % results['orders_completed'])
+    print('Replies sent: %d' % results['replies_sent'])
+    print('Throughput: %.1f orders/s' % results['orders_per_sec'])
+    for name in ['bar_latency_ms', 'notif_latency_ms']:
+        stats = results[name]
+        if len(stats):
+            print('%s: p50 %.2f  p99 %.2f  max %.2f' % (name, stats['p50'],
+                stats['p99'], stats['max']))
+    print('Max RSS: %d kB' % results['maxrss_kb'])
+    print('Results written to', args.output)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python2
+
+################################################################################
+## ThreadBench.py: Check and time the reply-thread filter.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(os.path.join(root_dir, 'server'))
+import QuoteFilter as qf
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'thread_corpus.json')
+
+def check_corpus(path):
+    """
+    Run the filter over the corpus and return the names of the cases
+    whose output differs from the expected one.
+    """
+    with open(path) as f:
+        cases = json.load(f)
+    failed = []
+    for case in cases:
+        body = case['body']
+        if bytes is str:
+            body = body.encode('utf-8')
+        result = qf.strip_quotes(body)
+        if bytes is str:
+            result = result.decode('utf-8')
+        if result != case['expected']:
+            failed.append((case['name'], result))
+    return len(cases), failed
+
+def reply_chain(n_replies):
+    """
+    A reply with n_replies levels of quoted replies below it, the way
+    a long email thread with the bar looks.
+    """
+    lines = ['One more gin and tonic please', '']
+    for i in range(n_replies):
+        quote = '> ' * (i + 1)
+        lines.append('%sOn Fri, Dec 14, 2018 at 9:%02d PM Obiwan Bar '
+                '<bar@example.com> wrote:' % (quote, i % 60))
+        lines.append(quote + 'Your order has been confirmed and will be '
+                'ready soon.')
+        lines.append(quote.rstrip())
+    return '\r\n'.join(lines)
+
+def time_filter(body, repeat):
+    """
+    Best time in seconds of filtering a body.
+    """
+    best = None
+    for i in range(repeat):
+        t_start = time.time()
+        qf.strip_quotes(body)
+        elapsed = time.time() - t_start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the reply-thread '
+            'filter against a corpus and time it on long reply chains.')
+    parser.add_argument('--corpus', default=CORPUS,
+            help='json file of bodies and expected results')
+    parser.add_argument('--sizes', default='10 100 1000 3000',
+            help='space-separated numbers of quoted replies to time')
+    parser.add_argument('--repeat', type=int, default=5,
+            help='runs per size, the best one is reported')
+    args = parser.parse_args()
+
+    n_cases, failed = check_corpus(args.corpus)
+    for name, result in failed:
+        print('FAILED %s: %r' % (name, result))
+    print('Corpus: %d/%d passed' % (n_cases - len(failed), n_cases))
+
+    for n_replies in [int(n) for n in args.sizes.split()]:
+        body = reply_chain(n_replies)
+        elapsed = time_filter(body, args.repeat)
+        print('%6d replies, %8d bytes: %8.3f ms  (%.1f MB/s)' % (n_replies,
+            len(body), 1000 * elapsed, len(body) / elapsed / 1e6))
+    sys.exit(len(failed) != 0)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python2
+
+################################################################################
+## BarEngine.py: Bartender queue state, independent of the user interface.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import time
+import random
+from collections import deque
+from OrderQueue import OrderQueue
+from PickupQueue import PickupQueue
+
+# Waiting order lanes, highest priority first.
+LANES = ('vip', 'normal', 'repeat')
+
+class BarEngine:
+    def __init__(self, send_notifs, send_pickup, pu_win_rows=0,
+            vip_senders=(), repeat_lane=False, order_aging=60.):
+        """
+        Own the waiting and pickup queues and the pickup cursor, and
+        record which parts of the screen each action changes.
+
+        send_notifs:    function(node_idx, notifs) to send a list of
+                        notifications to a server node at once
+        send_pickup:    function(screen_drink) to update the pickup screen
+        pu_win_rows:    number of visible pickup queue rows
+        vip_senders:    email addresses whose orders are served first
+        repeat_lane:    serve a patron's further orders after everyone
+                        else's first order
+        order_aging:    seconds of waiting worth one priority lane
+        """
+        self.send_notifs = send_notifs
+        self.send_pickup = send_pickup
+        self.pu_win_rows = pu_win_rows
+        self.vip_senders = set([addr.lower() for addr in vip_senders])
+        self.repeat_lane = repeat_lane
+
+        # Object items
+        self.cursor_pos = 0
+        self.cursor_row = 0
+        self.cursor_offset = 0
+        self.order_accepted = False
+        self.current = None
+        self.accepted_orders = deque()
+        self.patron_orders = {}
+        self.drinks_waiting = OrderQueue(LANES, order_aging)
+        self.drinks_pickup = PickupQueue()
+        self.changes = None
+        self.pop_changes()
+
+    def _pickup_changed(self, idx=0, offset=None):
+        """
+        Mark the visible pickup rows from list index idx onwards as
+        changed. Scrolling changes every row.
+        """
+        if offset is not None and offset != self.cursor_offset:
+            idx = self.cursor_offset
+        first = max(0, idx - self.cursor_offset)
+        self.changes['pickup'].update(range(first, self.pu_win_rows))
+
+    def _add_pickup(self, order):
+        """
+        Add a finished order to its patron's pickup queue entry.
+        """
+        new_drink = {'id': order['id'], 'drink': order['body']}
+        new_drink['node'] = order['node']
+        new_drink['t_ready'] = time.time()
+        drink = self.drinks_pickup.find(order['from'])
+        if drink is not None:
+            drink['orders'].append(new_drink)
+            rows = self.drinks_pickup.window(self.cursor_offset,
+                    self.pu_win_rows)
+            for i, row_drink in enumerate(rows):
+                if row_drink is drink:
+                    self.changes['pickup'].add(i)
+            return
+
+        drink = {'name':order['from'], 'orders':[new_drink]}
+        pickup_id = None
+        while pickup_id is None or pickup_id in self.drinks_pickup:
+            pickup_id = str(int(time.time())) + '.'
+            pickup_id += str(random.randint(1 << 10, 1 << 20))
+        drink['id'] = pickup_id
+        self.drinks_pickup.add(drink)
+        self._pickup_changed(len(self.drinks_pickup) - 1)
+
+        screen_drink = {'id': pickup_id, 'name': drink['name']}
+        screen_drink['action'] = 'add'
+        self.send_pickup(screen_drink)
+
+    def _finish(self, order):
+        """
+        Stop counting an order against its patron.
+        """
+        patron = order['from']
+        self.patron_orders[patron] -= 1
+        if not self.patron_orders[patron]:
+            del self.patron_orders[patron]
+
+    def _next_order(self):
+        """
+        Finish the current order and move on to the next one, which is
+        the next order already accepted, if any, or the next best one.
+        """
+        order = self.current
+        self._finish(order)
+
+        if len(self.accepted_orders):
+            self.current = self.accepted_orders.popleft()
+            self.order_accepted = True
+        else:
+            self.current = self.drinks_waiting.pop_next()
+            self.order_accepted = False
+        self.changes['order'] = True
+        self.changes['count'] = True
+        return order
+
+    def _notify(self, orders, status, **fields):
+        """
+        Send one notification frame per server node for a list of
+        orders. Drinks that were waiting for pickup also report how
+        many seconds ago they were made ready.
+        """
+        by_node = {}
+        t_now = time.time()
+        for order in orders:
+            notif = {'id': order['id'], 'status': status}
+            notif.update(fields)
+            if 't_ready' in order:
+                notif['ready_for'] = round(t_now - order['t_ready'], 3)
+            by_node.setdefault(order['node'], []).append(notif)
+        for node_idx, notifs in by_node.items():
+            self.send_notifs(node_idx, notifs)
+
+    def accept(self, n_orders=1):
+        """
+        Approve the next n_orders orders that aren't accepted yet,
+        starting with the current one.
+        """
+        if self.current is None:
+            return
+        orders = []
+        if not self.order_accepted:
+            self.order_accepted = True
+            self.changes['order'] = True
+            orders.append(self.current)
+        while len(orders) < n_orders:
+            order = self.drinks_waiting.pop_next()
+            if order is None:
+                break
+            self.accepted_orders.append(order)
+            orders.append(order)
+
+        # notify the email server
+        self._notify(orders, 'accepted')
+
+    def add_order(self, order):
+        """
+        Queue a new order. Returns True if it is shown right away.
+        """
+        lane = self.classify(order)
+        patron = order['from']
+        self.patron_orders[patron] = self.patron_orders.get(patron, 0) + 1
+        if self.current is None:
+            self.current = order
+            self.changes['order'] = True
+            return True
+
+        self.drinks_waiting.push(order, lane)
+        self.changes['count'] = True
+        return False
+
+    def cancel(self, reason='unspecified'):
+        """
+        Cancel the current order.
+        """
+        if self.current is None:
+            return
+        order = self._next_order()
+
+        # notify the email server
+        self._notify([order], 'cancelled', reason=reason)
+
+    def current_order(self):
+        """
+        The order the bartender is working on, if any.
+        """
+        return self.current
+
+    def classify(self, order):
+        """
+        Choose the waiting lane for a new order.
+        """
+        # The from field is only the display name, so the server sends
+        # the address separately. Older servers don't send it.
+        address = (order.get('email') or '').lower()
+        if address in self.vip_senders:
+            return 'vip'
+        if self.repeat_lane and order['from'] in self.patron_orders:
+            return 'repeat'
+        return 'normal'
+
+    def n_waiting(self):
+        """
+        Number of orders after the current one, accepted or not.
+        """
+        return len(self.accepted_orders) + len(self.drinks_waiting)
+
+    def pickup(self):
+        """
+        Mark the drinks under the cursor as picked up.
+        """
+        if not len(self.drinks_pickup):
+            return
+        offset = self.cursor_offset
+        self.cursor_row = self.cursor_offset + self.cursor_pos
+
+        # Remove the drink from the pickup list and
+        removed_row = self.cursor_row
+        pickup_order = self.drinks_pickup.at(self.cursor_row)
+        self.drinks_pickup.pop(pickup_order['id'])
+        n_drinks = len(self.drinks_pickup)
+        end_row = self.pu_win_rows - 1
+
+        # decrement the cursor offset if at the last drink
+        if self.cursor_row == n_drinks:
+            self.cursor_offset = max(0, self.cursor_offset-1)
+            self.cursor_row = self.cursor_pos + self.cursor_offset
+
+        # Make sure the cursor position and offset stays in list boundaries
+        n_drinks = max(0, n_drinks - 1)
+        self.cursor_pos = min(self.cursor_pos, self.cursor_row, n_drinks)
+        self.cursor_row = self.cursor_pos + self.cursor_offset
+        self.cursor_offset = min(self.cursor_offset, n_drinks-end_row)
+        self.cursor_offset = max(0, self.cursor_offset)
+        self._pickup_changed(removed_row, offset)
+
+        # notify the email server
+        self._notify(pickup_order['orders'], 'pickup')
+
+        # Notify the pickup screen
+        screen_drink = {'id': pickup_order['id'], 'action': 'remove'}
+        self.send_pickup(screen_drink)
+
+    def pop_changes(self):
+        """
+        Return what changed since the last call:
+            order:      the current order or its accepted state
+            count:      the number of orders after the current one
+            pickup:     set of visible pickup rows
+        """
+        changes = self.changes
+        self.changes = {'order': False, 'count': False, 'pickup': set()}
+        return changes
+
+    def scroll(self, step):
+        """
+        Move the pickup cursor one row down (step > 0) or up (step < 0).
+        """
+        n_drinks = len(self.drinks_pickup) - 1
+        offset = self.cursor_offset
+        old_pos = self.cursor_pos
+        self.cursor_row = self.cursor_offset + self.cursor_pos
+
+        # Scrolling down
+        if step > 0:
+            end_row = self.pu_win_rows - 1
+            if self.cursor_pos == end_row and self.cursor_row < n_drinks:
+                self.cursor_offset += 1
+            self.cursor_pos = min(self.cursor_pos+1, end_row, n_drinks)
+
+            # Stay on the first row of an empty queue.
+            self.cursor_pos = max(self.cursor_pos, 0)
+
+        # Scrolling up
+        if step < 0:
+            if self.cursor_pos == 0 and self.cursor_row > 0:
+                self.cursor_offset = max(self.cursor_offset-1, 0)
+            self.cursor_pos = max(self.cursor_pos-1, 0)
+        self.cursor_row = self.cursor_offset + self.cursor_pos
+
+        if offset != self.cursor_offset:
+            self._pickup_changed(offset=offset)
+        elif old_pos != self.cursor_pos:
+            self.changes['pickup'].update([old_pos, self.cursor_pos])
+
+    def send_to_pickup(self, group=False):
+        """
+        Mark the current drink as ready for pickup. With group, the
+        patron's other accepted drinks go to pickup with it.
+        """
+        if self.current is None:
+            return
+        patron = self.current['from']
+        self._add_pickup(self._next_order())
+        if not group:
+            return
+
+        # The orders now shown may belong to the same patron.
+        while self.order_accepted and self.current['from'] == patron:
+            self._add_pickup(self._next_order())
+        others = deque()
+        for order in self.accepted_orders:
+            if order['from'] == patron:
+                self._finish(order)
+                self._add_pickup(order)
+            else:
+                others.append(order)
+        self.accepted_orders = others
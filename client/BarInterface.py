@@ -21,12 +21,9 @@
 from __future__ import print_function
 import os
 import sys
-import time
-import zlib
 import curses
-import random
-import pickle as pkl
 import multiprocessing as mp
+from BarEngine import BarEngine
 from OrderReceiver import OrderReceiver
 
 class BarInterface(OrderReceiver):
@@ -34,15 +31,10 @@ class BarInterface(OrderReceiver):
         OrderReceiver.__init__(self, conf_file)
 
         # Object items
-        self.pu_win_rows = 0
-        self.cursor_pos = 0
-        self.cursor_row = 0
-        self.cursor_offset = 0
+        self.engine = BarEngine(self.send_notifs, self.send_pickup,
+                vip_senders=self.vip_senders, repeat_lane=self.repeat_lane,
+                order_aging=self.order_aging)
         self.win_selected = 'order'
-        self.order_accepted = False
-        self.drinks_waiting = []
-        self.drinks_pickup = []
-        self.pickup_sock = None
         self.col_white = None
         self.col_selected = None
         self._ev_recv = None
@@ -70,28 +62,19 @@ class BarInterface(OrderReceiver):
         self.ui_open()
         self.events_watchdog_init()
 
-    def display_order(self, order=None):
+    def add_order(self, order):
         """
-        Display an order on the window.
+        Queue a new order, announcing it if it is shown right away.
         """
-        self.update_drink_wait_count()
-        play_sound = False
-
-        if order is not None:
-            play_sound = not len(self.drinks_waiting)
-            self.drinks_waiting.append(order)
-            if len(self.drinks_waiting) > 1:
-                self.update_drink_wait_count()
-                return
-
-        if order is None and len(self.drinks_waiting):
-            if order is None:
-                order = self.drinks_waiting[0]
-                self.update_drink_wait_count()
-
-        if play_sound:
+        if self.engine.add_order(order):
             os.system('espeak "Attention! Somebody has ordered a drink." &> /dev/null &')
+        self.render()
 
+    def display_order(self):
+        """
+        Display the current order on the window.
+        """
+        order = self.engine.current_order()
         self.order_win.erase()
         if self.win_selected == 'order':
             self.order_win.bkgdset(' ', self.col_selected)
@@ -101,8 +84,7 @@ class BarInterface(OrderReceiver):
         self.show_order_win_keys()
 
         if order is None:
-            self.stdscr.refresh()
-            self.order_win.refresh()
+            self.order_win.noutrefresh()
             return
 
         patron = order['from']
@@ -112,35 +94,49 @@ class BarInterface(OrderReceiver):
         self.order_win.addstr(5, 3, 'Drink request:', self.col_white_bold)
         for i, line in enumerate(drink_request):
             self.order_win.addstr(6+i, 3, line, self.col_white)
-        self.stdscr.refresh()
-        self.order_win.refresh()
 
-    def display_pickup(self):
+        # Drinks the server matched against the menu, if it has one.
+        if 'drinks' in order:
+            row = 7 + len(drink_request)
+            self.order_win.addstr(row, 3, 'Menu items:', self.col_white_bold)
+            self.order_win.addstr(row+1, 3, ', '.join(order['drinks']),
+                    self.col_white)
+        self.order_win.noutrefresh()
+
+    def display_pickup(self, rows=None):
         """
-        Display the pickup window.
+        Display the pickup window. If rows is given, only those visible
+        rows of the pickup queue are redrawn.
         """
-        # Clear the window first
-        self.pickup_win.erase()
-        if self.win_selected == 'pickup':
-            self.order_win.bkgdset(' ', self.col_white)
-            self.pickup_win.bkgdset(' ', self.col_selected)
-        else:
-            self.order_win.bkgdset(' ', self.col_selected)
-            self.pickup_win.bkgdset(' ', self.col_white)
-        self.pickup_win.border(0)
-        self.show_pickup_win_keys()
-
-        self.pickup_win.addstr(2, 3, 'Pickup Queue:', self.col_white_bold)
-        for i in range(min(len(self.drinks_pickup), self.pu_win_rows)):
-            patron = self.drinks_pickup[i+self.cursor_offset]
-            item_name = patron['name'] + ' (%d)' % len(patron['orders'])
-            if self.win_selected == 'pickup' and i == self.cursor_pos:
+        if rows is None:
+            self.pickup_win.erase()
+            if self.win_selected == 'pickup':
+                self.pickup_win.bkgdset(' ', self.col_selected)
+            else:
+                self.pickup_win.bkgdset(' ', self.col_white)
+            self.pickup_win.border(0)
+            self.show_pickup_win_keys()
+            self.pickup_win.addstr(2, 3, 'Pickup Queue:', self.col_white_bold)
+            rows = range(self.engine.pu_win_rows)
+
+        # Pad every row to the window width so that it overwrites the
+        # previous contents without clearing the window.
+        _, ncols = self.size
+        width = ncols/2 - 10
+        engine = self.engine
+        visible = engine.drinks_pickup.window(engine.cursor_offset,
+                engine.pu_win_rows)
+        for i in rows:
+            item_name = ''
+            if i < len(visible):
+                patron = visible[i]
+                item_name = patron['name'] + ' (%d)' % len(patron['orders'])
+            item_name = item_name.ljust(width)[:width]
+            if self.win_selected == 'pickup' and i == engine.cursor_pos:
                 self.pickup_win.addstr(3+i, 3, item_name, self.col_cursor)
             else:
                 self.pickup_win.addstr(3+i, 3, item_name, self.col_white)
-
-        self.stdscr.refresh()
-        self.pickup_win.refresh()
+        self.pickup_win.noutrefresh()
 
     def events_watchdog_init(self):
         """
@@ -169,158 +165,53 @@ class BarInterface(OrderReceiver):
         """
         while True:
             self.notif_event.send(('input', self.stdscr.getch()))
-        self.send_notif(order['node'], notif)
 
     def keypress_order_win(self, key):
         """
         Keypresses for order window.
         """
-        if self.order_accepted:
+        if self.engine.order_accepted:
             if key == ord('c') or key == ord('C'):
-                self.order_win_cancel()
+                # TODO make a pop-up confirming the reason for the cancel
+                self.engine.cancel()
             if key == ord('s') or key == ord('S'):
-                self.order_win_send_to_pickup()
+                self.engine.send_to_pickup()
+            if key == ord('g') or key == ord('G'):
+                self.engine.send_to_pickup(group=True)
         else:
-            if key == ord('a') or key == ord('a'):
-                self.order_win_accept()
+            if key == ord('a') or key == ord('A'):
+                self.engine.accept()
+            if ord('2') <= key <= ord('9'):
+                self.engine.accept(key - ord('0'))
             if key == ord('d') or key == ord('D'):
-                self.order_win_cancel()
+                self.engine.cancel()
 
     def keypress_pickup_win(self, key):
         """
         Keypresses for the pickup window.
         """
-        n_drinks = len(self.drinks_pickup) - 1
-        self.cursor_row = self.cursor_offset + self.cursor_pos
-
-        # Scrolling down
         if key == ord('j') or key == curses.KEY_DOWN:
-            end_row = self.pu_win_rows - 1
-            if self.cursor_pos == end_row and self.cursor_row < n_drinks:
-                self.cursor_offset += 1
-            self.cursor_pos = min(self.cursor_pos+1, end_row, n_drinks)
-
-        # Scrolling up
+            self.engine.scroll(1)
         if key == ord('k') or key == curses.KEY_UP:
-            if self.cursor_pos == 0 and self.cursor_row > 0:
-                self.cursor_offset = max(self.cursor_offset-1, 0)
-            self.cursor_pos = max(self.cursor_pos-1, 0)
+            self.engine.scroll(-1)
 
         # Mark the drink as picked up
         if key == ord('p'):
-            self.pickup_drink()
-
-        self.display_pickup()
+            self.engine.pickup()
 
     def main(self):
         """
         Run the bartender interface.
         """
         self.update_drink_wait_count()
+        curses.doupdate()
         while True:
             event = self.get_event.recv()
             if event[0] == 'order':
-                self.display_order(event[1])
+                self.add_order(event[1])
             else:
                 self.process_keypress(event[1])
 
-    def order_win_accept(self):
-        """
-        Approve the current drink in the order queue
-        """
-        if not len(self.drinks_waiting):
-            return
-        # Update the UI
-        self.order_accepted = True
-        self.display_order()
-
-        # notify the email server
-        order = self.drinks_waiting[0]
-        notif = {'id': order['id'], 'status': 'accepted'}
-        self.send_notif(order['node'], notif)
-
-    def order_win_cancel(self):
-        """
-        Cancel an order.
-        """
-        if not len(self.drinks_waiting):
-            return
-        # TODO make a pop-up confirming the reason for the cancel
-        self.order_accepted = False
-        order = self.drinks_waiting.pop(0)
-        self.display_order()
-
-        # notify the email server
-        notif = {'id': order['id'], 'status': 'cancelled'}
-        notif['reason'] = 'unspecified'
-        self.send_notif(order['node'], notif)
-
-    def order_win_send_to_pickup(self):
-        """
-        Mark a drink as ready for pickup
-        """
-        if not len(self.drinks_waiting):
-            return
-        # Update the pickup screen
-        self.order_accepted = False
-        order = self.drinks_waiting.pop(0)
-        self.display_order()
-
-        # Add drink to the pickup queue
-        new_drink = {'id': order['id'], 'drink': order['body']}
-        new_drink['node'] = order['node']
-        not_added = True
-        for drink in self.drinks_pickup:
-            if order['from'] == drink['name']:
-                drink['orders'].append(new_drink)
-                not_added = False # LOL, double negative
-
-        if not_added:
-            drink = {'name':order['from'], 'orders':[new_drink]}
-            pickup_id = str(int(time.time())) + '.'
-            pickup_id += str(random.randint(1 << 10, 1 << 20))
-            drink['id'] = pickup_id
-            self.drinks_pickup.append(drink)
-
-            screen_drink = {'id': pickup_id, 'name': drink['name']}
-            screen_drink['action'] = 'add'
-            self.pickup_sock.send(pkl.dumps(screen_drink))
-
-        self.display_pickup()
-
-    def pickup_drink(self):
-        """
-        Notify when someone picks up their drinks
-        """
-        if not len(self.drinks_pickup):
-            return
-
-        # Remove the drink from the pickup list and
-        pickup_order = self.drinks_pickup.pop(self.cursor_row)
-        n_drinks = len(self.drinks_pickup)
-        end_row = self.pu_win_rows - 1
-
-        # decrement the cursor offset if at the last drink
-        if self.cursor_row == n_drinks:
-            self.cursor_offset = max(0, self.cursor_offset-1)
-            self.cursor_row = self.cursor_pos + self.cursor_offset
-
-        # Make sure the cursor position and offset stays in list boundaries
-        n_drinks = max(0, n_drinks - 1)
-        self.cursor_pos = min(self.cursor_pos, self.cursor_row, n_drinks)
-        self.cursor_row = self.cursor_pos + self.cursor_offset
-        self.cursor_offset = min(self.cursor_offset, n_drinks-end_row)
-        self.cursor_offset = max(0, self.cursor_offset)
-
-        # notify the email server
-        for order in pickup_order['orders']:
-            notif = {'id': order['id'], 'status': 'pickup'}
-            self.send_notif(order['node'], notif)
-
-        # Notify the pickup screen
-        screen_drink = {'id': pickup_order['id'], 'action': 'remove'}
-        self.pickup_sock.send(pkl.dumps(screen_drink))
-
     def process_keypress(self, key):
         """
         Handle processing the keypresses
@@ -330,14 +221,31 @@ class BarInterface(OrderReceiver):
         else:
             self.keypress_pickup_win(key)
 
-        # Window selection
+        # Window selection redraws both windows with the new highlight.
+        selected = self.win_selected
         if key == curses.KEY_LEFT:
             self.win_selected = 'order'
         elif key == curses.KEY_RIGHT:
             self.win_selected = 'pickup'
-
-        self.display_order()
-        self.display_pickup()
+        if selected != self.win_selected:
+            self.engine.pop_changes()
+            self.display_order()
+            self.display_pickup()
+            self.update_drink_wait_count()
+        self.render()
+
+    def render(self):
+        """
+        Repaint only what the engine changed since the last repaint.
+        """
+        changes = self.engine.pop_changes()
+        if changes['order']:
+            self.display_order()
+        if changes['count']:
+            self.update_drink_wait_count()
+        if len(changes['pickup']):
+            self.display_pickup(sorted(changes['pickup']))
+        curses.doupdate()
 
     def show_order_win_keys(self):
         """
@@ -345,10 +253,10 @@ class BarInterface(OrderReceiver):
         """
         nrows, _ = self.size
 
-        if self.order_accepted:
-            ord_keys = '(c) Cancel\t(s) Send to pickup'
+        if self.engine.order_accepted:
+            ord_keys = '(c) Cancel  (s) Send to pickup  (g) Send group'
         else:
-            ord_keys = '(a) Accept\t(d) Decline'
+            ord_keys = '(a) Accept  (2-9) Accept next N  (d) Decline'
 
         self.order_win.addstr(nrows-4-3-2, 3, 'Keys:', self.col_white_bold)
         self.order_win.addstr(nrows-4-3-2, 3+6, ord_keys, self.col_white)
@@ -412,6 +320,7 @@ class BarInterface(OrderReceiver):
         for i in range(nrows-2):
             self.stdscr.addstr(i+1, 1, (ncols-2) * ' ')
         self.size = (nrows, ncols)
+        self.stdscr.noutrefresh()
 
         self.count_win = curses.newwin(3, ncols/2-6, 2+nrows-4-3, 4)
         self.count_win.bkgdset(' ', self.col_white)
@@ -422,26 +331,23 @@ class BarInterface(OrderReceiver):
         self.display_order()
 
         self.pickup_win = curses.newwin(nrows-4, ncols/2-6, 2, ncols/2+2)
-        self.pu_win_rows = nrows - 4 - 6
+        self.engine.pu_win_rows = nrows - 4 - 6
         self.display_pickup()
 
-        self.stdscr.refresh()
-        self.order_win.refresh()
-        self.pickup_win.refresh()
-        self.count_win.refresh()
+        self.count_win.noutrefresh()
+        curses.doupdate()
 
     def update_drink_wait_count(self):
         """
         Update the count window to the number of drink orders waiting.
         """
         count_str = 'Drink orders waiting: '
-        n_dr = str(max(0, len(self.drinks_waiting)-1))
+        n_dr = str(self.engine.n_waiting())
         nrows, ncols = self.size
         self.count_win.addstr(1, 3, ' '*(ncols/2-10), self.col_white)
         self.count_win.addstr(1, 3, count_str, self.col_white_bold)
         self.count_win.addstr(1, 3+len(count_str), n_dr, self.col_white_bold)
-        self.stdscr.refresh()
-        self.count_win.refresh()
+        self.count_win.noutrefresh()
 
 
 # Set up the bartender interface.
@@ -0,0 +1,102 @@
+#!/usr/bin/env python2
+
+################################################################################
+## OrderQueue.py: Waiting order queue with priority lanes.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import time
+from collections import deque
+
+class OrderQueue:
+    def __init__(self, lanes, aging=60.):
+        """
+        Orders waiting for the bartender, in FIFO lanes listed from
+        highest to lowest priority.
+
+        The next best order is the oldest order of the highest priority
+        lane, except that an order gains one lane of priority for every
+        aging seconds it has waited, so low priority orders are never
+        starved. Only the head of each lane is compared, so taking the
+        next order costs O(number of lanes).
+
+        lanes:  lane names, highest priority first
+        aging:  seconds of waiting worth one lane of priority, or 0 to
+                always serve strictly by lane
+        """
+        self.lanes = list(lanes)
+        self.aging = aging
+        self.queues = dict([(lane, deque()) for lane in self.lanes])
+        self.n_orders = 0
+
+    def __iter__(self):
+        for lane in self.lanes:
+            for _, order in self.queues[lane]:
+                yield order
+
+    def __len__(self):
+        return self.n_orders
+
+    def _best_lane(self, now=None):
+        """
+        Return the lane holding the next best order, or None.
+        """
+        if now is None:
+            now = time.time()
+        best = None
+        best_key = None
+        for rank, lane in enumerate(self.lanes):
+            queue = self.queues[lane]
+            if not len(queue):
+                continue
+            t_queued = queue[0][0]
+            if self.aging > 0:
+                key = (rank - (now - t_queued) / self.aging, t_queued)
+            else:
+                key = (rank, t_queued)
+            if best_key is None or key < best_key:
+                best = lane
+                best_key = key
+        return best
+
+    def next_order(self, now=None):
+        """
+        Return the next best order without removing it, or None.
+        """
+        lane = self._best_lane(now)
+        if lane is None:
+            return None
+        return self.queues[lane][0][1]
+
+    def pop_next(self, now=None):
+        """
+        Remove and return the next best order, or None.
+        """
+        lane = self._best_lane(now)
+        if lane is None:
+            return None
+        self.n_orders -= 1
+        return self.queues[lane].popleft()[1]
+
+    def push(self, order, lane=None):
+        """
+        Add an order to the end of a lane, the lowest one by default.
+        """
+        if lane is None:
+            lane = self.lanes[-1]
+        self.queues[lane].append((time.time(), order))
+        self.n_orders += 1
@@ -19,14 +19,18 @@
 ################################################################################
 
 from __future__ import print_function
+import os
 import sys
 import json
 import time
-import zlib
-import gnupg
 import socket
-import pickle as pkl
 import multiprocessing as mp
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir, 'common'))
+import Handshake as hs
+import WireCrypto as wc
+import WireFraming as wf
+import WireSchema as ws
 
 class OrderReceiver:
     def __init__(self, conf_file):
@@ -35,8 +39,12 @@ class OrderReceiver:
         Configuration items:
             hostname:           hostname of the order server
             ports:              space-separated list of server node ports
-            buffer_size:        the size of the TCP buffer
+            buffer_size:        initial size of the TCP receive buffer
             bar_acknowledge:    a word to check from the bar client
+            ciphers:            space-separated ciphers, in preference order
+            vip_senders:        space-separated addresses served first
+            repeat_lane:        serve repeat orders after first orders
+            order_aging:        seconds of waiting worth one priority lane
         """
         with open(conf_file) as f:
             config = json.loads(f.read())
@@ -46,12 +54,19 @@ class OrderReceiver:
         self.bar_acknowledge = config['bar_acknowledge']
         self.gpg_passwd = config['gpg_passwd']
         self.pickup_port = config['pickup_port']
+        self.ciphers = config.get('ciphers', 'gpg').split()
+        self.vip_senders = config.get('vip_senders', '').split()
+        self.repeat_lane = config.get('repeat_lane', False)
+        self.order_aging = config.get('order_aging', 60.)
 
         # Object items
         self.pickup_screen = "127.0.0.1"
-        self.gpg = None
         self.node_procs = []
         self.node_sockets = []
+        self.node_ciphers = []
+        self.node_codecs = []
+        self.pickup_sock = None
+        self.pickup_codec = None
         self.proc_join = None
         self.recv_port = None
 
@@ -60,13 +75,20 @@ class OrderReceiver:
         Get a packet from the server.
         Parse packet into dictionary.
         Send packet to unified receiver.
-        Packet is a pickled dictionary.
+        Packet is an encoded dictionary.
         """
         sock = self.node_sockets[node_idx]
+        cipher = self.node_ciphers[node_idx]
+        codec = self.node_codecs[node_idx]
         while True:
-            order = sock.recv(self.buffer_size)
-            order = self.gpg.decrypt(order, passphrase=self.gpg_passwd)
-            order = pkl.loads(zlib.decompress(order.data))
+            order = sock.recv_frame()
+            if order is None: # Server closed.
+                return
+            try:
+                order = codec.decode(cipher.decrypt(order))
+            except ValueError as err:
+                print('Invalid order packet:', err)
+                continue
             order['node'] = node_idx
             self.recv_port.send(order)
 
@@ -80,31 +102,55 @@ class OrderReceiver:
         """
         Send a notification back to the email robot.
         """
+        self.send_notifs(node_idx, [notif])
+
+    def send_notifs(self, node_idx, notifs):
+        """
+        Send a list of notifications back to the email robot in one
+        message. A single notification is sent on its own.
+        """
+        if len(notifs) == 1:
+            notifs = notifs[0]
+
         # Encrypt a notification
-        notif = zlib.compress(pkl.dumps(notif, pkl.HIGHEST_PROTOCOL))
-        encrypted = self.gpg.encrypt(notif, None, symmetric='AES256',
-                passphrase=self.gpg_passwd, armor=False)
+        notif = self.node_codecs[node_idx].encode(notifs)
+        encrypted = self.node_ciphers[node_idx].encrypt(notif)
 
         # Send the notification to the server.
         sock = self.node_sockets[node_idx]
-        sock.send(encrypted.data)
+        sock.send_frame(encrypted)
+
+    def send_pickup(self, screen_drink):
+        """
+        Send an update to the pickup window screen.
+        """
+        self.pickup_sock.send_frame(self.pickup_codec.encode(screen_drink))
 
     def socket_init(self):
         """
         Initialize the network connection with the email server.
         """
-        self.gpg = gnupg.GPG()
         # Set up the socket receiver threads.
         self.proc_join, self.recv_port = mp.Pipe(False)
 
-        # Send the hello message to the server.
+        # Send the hello message to the server and agree on a cipher
+        # and a message encoding.
+        offer = wc.client_offer(self.ciphers)
+        offer.update(ws.client_offer())
+        hello = hs.format_hello(self.bar_acknowledge, offer)
         for i, port in enumerate(self.ports):
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.connect((self.hostname, port))
-            sock.send(self.bar_acknowledge)
-            if sock.recv(self.buffer_size) != self.bar_acknowledge:
+            sock = wf.FramedSocket(sock, self.buffer_size)
+            sock.send_frame(hello)
+            word, options = hs.parse_hello(sock.recv_frame())
+            if word != self.bar_acknowledge:
                 raise ValueError('Invalid acknowledgement.')
             self.node_sockets.append(sock)
+            self.node_ciphers.append(wc.client_select(options,
+                self.gpg_passwd))
+            self.node_codecs.append(ws.client_select(options,
+                ws.PickleCodec()))
 
             proc = mp.Process(target=self._get_packet, args=(i,))
             proc.daemon = True
@@ -112,11 +158,16 @@ class OrderReceiver:
             self.node_procs.append(proc)
 
         # Connect to the pickup window screen.
-        self.pickup_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.pickup_sock.connect((self.pickup_screen, self.pickup_port))
-        self.pickup_sock.send(self.bar_acknowledge)
-        if self.pickup_sock.recv(self.buffer_size) != self.bar_acknowledge:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((self.pickup_screen, self.pickup_port))
+        self.pickup_sock = wf.FramedSocket(sock, self.buffer_size)
+        self.pickup_sock.send_frame(hs.format_hello(self.bar_acknowledge,
+            ws.client_offer()))
+        word, options = hs.parse_hello(self.pickup_sock.recv_frame())
+        if word != self.bar_acknowledge:
             raise ValueError('Invalid acknowledgement.')
+        self.pickup_codec = ws.client_select(options,
+                ws.PickleCodec(compress=False))
 
 if __name__ == '__main__':
     # Quick test of the essential functionality
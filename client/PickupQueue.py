@@ -0,0 +1,102 @@
+#!/usr/bin/env python2
+
+################################################################################
+## PickupQueue.py: Ordered pickup queue indexed by patron and pickup ID.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import itertools
+from collections import OrderedDict
+
+# values() copies the whole dictionary into a list in Python 2.
+_itervalues = getattr(OrderedDict, 'itervalues', OrderedDict.values)
+
+class PickupQueue:
+    def __init__(self):
+        """
+        Drinks ready for pickup, in the order they became ready. Each
+        entry is a dictionary with at least an 'id' and a 'name'.
+
+        Entries are kept in an ordered dictionary keyed by pickup ID,
+        with a second dictionary from patron name to pickup ID, so
+        adding, finding a patron's entry and removing an entry are all
+        O(1). Lookups by position walk from the front of the queue and
+        are only meant for the rows visible on screen.
+        """
+        self.by_id = OrderedDict()
+        self.by_name = {}
+
+    def __contains__(self, pickup_id):
+        return pickup_id in self.by_id
+
+    def __iter__(self):
+        return iter(_itervalues(self.by_id))
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def add(self, entry):
+        """
+        Add an entry to the end of the queue. An entry with the same
+        pickup ID is replaced in place.
+        """
+        pickup_id = entry['id']
+        old = self.by_id.get(pickup_id)
+        if old is not None and self.by_name.get(old['name']) == pickup_id:
+            del self.by_name[old['name']]
+        self.by_id[pickup_id] = entry
+        self.by_name[entry['name']] = pickup_id
+
+    def at(self, idx):
+        """
+        Return the entry at a position in the queue.
+        """
+        if idx < 0 or idx >= len(self.by_id):
+            raise IndexError('pickup queue index out of range')
+        return next(itertools.islice(_itervalues(self.by_id), idx, None))
+
+    def find(self, name):
+        """
+        Return the entry for a patron, or None.
+        """
+        pickup_id = self.by_name.get(name)
+        if pickup_id is None:
+            return None
+        return self.by_id[pickup_id]
+
+    def get(self, pickup_id, default=None):
+        return self.by_id.get(pickup_id, default)
+
+    def pop(self, pickup_id, default=None):
+        """
+        Remove an entry by pickup ID. Unknown IDs return default and
+        leave the queue unchanged.
+        """
+        entry = self.by_id.pop(pickup_id, None)
+        if entry is None:
+            return default
+        if self.by_name.get(entry['name']) == pickup_id:
+            del self.by_name[entry['name']]
+        return entry
+
+    def window(self, start, n_rows):
+        """
+        Return the entries in rows [start, start+n_rows) of the queue.
+        """
+        start = max(0, start)
+        entries = _itervalues(self.by_id)
+        return list(itertools.islice(entries, start, start+n_rows))
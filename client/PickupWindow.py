@@ -26,8 +26,13 @@ import json
 import curses
 import socket
 import random
-import pickle as pkl
 import multiprocessing as mp
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir, 'common'))
+import Handshake as hs
+import WireFraming as wf
+import WireSchema as ws
+from PickupQueue import PickupQueue
 
 class PickupWindow:
     def __init__(self, conf_file):
@@ -45,12 +50,13 @@ class PickupWindow:
 
         # Object items
         self.win_idx = 0
-        self.drinks_pickup = []
+        self.drinks_pickup = PickupQueue()
         self._ev_recv = None
         self._ev_timer = None
         self.get_event = None
         self.notif_event = None
         self.bar_sock = None
+        self.codec = None
 
     def cleanup(self):
         """
@@ -144,9 +150,9 @@ class PickupWindow:
 
         # Run the display
         idx = self.win_idx
-        for i in range(idx*max_drinks, min((idx+1)*max_drinks, self.curr_len)):
-            row_idx = i % max_drinks
-            name = self.drinks_pickup[i]['name']
+        page = self.drinks_pickup.window(idx*max_drinks, max_drinks)
+        for row_idx, drink in enumerate(page):
+            name = drink['name']
             self.pickup_win.addstr(4+row_idx, 4, name, self.col_white_bold)
 
         self.stdscr.refresh()
@@ -158,10 +164,14 @@ class PickupWindow:
         Watch for new orders
         """
         while True:
-            order = self.bar_conn.recv(self.buffer_size)
-            if not len(order):
+            order = self.bar_conn.recv_frame()
+            if order is None:
                 self.notif_event.send(('quit', None))
-            order = pkl.loads(order)
+                return
+            try:
+                order = self.codec.decode(order)
+            except ValueError: # Skip malformed updates.
+                continue
             self.notif_event.send(('order', order))
 
     def _events_timer(self):
@@ -199,35 +209,6 @@ class PickupWindow:
             else:
                 return
 
-    def pickup_drink(self):
-        """
-        Notify when someone picks up their drinks
-        """
-        if not len(self.drinks_pickup):
-            return
-
-        # Remove the drink from the pickup list and
-        pickup_order = self.drinks_pickup.pop(self.cursor_row)
-        n_drinks = len(self.drinks_pickup)
-        end_row = self.pu_win_rows - 1
-
-        # decrement the cursor offset if at the last drink
-        if self.cursor_row == n_drinks:
-            self.cursor_offset = max(0, self.cursor_offset-1)
-            self.cursor_row = self.cursor_pos + self.cursor_offset
-
-        # Make sure the cursor position and offset stays in list boundaries
-        n_drinks = max(0, n_drinks - 1)
-        self.cursor_pos = min(self.cursor_pos, self.cursor_row, n_drinks)
-        self.cursor_row = self.cursor_pos + self.cursor_offset
-        self.cursor_offset = min(self.cursor_offset, n_drinks-end_row)
-        self.cursor_offset = max(0, self.cursor_offset)
-
-        # notify the email server
-        for order in pickup_order['orders']:
-            notif = {'id': order['id'], 'status': 'pickup'}
-            self.send_notif(order['node'], notif)
-
     def pickup_screen_init(self):
         """
         Connect to the bartender and create the curses window.
@@ -240,14 +221,9 @@ class PickupWindow:
         Add/Remove drinks from the pickup list.
         """
         if order['action'] == 'add':
-            self.drinks_pickup.append(order)
+            self.drinks_pickup.add(order)
         else:
-            idx = 0
-            while idx < len(self.drinks_pickup):
-                if self.drinks_pickup[idx]['id'] == order['id']:
-                    break
-                idx += 1
-            self.drinks_pickup.pop(idx)
+            self.drinks_pickup.pop(order['id'])
 
     def process_timer(self):
         """
@@ -266,14 +242,23 @@ class PickupWindow:
         self.bar_sock.bind((host, self.port))
         self.bar_sock.listen(1)
 
-        # Wait for the bar to connect
-        self.bar_conn, addr = self.bar_sock.accept()
-        msg = self.bar_conn.recv(self.buffer_size)
-        while msg != self.bar_acknowledge:
+        # Wait for the bar to connect. Anything that doesn't send a
+        # valid hello, such as an unframed client, is dropped.
+        while True:
+            conn, addr = self.bar_sock.accept()
+            self.bar_conn = wf.FramedSocket(conn, self.buffer_size)
+            try:
+                word, options = hs.parse_hello(self.bar_conn.recv_frame())
+            except (ValueError, socket.error):
+                word = None
+            if word == self.bar_acknowledge:
+                break
             self.bar_conn.close()
-            self.bar_conn, addr = self.bar_sock.accept()
-            msg = self.bar_conn.recv(self.buffer_size)
-        self.bar_conn.send(self.bar_acknowledge)
+
+        # Agree on the message encoding.
+        reply, self.codec = ws.server_select(options,
+                ws.PickleCodec(compress=False))
+        self.bar_conn.send_frame(hs.format_hello(self.bar_acknowledge, reply))
 
         self.display_info(timer=True)
         self.display_pickup(timer=True)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python2
+
+################################################################################
+## Handshake.py: Option negotiation for the bar acknowledge handshake.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+
+# The hello message is the bar_acknowledge word, optionally followed by
+# space-separated key=value options. A bare acknowledge word is what
+# older clients and servers send, so it means "all defaults".
+
+def format_hello(word, options=None):
+    """
+    Build a hello message from the acknowledge word and options.
+    """
+    fields = [word]
+    if options:
+        for key in sorted(options.keys()):
+            fields.append('%s=%s' % (key, options[key]))
+    return ' '.join(fields)
+
+def parse_hello(msg):
+    """
+    Split a hello message into the acknowledge word and options.
+    """
+    if msg is None:
+        return None, {}
+    if not isinstance(msg, str):
+        msg = msg.decode('utf-8')
+    fields = msg.split()
+    if not len(fields):
+        return None, {}
+    options = {}
+    for field in fields[1:]:
+        if '=' in field:
+            key, value = field.split('=', 1)
+            options[key] = value
+    return fields[0], options
@@ -0,0 +1,124 @@
+#!/usr/bin/env python2
+
+################################################################################
+## WireCrypto.py: Ciphers for the bar wire protocol.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+
+from __future__ import print_function
+import os
+import gnupg
+import hashlib
+import binascii
+
+# The AEAD cipher is optional and needs the cryptography package.
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+NONCE_SIZE = 12
+PBKDF2_ROUNDS = 100000
+
+class GPGCipher:
+    def __init__(self, passwd):
+        """
+        Symmetric GPG encryption. Every packet runs a gpg subprocess.
+        """
+        self.gpg = gnupg.GPG()
+        self.passwd = passwd
+
+    def decrypt(self, data):
+        return self.gpg.decrypt(data, passphrase=self.passwd).data
+
+    def encrypt(self, data):
+        encrypted = self.gpg.encrypt(data, None, symmetric='AES256',
+                passphrase=self.passwd, armor=False)
+        return encrypted.data
+
+class AEADCipher:
+    def __init__(self, passwd, salt):
+        """
+        In-process AES-256-GCM. The key is derived once per connection
+        from the shared password and a salt chosen by the server.
+        """
+        if AESGCM is None:
+            raise ImportError('The aead cipher requires cryptography.')
+        key = hashlib.pbkdf2_hmac('sha256', passwd.encode('utf-8'), salt,
+                PBKDF2_ROUNDS, 32)
+        self.aead = AESGCM(key)
+
+    def decrypt(self, data):
+        """
+        Decrypt and authenticate a packet. Raises ValueError if it was
+        corrupted, forged or encrypted with another key.
+        """
+        try:
+            return self.aead.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:],
+                    None)
+        except InvalidTag:
+            raise ValueError('Packet failed authentication.')
+
+    def encrypt(self, data):
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self.aead.encrypt(nonce, data, None)
+
+def available_ciphers():
+    """
+    List the cipher names that can be used on this machine.
+    """
+    if AESGCM is None:
+        return ['gpg']
+    return ['gpg', 'aead']
+
+def client_offer(ciphers):
+    """
+    Hello options offering ciphers in order of preference. Offering
+    only GPG sends no options so that older servers still accept it.
+    """
+    if list(ciphers) == ['gpg']:
+        return {}
+    return {'cipher': ','.join(ciphers)}
+
+def client_select(reply_options, passwd):
+    """
+    Create the cipher the server picked in its hello reply.
+    """
+    name = reply_options.get('cipher', 'gpg')
+    if name == 'aead':
+        salt = binascii.unhexlify(reply_options['salt'])
+        return AEADCipher(passwd, salt)
+    return GPGCipher(passwd)
+
+def server_select(hello_options, allowed, passwd):
+    """
+    Pick the first cipher offered by the client that the server allows.
+    Returns the hello reply options and the cipher.
+    """
+    offered = hello_options.get('cipher', 'gpg').split(',')
+    allowed = [c for c in allowed if c in available_ciphers()]
+    for name in offered:
+        if name not in allowed:
+            continue
+        if name == 'aead':
+            salt = os.urandom(16)
+            reply = {'cipher': name, 'salt': binascii.hexlify(salt).decode()}
+            return reply, AEADCipher(passwd, salt)
+        if name == 'gpg':
+            return {}, GPGCipher(passwd)
+    raise ValueError('No common cipher with the bar: %s' % ','.join(offered))
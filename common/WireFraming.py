@@ -0,0 +1,112 @@
+#!/usr/bin/env python2
+
+################################################################################
+## WireFraming.py: Length-prefixed message framing for TCP links.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+
+from __future__ import print_function
+import struct
+
+# Every frame is a 4-byte big-endian length followed by the payload.
+_LENGTH = struct.Struct('!I')
+
+MAX_FRAME = 1 << 24
+
+class FramedSocket:
+    def __init__(self, sock, buffer_size=4096):
+        """
+        Wrap a connected TCP socket to send and receive whole messages.
+
+        TCP is a byte stream, so one recv() may return part of a message
+        or several messages at once. Received bytes go into a reusable
+        buffer with recv_into() and are split into frames from there.
+        The buffer starts at buffer_size and grows to fit large frames.
+        """
+        self.sock = sock
+        self.buf = bytearray(max(buffer_size, _LENGTH.size))
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def _make_room(self, frame_size):
+        """
+        Move unread data to the front of the buffer, growing the buffer
+        if a frame of frame_size bytes will not fit.
+        """
+        n_unread = self.end - self.start
+        if frame_size > len(self.buf):
+            buf = bytearray(max(frame_size, 2*len(self.buf)))
+            buf[:n_unread] = self.buf[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(self.buf)
+        elif self.start:
+            self.buf[:n_unread] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = n_unread
+
+    def close(self):
+        self.sock.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def pending(self):
+        """
+        Check whether a whole frame is already buffered, in which case
+        recv_frame() returns without reading the socket.
+        """
+        n_unread = self.end - self.start
+        if n_unread < _LENGTH.size:
+            return False
+        length = _LENGTH.unpack_from(self.buf, self.start)[0]
+        return n_unread >= _LENGTH.size + length
+
+    def recv_frame(self):
+        """
+        Receive one message. Returns None when the peer has closed.
+        """
+        while True:
+            n_unread = self.end - self.start
+            frame_size = _LENGTH.size
+            if n_unread >= _LENGTH.size:
+                length = _LENGTH.unpack_from(self.buf, self.start)[0]
+                if length > MAX_FRAME:
+                    raise ValueError('Frame too large: %d bytes' % length)
+                frame_size += length
+                if n_unread >= frame_size:
+                    frame = bytes(self.buf[self.start+_LENGTH.size:
+                        self.start+frame_size])
+                    self.start += frame_size
+                    if self.start == self.end:
+                        self.start = self.end = 0
+                    return frame
+
+            if self.start + frame_size > len(self.buf):
+                self._make_room(frame_size)
+            n_recv = self.sock.recv_into(self.view[self.end:])
+            if not n_recv:
+                return None
+            self.end += n_recv
+
+    def send_frame(self, data):
+        """
+        Send one message.
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.sock.sendall(_LENGTH.pack(len(data)) + data)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python2
+
+################################################################################
+## WireSchema.py: Compact versioned encoding for order handler messages.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import zlib
+import struct
+import numbers
+import pickle as pkl
+
+# A message is a fixed header of (version, flags) bytes followed by a
+# body in the MessagePack format, restricted to nil, booleans, integers,
+# floats, strings, binary, arrays and maps. Bodies of COMPRESS_MIN
+# bytes or more are zlib-compressed, which the flags record.
+_HEADER = struct.Struct('!BB')
+
+WIRE_VERSION = 1
+FLAG_ZLIB = 0x01
+COMPRESS_MIN = 512
+MAX_BODY = 1 << 24
+MAX_DEPTH = 32
+
+_PY2 = bytes is str
+_text = type(u'')
+
+class CompactCodec:
+    def __init__(self, compress_min=COMPRESS_MIN):
+        """
+        Encode messages with the compact schema. Decoding never runs
+        code from the message, unlike unpickling.
+        """
+        self.version = WIRE_VERSION
+        self.compress_min = compress_min
+
+    def decode(self, data):
+        if len(data) < _HEADER.size:
+            raise ValueError('Truncated message header.')
+        version, flags = _HEADER.unpack_from(data, 0)
+        if version != WIRE_VERSION:
+            raise ValueError('Unsupported wire version: %d' % version)
+        body = data[_HEADER.size:]
+        if flags & FLAG_ZLIB:
+            inflater = zlib.decompressobj()
+            body = inflater.decompress(body, MAX_BODY)
+            if inflater.unconsumed_tail:
+                raise ValueError('Message body is too large.')
+        return unpack(body)
+
+    def encode(self, obj):
+        body = pack(obj)
+        flags = 0
+        if len(body) >= self.compress_min:
+            body = zlib.compress(body)
+            flags |= FLAG_ZLIB
+        return _HEADER.pack(self.version, flags) + body
+
+class PickleCodec:
+    def __init__(self, compress=True):
+        """
+        The pickle encoding used before the compact schema, for peers
+        that don't offer it. The bar connection compressed its pickles
+        and the pickup screen connection didn't.
+        """
+        self.version = 0
+        self.compress = compress
+
+    def decode(self, data):
+        # Raise ValueError for bad input like the compact schema does.
+        # Unpickling garbage can raise almost any exception.
+        try:
+            if self.compress:
+                data = zlib.decompress(data)
+            return pkl.loads(data)
+        except Exception as err:
+            raise ValueError('Invalid pickled message: %s: %s' % (
+                err.__class__.__name__, err))
+
+    def encode(self, obj):
+        data = pkl.dumps(obj, pkl.HIGHEST_PROTOCOL)
+        if self.compress:
+            data = zlib.compress(data)
+        return data
+
+def client_offer():
+    """
+    Hello options offering the compact schema.
+    """
+    return {'wire': str(WIRE_VERSION)}
+
+def client_select(reply_options, legacy):
+    """
+    Create the codec the peer picked in its hello reply, falling back
+    to the legacy codec if it didn't pick one.
+    """
+    if reply_options.get('wire') == str(WIRE_VERSION):
+        return CompactCodec()
+    return legacy
+
+def server_select(hello_options, legacy):
+    """
+    Pick the codec for a peer from its hello options. Returns the hello
+    reply options and the codec.
+    """
+    try:
+        version = int(hello_options.get('wire', 0))
+    except ValueError:
+        version = 0
+    if version >= WIRE_VERSION:
+        return {'wire': str(WIRE_VERSION)}, CompactCodec()
+    return {}, legacy
+
+#-------------------------------------------------------------------------------
+# MessagePack subset
+def pack(obj):
+    """
+    Encode an object as a MessagePack body.
+    """
+    out = []
+    _pack(obj, out, 0)
+    return b''.join(out)
+
+def _pack(obj, out, depth):
+    if depth > MAX_DEPTH:
+        raise ValueError('Message is nested too deeply.')
+    if obj is None:
+        out.append(b'\xc0')
+    elif obj is True:
+        out.append(b'\xc3')
+    elif obj is False:
+        out.append(b'\xc2')
+    elif isinstance(obj, numbers.Integral):
+        _pack_int(int(obj), out)
+    elif isinstance(obj, float):
+        out.append(struct.pack('!Bd', 0xcb, obj))
+    elif isinstance(obj, _text):
+        _pack_raw(obj.encode('utf-8'), out, 0xa0, 0xd9)
+    elif isinstance(obj, bytes):
+        # Python 2 strings are bytes, and are sent as MessagePack
+        # strings so that they decode to the same type.
+        if _PY2:
+            _pack_raw(obj, out, 0xa0, 0xd9)
+        else:
+            _pack_raw(obj, out, None, 0xc4)
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(len(obj), out, 0x90, 0xdc, 16)
+        for item in obj:
+            _pack(item, out, depth + 1)
+    elif isinstance(obj, dict):
+        _pack_length(len(obj), out, 0x80, 0xde, 16)
+        for key, value in obj.items():
+            _pack(key, out, depth + 1)
+            _pack(value, out, depth + 1)
+    else:
+        raise TypeError('Cannot encode %s.' % type(obj).__name__)
+
+def _pack_int(n, out):
+    if 0 <= n < 0x80:
+        out.append(struct.pack('!B', n))
+    elif -32 <= n < 0:
+        out.append(struct.pack('!b', n))
+    elif -(1 << 63) <= n < (1 << 63):
+        out.append(struct.pack('!Bq', 0xd3, n))
+    elif 0 <= n < (1 << 64):
+        out.append(struct.pack('!BQ', 0xcf, n))
+    else:
+        raise ValueError('Integer out of range: %d' % n)
+
+def _pack_length(n, out, fix, code16, fix_max):
+    """
+    Write an array or map length: a fix type below fix_max, otherwise
+    code16 with a 16-bit length or code16+1 with a 32-bit length.
+    """
+    if n < fix_max:
+        out.append(struct.pack('!B', fix | n))
+    elif n < (1 << 16):
+        out.append(struct.pack('!BH', code16, n))
+    else:
+        out.append(struct.pack('!BI', code16 + 1, n))
+
+def _pack_raw(data, out, fix, code8):
+    """
+    Write a string (fix type below 32 bytes, then code8 = str8) or
+    binary (no fix type, code8 = bin8) with its length.
+    """
+    n = len(data)
+    if fix is not None and n < 32:
+        out.append(struct.pack('!B', fix | n))
+    elif n < (1 << 8):
+        out.append(struct.pack('!BB', code8, n))
+    elif n < (1 << 16):
+        out.append(struct.pack('!BH', code8 + 1, n))
+    else:
+        out.append(struct.pack('!BI', code8 + 2, n))
+    out.append(data)
+
+def unpack(data):
+    """
+    Decode a MessagePack body.
+    """
+    data = bytearray(data)
+    obj, pos = _unpack(data, 0, 0)
+    if pos != len(data):
+        raise ValueError('Trailing data after message body.')
+    return obj
+
+def _read(data, pos, n):
+    if pos + n > len(data):
+        raise ValueError('Truncated message body.')
+    return bytes(data[pos:pos+n]), pos + n
+
+def _read_struct(fmt, data, pos):
+    size = struct.calcsize(fmt)
+    if pos + size > len(data):
+        raise ValueError('Truncated message body.')
+    return struct.unpack_from(fmt, data, pos)[0], pos + size
+
+def _unpack(data, pos, depth):
+    if depth > MAX_DEPTH:
+        raise ValueError('Message is nested too deeply.')
+    if pos >= len(data):
+        raise ValueError('Truncated message body.')
+    code = data[pos]
+    pos += 1
+
+    # Fixed-size types
+    if code < 0x80:
+        return code, pos
+    if code >= 0xe0:
+        return code - 0x100, pos
+    if code == 0xc0:
+        return None, pos
+    if code == 0xc2:
+        return False, pos
+    if code == 0xc3:
+        return True, pos
+    if code in _NUMBERS:
+        return _read_struct(_NUMBERS[code], data, pos)
+
+    # Strings and binary
+    if 0xa0 <= code <= 0xbf:
+        return _unpack_str(data, pos, code & 0x1f)
+    if code in _STR_LENGTHS:
+        n, pos = _read_struct(_STR_LENGTHS[code], data, pos)
+        return _unpack_str(data, pos, n)
+    if code in _BIN_LENGTHS:
+        n, pos = _read_struct(_BIN_LENGTHS[code], data, pos)
+        return _read(data, pos, n)
+
+    # Containers
+    if 0x90 <= code <= 0x9f or code in (0xdc, 0xdd):
+        if code <= 0x9f:
+            n = code & 0x0f
+        else:
+            n, pos = _read_struct(_CONTAINER_LENGTHS[code], data, pos)
+        obj = []
+        for i in range(n):
+            item, pos = _unpack(data, pos, depth + 1)
+            obj.append(item)
+        return obj, pos
+    if 0x80 <= code <= 0x8f or code in (0xde, 0xdf):
+        if code <= 0x8f:
+            n = code & 0x0f
+        else:
+            n, pos = _read_struct(_CONTAINER_LENGTHS[code], data, pos)
+        obj = {}
+        for i in range(n):
+            key, pos = _unpack(data, pos, depth + 1)
+            value, pos = _unpack(data, pos, depth + 1)
+            if isinstance(key, (list, dict)):
+                raise ValueError('Unhashable map key.')
+            obj[key] = value
+        return obj, pos
+    raise ValueError('Unsupported type code: 0x%02x' % code)
+
+def _unpack_str(data, pos, n):
+    raw, pos = _read(data, pos, n)
+    if _PY2:
+        return raw, pos
+    return raw.decode('utf-8', 'replace'), pos
+
+_NUMBERS = {
+    0xca: '!f', 0xcb: '!d',
+    0xcc: '!B', 0xcd: '!H', 0xce: '!I', 0xcf: '!Q',
+    0xd0: '!b', 0xd1: '!h', 0xd2: '!i', 0xd3: '!q',
+    }
+_STR_LENGTHS = {0xd9: '!B', 0xda: '!H', 0xdb: '!I'}
+_BIN_LENGTHS = {0xc4: '!B', 0xc5: '!H', 0xc6: '!I'}
+_CONTAINER_LENGTHS = {0xdc: '!H', 0xdd: '!I', 0xde: '!H', 0xdf: '!I'}
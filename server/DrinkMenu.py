@@ -0,0 +1,170 @@
+#!/usr/bin/env python2
+
+################################################################################
+## DrinkMenu.py: Structured drink menu and order matching.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import os
+import sys
+import json
+import threading
+
+class DrinkMenu:
+    def __init__(self, path):
+        """
+        Drinks that can be ordered, read from a json file of the form
+
+            {"drinks": [{"id": "gin_tonic", "name": "Gin and tonic",
+                         "aliases": ["g&t"], "available": true}, ...]}
+
+        where aliases and available are optional. Orders are matched
+        against the drink names and aliases, ignoring case and
+        punctuation. The file is read again when it changes, so drinks
+        can be marked unavailable during the party. A file that can't
+        be read or parsed, such as one that is half written, is logged
+        and the last good menu kept until the file changes again.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.drinks = {}
+        self.matcher = Matcher({})
+
+    def _load(self):
+        """
+        Read the menu file if it changed since the last read.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError as err:
+            print('Could not read the drink menu:', err, file=sys.stderr)
+            return
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+        if stamp == self.stamp:
+            return
+        self.stamp = stamp
+
+        drinks = {}
+        patterns = {}
+        try:
+            with open(self.path) as f:
+                config = json.loads(f.read())
+            for drink in config['drinks']:
+                drink.setdefault('aliases', [])
+                drink.setdefault('available', True)
+                drinks[drink['id']] = drink
+                for name in [drink['name']] + drink['aliases']:
+                    pattern = normalize(name)
+                    if len(pattern.strip()):
+                        patterns[pattern] = drink['id']
+        except (IOError, OSError, ValueError, KeyError, TypeError,
+                AttributeError) as err:
+            print('Could not load the drink menu, keeping the last one:',
+                    err, file=sys.stderr)
+            return
+        self.drinks = drinks
+        self.matcher = Matcher(patterns)
+
+    def match(self, text):
+        """
+        Find the menu drinks named in an order. Returns the list of
+        drink IDs in order of appearance, and the list of those that
+        are unavailable.
+        """
+        with self.lock:
+            self._load()
+            drinks = self.drinks
+            matcher = self.matcher
+
+        # Keep the leftmost, then longest, matches that don't overlap.
+        # Patterns are padded with spaces, so neighbouring drinks share
+        # the space between them.
+        found = []
+        end = 0
+        for start, stop, drink_id in sorted(matcher.find(normalize(text)),
+                key=lambda m: (m[0], m[0] - m[1])):
+            if start + 1 >= end:
+                found.append(drink_id)
+                end = stop
+        unavailable = [d for d in found if not drinks[d]['available']]
+        return found, unavailable
+
+    def name(self, drink_id):
+        return self.drinks[drink_id]['name']
+
+class Matcher:
+    def __init__(self, patterns):
+        """
+        Aho-Corasick automaton over a dictionary of pattern strings to
+        values. Finding every pattern in a text takes one pass over it,
+        however many patterns there are.
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for pattern, value in patterns.items():
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[node][ch] = nxt
+                node = nxt
+            self.out[node].append((len(pattern), value))
+
+        # Breadth-first, so a node's failure link is set before its
+        # children's.
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fail = self.fail[node]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[nxt] = self.goto[fail].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find(self, text):
+        """
+        Return (start, stop, value) for every pattern found in text.
+        """
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        found = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, value in out[node]:
+                found.append((i + 1 - length, i + 1, value))
+        return found
+
+def normalize(text):
+    """
+    Lower-case text, turn everything but letters and digits into single
+    spaces and pad it with a space on each side.
+    """
+    if not isinstance(text, type(u'')):
+        text = text.decode('utf-8', 'replace')
+    chars = [ch if ch.isalnum() else ' ' for ch in text.lower()]
+    return ' ' + ' '.join(''.join(chars).split()) + ' '
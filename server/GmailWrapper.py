@@ -27,23 +27,52 @@ import json
 import time
 import email
 import base64
-import smtplib
+import socket
+import threading
 import pickle as pkl
+from collections import deque
+import MailBackend as mb
+import HistoryPoller as hp
+import SMTPPool as sp
 import multiprocessing as mp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from httplib2 import Http
 from oauth2client import file, client, tools
 from google.cloud import pubsub_v1
 from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 
-class GmailClient:
-    def __init__(self, conf_file):
-        # Configuration items
+# Gmail recommends at most 50 requests per batch, and batchModify takes
+# up to 1000 message IDs.
+BATCH_SIZE = 50
+MODIFY_SIZE = 1000
+
+# Message resource fields needed to find the text body when reading
+# messages in the full format. Attachments only come back as IDs.
+FULL_FIELDS = 'id,internalDate,payload(mimeType,filename,headers,body,parts)'
+
+# Renew the inbox watch this many seconds before it expires, and
+# remember this many message IDs to drop duplicate notifications.
+WATCH_MARGIN = 3600
+SEEN_SIZE = 4096
+
+# Batch sub-requests that fail with these statuses, such as a per-part
+# 429 rateLimitExceeded, are retried FETCH_RETRIES times with backoff,
+# then again on the next poll, at most FETCH_DELAY seconds later.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+FETCH_RETRIES = 2
+FETCH_DELAY = 10.
+
+class GmailClient(mb.MailBackend):
+    def __init__(self, conf_file, overrides=None):
+        # Configuration items, optionally overridden per handler node.
         conf_file = os.path.abspath(conf_file)
         with open(conf_file) as f:
             config = json.loads(f.read())
+        if overrides is not None:
+            config.update(overrides)
         conf_dir = os.path.dirname(conf_file)
+        mb.MailBackend.__init__(self, config)
 
         self.token = os.path.join(conf_dir, config['token'])
         self.credentials = os.path.join(conf_dir, config['credentials'])
@@ -51,11 +80,26 @@ class GmailClient:
         self.project_id = config['project_id']
         self.topic_name = config['topic_name']
         self.subscription_name = config['subscription_name']
-        self.email_name = config['email_name']
-        self.send_name = config['send_name']
         self.password = config['password']
+        self.smtp_host = config.get('smtp_host', 'smtp.gmail.com:587')
+        self.smtp_workers = config.get('smtp_workers', 2)
+        self.smtp_queue_size = config.get('smtp_queue_size', 256)
+        self.fetch_format = config.get('fetch_format', 'full')
+        self.max_body_size = config.get('max_body_size', 65536)
+        if self.fetch_format not in ['full', 'raw']:
+            raise ValueError('Invalid fetch format: %s' % self.fetch_format)
+        self.watch_interval = config.get('watch_interval', 86400)
+        self.resync_max = config.get('resync_max', 100)
+        self.notif_debounce = config.get('notif_debounce', 0.05)
+        self.pubsub_max_messages = config.get('pubsub_max_messages', 100)
+        self.pubsub_max_bytes = config.get('pubsub_max_bytes', 1<<20)
+        self.ingest = config.get('ingest', 'push')
+        self.poll_min = config.get('poll_min', 1.)
+        self.poll_max = config.get('poll_max', 30.)
+        self.poll_backoff = config.get('poll_backoff', 2.)
+        if self.ingest not in ['push', 'poll']:
+            raise ValueError('Invalid ingest mode: %s' % self.ingest)
 
-        self.send_name_email = self.send_name + ' <%s>' % self.email_name
         self.topic_name_full = 'projects/%s/topics/%s' % (self.project_id, self.topic_name)
 
         self.SCOPES = [
@@ -69,23 +113,89 @@ class GmailClient:
         # Object items.
         self.service = None
         self.notif_proc = None
+        self.notif_future = None
         self.notif_send = None
-        self.notif_recv = None
         self.user_hist = None
         self.user_msg = None
         self.hist_id = None
+        self.expiration = None
+        self.watch_time = None
+        self.seen_ids = set()
+        self.seen_order = deque()
+        self.unfetched = []
+        self.fetch_time = None
+        self.smtp = sp.SMTPPool(self.smtp_host, self.email_name,
+                self.password, self.smtp_workers, self.smtp_queue_size)
+        self.metrics.add_collector(self.smtp_metrics)
 
     def changes_new_messages(self, hist_changes):
         # Check if history changes have new messages and return
-        # metadata for any new messages detected.
-        messages = []
+        # metadata for any new messages detected. Messages from the
+        # server itself are filtered out in read_messages, and messages
+        # already read, e.g. after a resync, are dropped here. Messages
+        # that could not be fetched last time are tried again first.
+        messages = self.unfetched
+        self.unfetched = []
+        self.fetch_time = None
+        msg_ids = set([msg['id'] for msg in messages])
         for ch in [ch for ch in hist_changes if 'messagesAdded' in ch.keys()]:
             for msg in ch['messagesAdded']:
-                if self.not_from_self(msg['message']):
-                    messages.append(msg['message'])
+                msg_id = msg['message']['id']
+                if msg_id in self.seen_ids or msg_id in msg_ids:
+                    continue
+                msg_ids.add(msg_id)
+                messages.append(msg['message'])
         return messages
 
-    def gmail_setup(self, only_authorize=False):
+    def fetch_messages(self, message_attrs):
+        """
+        Fetch messages with one batch request per BATCH_SIZE messages.
+        Returns a dictionary of the responses and one of the errors,
+        both keyed by message ID.
+        """
+        fetched = {}
+        failed = {}
+        def callback(request_id, response, exception):
+            if exception is not None:
+                failed[request_id] = exception
+            else:
+                fetched[request_id] = response
+
+        for i in range(0, len(message_attrs), BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for message_attr in message_attrs[i:i+BATCH_SIZE]:
+                msg_id = message_attr['id']
+                if self.fetch_format == 'full':
+                    request = self.user_msg.get(id=msg_id, userId='me',
+                            format='full', fields=FULL_FIELDS)
+                else:
+                    request = self.user_msg.get(id=msg_id, userId='me',
+                            format='raw')
+                batch.add(request, request_id=msg_id)
+            with self.metrics.timer('read_messages'):
+                batch.execute()
+            self.metrics.count('gmail_requests',
+                    len(message_attrs[i:i+BATCH_SIZE]), method='messages.get')
+        return fetched, failed
+
+    def mark_seen(self, msg_id):
+        """
+        Remember a message as read, so that it is not read again.
+        """
+        self.seen_ids.add(msg_id)
+        self.seen_order.append(msg_id)
+        if len(self.seen_order) > SEEN_SIZE:
+            self.seen_ids.discard(self.seen_order.popleft())
+
+    def flow_control(self):
+        """
+        Pub/Sub subscriber flow control settings.
+        """
+        return pubsub_v1.types.FlowControl(
+                max_messages=self.pubsub_max_messages,
+                max_bytes=self.pubsub_max_bytes)
+
+    def build_service(self):
         # The file token.json stores the user's access and refresh tokens, and is
         # created automatically when the authorization flow completes for the first
         # time.
@@ -95,159 +205,466 @@ class GmailClient:
         if not creds or creds.invalid:
             flow = client.flow_from_clientsecrets(self.credentials, SCOPES)
             creds = tools.run_flow(flow, store)
+        return build('gmail', 'v1', http=creds.authorize(Http()))
 
-        self.service = build('gmail', 'v1', http=creds.authorize(Http()))
+    def gmail_setup(self, only_authorize=False, notif_process=True):
+        self.service = self.build_service()
         if only_authorize:
             return
         self.user_labels = self.service.users().labels()
         self.user_hist = self.service.users().history()
         self.user_msg = self.service.users().messages()
-        self.watch()
+        if self.ingest == 'poll':
+            profile = self.service.users().getProfile(userId='me').execute()
+            self.hist_id = profile['historyId']
+        else:
+            self.watch()
 
-        # Set up the message callback thread
+        # Set up the message callback thread. The subscriber runs its
+        # callbacks in its own threads, and the poller runs in a thread
+        # of its own, so either can also live in this process when the
+        # caller waits on notif_recv itself.
         os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = self.application
         self.notif_recv, self.notif_send = mp.Pipe(False)
-        self.notif_proc = mp.Process(target=self._notification_thread)
-        self.notif_proc.daemon = True
-        self.notif_proc.start()
-
-    def not_from_self(self, message_attr):
-        # check to make sure someone else sent the message received.
-        msg_id = message_attr['id']
-        message = self.user_msg.get(id=msg_id, userId='me', format='metadata')
-        message = message.execute()
-        headers = message['payload']['headers']
-        msg_from = [h for h in headers if h['name'] == 'From']
-        # Assume that if the message has no "from" metadata that
-        # someone else sent it
-        if len(msg_from):
-            msg_from = msg_from[0]['value']
+        if notif_process:
+            self.notif_proc = mp.Process(target=self._notification_thread)
+            self.notif_proc.daemon = True
+            self.notif_proc.start()
+        elif self.ingest == 'poll':
+            self.notif_future = self._poller().start()
         else:
-            msg_from = ''
-
-        email_name = self.email_name
-        email_bracket = '<%s>' % self.email_name
-        from_self = msg_from == email_name or email_bracket in msg_from
-        return not from_self
+            self.notif_future = self._subscribe()
 
     def _notification_thread(self):
+        # The subscriber is non-blocking. Keep the thread alive always
+        if self.ingest == 'poll':
+            self._poller().run()
+            return
+        self._subscribe()
+        while True:
+            time.sleep(60)
+
+    def _poller(self, service=None):
+        # Poll the history with a Gmail service of its own, since an
+        # HTTP connection can't be shared between threads or processes.
+        # Only messages added to the inbox count as changes, not the
+        # server's own replies and read marks.
+        if service is None:
+            service = self.build_service()
+        send_lock = threading.Lock()
+        def list_changes(start_id):
+            self.metrics.count('gmail_requests', method='history.list')
+            try:
+                history = service.users().history().list(userId='me',
+                        startHistoryId=start_id,
+                        historyTypes=['messageAdded'], labelId='INBOX',
+                        maxResults=1, fields='history/id,historyId'
+                        ).execute()
+            except HttpError as err:
+                if err.resp.status != 404:
+                    raise
+                # Too old to list from, which update_hist recovers from.
+                self.metrics.count('gmail_requests', method='getProfile')
+                profile = service.users().getProfile(userId='me').execute()
+                return profile['historyId'], True
+            return history['historyId'], len(history.get('history', [])) > 0
+        def send_notif(msg_data):
+            with send_lock:
+                self.notif_send.send(msg_data)
+        return hp.HistoryPoller(list_changes, send_notif, self.hist_id,
+                self.poll_min, self.poll_max, self.poll_backoff)
+
+    def _subscribe(self, subscriber=None):
+        # Subscribe to inbox notifications, forwarding them to notif_recv.
+        # Flow control bounds the notifications held by the callbacks,
+        # so a full pipe pushes back on Pub/Sub instead of piling up.
         project_id = self.project_id
         sub_name = self.subscription_name
 
-        subscriber = pubsub_v1.SubscriberClient()
+        if subscriber is None:
+            subscriber = pubsub_v1.SubscriberClient()
 
         # The `subscription_path` method creates a fully qualified identifier
         # in the form `projects/{project_id}/subscriptions/{subscription_name}`
         subscription_path = subscriber.subscription_path(project_id, sub_name)
 
+        # Callbacks run in a thread pool, and a pipe end is not safe to
+        # send on from several threads at once.
+        send_lock = threading.Lock()
         def callback(message):
-            msg_data = ast.literal_eval(message.data)
-            self.notif_send.send(msg_data)
+            try:
+                msg_data = json.loads(message.data)
+            except ValueError:
+                msg_data = ast.literal_eval(message.data)
+            msg_data['receivedTime'] = time.time()
+            with send_lock:
+                self.notif_send.send(msg_data)
             message.ack()
 
-        # The subscriber is non-blocking. Keep the thread alive always
-        subscriber.subscribe(subscription_path, callback=callback)
-        while True:
-            time.sleep(60)
+        return subscriber.subscribe(subscription_path, callback=callback,
+                flow_control=self.flow_control())
 
-    def read_message(self, message_attr):
+    def parse_full_message(self, response):
         """
-        service: the gmail service created in gmail_setup()
-        msg_id: the message id to read
+        Get the sender, subject and text body of a message fetched in
+        the full format. A text body too large to be sent inline is
+        fetched on its own, unless it is over max_body_size.
         """
-        # TODO handle attachments
-        # Read data from a message.
-        msg_id = message_attr['id']
-        message = self.user_msg.get(id=msg_id, userId='me', format='raw')
-        message = message.execute()
-        msg_str = base64.urlsafe_b64decode(message['raw'].encode('ASCII'))
-        mime_msg = email.message_from_string(msg_str)
-
-        # Parse the message that we care about.
+        payload = response['payload']
+        headers = dict([(header['name'].lower(), header['value'])
+            for header in payload.get('headers', [])])
+
         msg_compact = {}
-        msg_compact['from'] = mime_msg['From']
-        msg_compact['subject'] = mime_msg['Subject']
-        msg_compact['body'] = get_body(mime_msg)
+        msg_compact['from'] = _native(headers.get('from'))
+        msg_compact['subject'] = _native(headers.get('subject'))
+        msg_compact['body'] = ''
+
+        part = find_text_part(payload)
+        if part is None:
+            return msg_compact
+        body = part.get('body', {})
+        data = body.get('data')
+        if data is None and 'attachmentId' in body and \
+                body.get('size', 0) <= self.max_body_size:
+            user_att = self.user_msg.attachments()
+            data = user_att.get(userId='me', messageId=response['id'],
+                    id=body['attachmentId']).execute().get('data')
+        if data is not None:
+            msg_compact['body'] = decode_part_data(data, self.max_body_size)
+        return msg_compact
+
+    def read_messages(self, message_attrs):
+        """
+        Read new messages and mark them as read, using one batch request
+        per BATCH_SIZE messages to fetch them and a single batchModify.
+        Messages sent by the server itself are skipped.
+
+        In the full fetch format only the MIME structure and the text
+        parts are downloaded, and attachments are never fetched. The
+        raw format downloads and parses whole messages. Either way the
+        body is cut at max_body_size bytes.
+
+        Fetches that fail for a reason that may pass, such as the rate
+        limit, are retried with backoff, and are left for the next poll
+        if they still fail (see timeout). Messages are only
+        remembered as seen once they have been fetched.
+
+        Returns a list of (message_attr, message) pairs.
+        """
+        fetched = {}
+        pending = message_attrs
+        for attempt in range(FETCH_RETRIES + 1):
+            if attempt:
+                self.metrics.count('fetch_retries', len(pending))
+                time.sleep(2 ** (attempt - 1))
+            new_fetched, failed = self.fetch_messages(pending)
+            fetched.update(new_fetched)
+            retry = []
+            for message_attr in pending:
+                err = failed.get(message_attr['id'])
+                if err is None:
+                    continue
+                if _retryable(err):
+                    retry.append(message_attr)
+                else:
+                    print('Could not read message %s:' % message_attr['id'],
+                            err, file=sys.stderr)
+            pending = retry
+            if not len(pending):
+                break
+        if len(pending):
+            print('Could not read %d messages, trying again later.' %
+                    len(pending), file=sys.stderr)
+            self.unfetched.extend(pending)
+            self.fetch_time = time.time() + FETCH_DELAY
+        for msg_id in fetched:
+            self.mark_seen(msg_id)
+        self.metrics.count('messages_read', len(fetched))
+
+        # Parse the messages that we care about.
+        messages = []
+        unread = []
+        for message_attr in message_attrs:
+            msg_id = message_attr['id']
+            if msg_id not in fetched:
+                continue
+            if self.fetch_format == 'full':
+                msg_compact = self.parse_full_message(fetched[msg_id])
+            else:
+                msg_compact = parse_raw_message(fetched[msg_id]['raw'],
+                        self.max_body_size)
+            if 'internalDate' in fetched[msg_id]:
+                internal_date = int(fetched[msg_id]['internalDate'])
+                msg_compact['internalDate'] = internal_date / 1000.
+            with self.metrics.timer('not_from_self'):
+                from_other = self.not_from_self(msg_compact['from'])
+            if not from_other:
+                continue
+            messages.append((message_attr, msg_compact))
+            if 'UNREAD' in message_attr.get('labelIds', []):
+                unread.append(msg_id)
 
         # Mark as read, then return
-        if 'UNREAD' in message_attr['labelIds']:
-            mark_read = {'removeLabelIds': ['UNREAD']}
-            msg = self.user_msg.modify(userId='me', id=msg_id, body=mark_read)
-            msg.execute()
-        return msg_compact
+        for i in range(0, len(unread), MODIFY_SIZE):
+            mark_read = {'ids': unread[i:i+MODIFY_SIZE],
+                    'removeLabelIds': ['UNREAD']}
+            self.user_msg.batchModify(userId='me', body=mark_read).execute()
+            self.metrics.count('gmail_requests', method='batchModify')
+        return messages
+
+    def poll_new_messages(self):
+        # Sync the history for the notifications waiting, or renew the
+        # watch if that is due.
+        if self.notif_recv.poll(0):
+            hist_changes = self.update_hist(self.recv_notifs(0, 0))
+        else:
+            hist_changes = self.renew_watch()
+        return self.changes_new_messages(hist_changes)
+
+    def recv_notifs(self, timeout=None, debounce=None):
+        """
+        Wait up to timeout seconds for an inbox notification, then keep
+        collecting notifications for debounce seconds (notif_debounce by
+        default). A burst of notifications needs only one history sync,
+        from the last synced history ID to the highest one received, so
+        only that notification is returned. Returns None on timeout.
+        """
+        if not self.notif_recv.poll(timeout):
+            return None
+        if debounce is None:
+            debounce = self.notif_debounce
+        latest = self.notif_recv.recv()
+        n_notifs = 1
+        t_end = time.time() + debounce
+        while self.notif_recv.poll(max(0., t_end - time.time())):
+            msg_data = self.notif_recv.recv()
+            n_notifs += 1
+            if int(msg_data['historyId']) > int(latest['historyId']):
+                latest = msg_data
+        self.metrics.count('notifications', n_notifs)
+        self.metrics.count('notifications_coalesced', n_notifs - 1)
+        return latest
+
+    def renew_watch(self):
+        """
+        Renew the inbox watch if it is due, then return the history
+        changes since the last sync, which may include messages whose
+        notifications were missed.
+        """
+        due = self.watch_due()
+        if due is None or due > 0:
+            return []
+        print('Renewing inbox watch.')
+        self.watch()
+        self.metrics.count('watch_renewals')
+        return self.update_hist()
+
+    def resync_messages(self):
+        """
+        Recover from a history gap by listing up to resync_max unread
+        inbox messages, oldest first, as history changes. The history
+        ID is taken before listing, so nothing falls between the two.
+        """
+        profile = self.service.users().getProfile(userId='me').execute()
+        labels = ['INBOX', 'UNREAD']
+        response = self.user_msg.list(userId='me', labelIds=labels,
+                maxResults=self.resync_max).execute()
+        self.metrics.count('gmail_requests', method='getProfile')
+        self.metrics.count('gmail_requests', method='messages.list')
+        self.hist_id = profile['historyId']
+
+        messages = response.get('messages', [])
+        print('History gap, resyncing %d unread messages.' % len(messages),
+                file=sys.stderr)
+        added = []
+        for msg in reversed(messages):
+            msg['labelIds'] = labels
+            added.append({'message': msg})
+        return [{'messagesAdded': added}]
 
     def send_message(self, message, threadId=None):
         """
         Use SMTP to send email. Don't use the Gmail API since that
-        can cause conflicts with the threading.
+        can cause conflicts with the threading. The message is queued
+        and sent in the background.
         """
-        mime_msg = MIMEText(message['body'])
-        mime_msg['To'] = message['to']
-        mime_msg['From'] = self.send_name_email
-        mime_msg['Subject'] = message['subject']
-        msg_string = mime_msg.as_string()
-
+        msg_string = self.render_message(message)
         toaddrs = message['to'].split('<')[-1].split('>')[0]
-        username = self.email_name
-        password = self.password
-        server = smtplib.SMTP('smtp.gmail.com:587')
-        server.ehlo()
-        server.starttls()
-        server.login(username, password)
-        server.sendmail(username, toaddrs, msg_string)
-
-    def update_hist(self, msg_data):
-        # poll history changes since the last recorded history ID
-        # TODO call the watch function after a certain interval.
+        with self.metrics.timer('send_message'):
+            self.smtp.send(self.email_name, toaddrs, msg_string)
+        self.metrics.count('emails_queued')
+
+    def setup(self, notif_process=True):
+        self.gmail_setup(notif_process=notif_process)
+
+    def smtp_metrics(self):
+        """
+        SMTP pool statistics for the metrics endpoint.
+        """
+        return dict([('smtp_' + key, value)
+            for key, value in self.smtp.metrics().items()])
+
+    def stop(self):
+        if self.notif_proc is not None:
+            self.notif_proc.terminate()
+        if self.notif_future is not None:
+            self.notif_future.cancel()
+        self.smtp.stop(timeout=10)
+
+    def timeout(self):
+        due = self.watch_due()
+        if self.fetch_time is not None:
+            retry = max(0., self.fetch_time - time.time())
+            due = retry if due is None else min(due, retry)
+        return due
+
+    def update_hist(self, msg_data=None):
+        # poll history changes since the last recorded history ID. A
+        # history ID that is too old to list from means a gap, which is
+        # recovered from by a resync.
+        if msg_data is not None:
+            if 'receivedTime' in msg_data:
+                self.metrics.observe('notification_wait',
+                        time.time() - msg_data['receivedTime'])
         hist_id = self.hist_id
-        history = self.user_hist.list(userId='me', startHistoryId=hist_id)
-        history = history.execute()
-        changes = history['history'] if 'history' in history else []
-        while 'nextPageToken' in history:
-            page_token = history['nextPageToken']
-            history = self.user_hist.list(userId='me', startHistoryId=hist_id,
-                    pageToken=page_token).execute()
-            changes.extend(history['history'])
-
-        hist_id = msg_data['historyId']
+        try:
+            with self.metrics.timer('update_hist'):
+                history = self.user_hist.list(userId='me',
+                        startHistoryId=hist_id).execute()
+                self.metrics.count('gmail_requests', method='history.list')
+                changes = history['history'] if 'history' in history else []
+                while 'nextPageToken' in history:
+                    page_token = history['nextPageToken']
+                    history = self.user_hist.list(userId='me',
+                            startHistoryId=hist_id,
+                            pageToken=page_token).execute()
+                    self.metrics.count('gmail_requests', method='history.list')
+                    changes.extend(history.get('history', []))
+        except HttpError as err:
+            if err.resp.status != 404:
+                raise
+            self.metrics.count('history_resyncs')
+            return self.resync_messages()
+
+        if msg_data is not None:
+            hist_id = msg_data['historyId']
+        else:
+            hist_id = history.get('historyId', hist_id)
         self.hist_id = hist_id
         return changes
 
     def wait_new_messages(self):
-        # we only care if the changes correspond to new messages.
+        # we only care if the changes correspond to new messages. The
+        # watch is renewed while waiting.
         messages = []
         while not len(messages):
-            hist_changes = self.update_hist(self.notif_recv.recv())
+            msg_data = self.recv_notifs(self.watch_due())
+            if msg_data is not None:
+                hist_changes = self.update_hist(msg_data)
+            else:
+                hist_changes = self.renew_watch()
             messages = self.changes_new_messages(hist_changes)
         return messages
 
     def watch(self):
+        # Inbox notifications stop when the watch expires, after about
+        # a week. Renewing it keeps the history ID already synced to.
         request = {
             'labelIds': ['INBOX'],
             'topicName': self.topic_name_full
             }
         watcher = self.service.users().watch(userId='me', body=request)
         watcher = watcher.execute()
-        self.hist_id = watcher['historyId']
-        self.expiration = watcher['expiration']
-
-def get_body(mime_msg):
-    # https://stackoverflow.com/questions/17874360/python-how-to-parse-the-body-from-a-raw-email-given-that-raw-email-does-not
-    body = ''
-    if mime_msg.is_multipart():
-        for part in mime_msg.walk():
-            ctype = part.get_content_type()
-            cdispo = str(part.get('Content-Disposition'))
-
-            # skip any text/plain (txt) attachments
-            if ctype == 'text/plain' and 'attachment' not in cdispo:
-                body = part.get_payload(decode=True)  # decode
-                break
-    # not multipart - i.e. plain text, no attachments, keeping fingers crossed
-    else:
-        body = mime_msg.get_payload(decode=True)
-    body = body.replace('\r\n', '\n')
-    return body
+        self.metrics.count('gmail_requests', method='watch')
+        if self.hist_id is None:
+            self.hist_id = watcher['historyId']
+        self.expiration = int(watcher['expiration']) / 1000.
+        self.watch_time = time.time()
+
+    def watch_due(self):
+        """
+        Seconds until the inbox watch should be renewed: watch_interval
+        after the last renewal, or WATCH_MARGIN before it expires. None
+        if there is no watch, when polling.
+        """
+        if self.watch_time is None:
+            return None
+        t_renew = self.watch_time + self.watch_interval
+        t_renew = min(t_renew, self.expiration - WATCH_MARGIN)
+        return max(0., t_renew - time.time())
+
+def _native(value):
+    """
+    Header values from the API are unicode, but the rest of the
+    handler works with native strings.
+    """
+    if value is not None and bytes is str and not isinstance(value, str):
+        value = value.encode('utf-8')
+    return value
+
+def _is_attachment(part):
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-disposition':
+            return header['value'].lower().startswith('attachment')
+    return False
+
+def _retryable(err):
+    """
+    Whether a failed batch sub-request may succeed if sent again.
+    """
+    if isinstance(err, HttpError):
+        return err.resp.status in RETRY_STATUS
+    return isinstance(err, socket.error)
+
+def decode_part_data(data, max_size=None):
+    """
+    Decode the base64url body data of a message part, keeping at most
+    max_size bytes. Only as much of the data as is kept gets decoded.
+    """
+    data = data.encode('ASCII') if not isinstance(data, bytes) else data
+    if max_size is not None:
+        data = data[:4 * ((max_size + 2) // 3)]
+    data += b'=' * (-len(data) % 4)
+    body = base64.urlsafe_b64decode(data)
+    if max_size is not None:
+        body = body[:max_size]
+    return body.replace(b'\r\n', b'\n')
+
+def find_text_part(payload):
+    """
+    Find the first text/plain part of a message payload that isn't an
+    attachment, or else the first text/html one. Parts are searched in
+    order and the search stops at the first text/plain part.
+    """
+    html = None
+    stack = [payload]
+    while len(stack):
+        part = stack.pop()
+        if 'parts' in part:
+            stack.extend(reversed(part['parts']))
+            continue
+        if part.get('filename') or _is_attachment(part):
+            continue
+        ctype = part.get('mimeType', '').lower()
+        if ctype == 'text/plain':
+            return part
+        if ctype == 'text/html' and html is None:
+            html = part
+    return html
+
+def parse_raw_message(raw, max_size=None):
+    """
+    Parse a base64url-encoded raw message into its sender, subject and
+    text body.
+    """
+    msg_str = base64.urlsafe_b64decode(raw.encode('ASCII'))
+    mime_msg = email.message_from_string(msg_str)
+
+    msg_compact = {}
+    msg_compact['from'] = mime_msg['From']
+    msg_compact['subject'] = mime_msg['Subject']
+    msg_compact['body'] = mb.get_body(mime_msg)[:max_size]
+    return msg_compact
 
 if __name__ == '__main__':
     # Quick test to send an instant reply to a message
@@ -257,8 +674,7 @@ if __name__ == '__main__':
     gmail_client = GmailClient(conf_file)
     gmail_client.gmail_setup()
     new_messages = gmail_client.wait_new_messages()
-    for message_attr in new_messages:
-        message = gmail_client.read_message(message_attr)
+    for message_attr, message in gmail_client.read_messages(new_messages):
 
         # reply
         reply_msg = {}
@@ -266,3 +682,4 @@ if __name__ == '__main__':
         reply_msg['subject'] = 'Re: ' + message['subject']
         reply_msg['body'] = 'received message: %s.\r\n' % message['subject']
         gmail_client.send_message(reply_msg, message_attr['threadId'])
+    gmail_client.smtp.stop()
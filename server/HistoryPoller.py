@@ -0,0 +1,106 @@
+#!/usr/bin/env python2
+
+################################################################################
+## HistoryPoller.py: Poll the Gmail history instead of using Pub/Sub.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import sys
+import time
+import threading
+
+class HistoryPoller:
+    def __init__(self, list_changes, send_notif, start_id,
+            min_interval=1., max_interval=30., backoff=2.):
+        """
+        Ingest driver polling the mailbox history instead of waiting
+        for Pub/Sub. Whenever email has arrived since the last history
+        ID seen, a notification like the ones Pub/Sub delivers is sent,
+        so the rest of the handler can't tell the two apart. Other
+        changes, such as the handler marking email read or sending
+        replies, only move the history ID along.
+
+        The interval adapts to the traffic: it drops to min_interval
+        as soon as the mailbox changes, and grows by a factor of
+        backoff after every poll that finds nothing, up to
+        max_interval.
+
+        list_changes:   function(start_id) returning the current
+                        history ID and whether email arrived since
+                        start_id
+        send_notif:     function(msg_data) to pass on a notification
+        start_id:       history ID the handler has already synced to
+        """
+        self.list_changes = list_changes
+        self.send_notif = send_notif
+        self.last_id = int(start_id)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+        # Object items
+        self.interval = min_interval
+        self.stopped = threading.Event()
+        self.n_polls = 0
+        self.n_changes = 0
+
+    def cancel(self):
+        """
+        Stop polling. Named like the Pub/Sub subscription future's
+        method, which the poller stands in for.
+        """
+        self.stopped.set()
+
+    def poll(self):
+        """
+        Check the history once and adapt the interval. Returns True if
+        email arrived.
+        """
+        self.n_polls += 1
+        try:
+            hist_id, added = self.list_changes(self.last_id)
+        except Exception as err:
+            print('Could not poll the mailbox:', err, file=sys.stderr)
+            hist_id, added = self.last_id, False
+        self.last_id = max(self.last_id, int(hist_id))
+
+        if not added:
+            self.interval = min(self.interval * self.backoff,
+                    self.max_interval)
+            return False
+        self.n_changes += 1
+        self.interval = self.min_interval
+        self.send_notif({'historyId': self.last_id,
+            'receivedTime': time.time()})
+        return True
+
+    def run(self):
+        """
+        Poll until cancelled.
+        """
+        while not self.stopped.is_set():
+            self.poll()
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        """
+        Poll in a background thread. Returns self, to be cancelled.
+        """
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return self
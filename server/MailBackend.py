@@ -0,0 +1,379 @@
+#!/usr/bin/env python2
+
+################################################################################
+## MailBackend.py: Mail backends for the order handler.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import os
+import json
+import time
+import mailbox
+import itertools
+import threading
+import Metrics as mt
+import multiprocessing as mp
+from collections import deque
+from email.message import Message
+from email.mime.text import MIMEText
+
+class MailBackend:
+    def __init__(self, config):
+        """
+        Base class for the mail the order handler reads orders from and
+        sends replies through. A backend fetches new messages, reads
+        them and marks them as read, and sends messages. The Gmail
+        backend is GmailWrapper.GmailClient.
+
+        notif_recv is a pipe end that is readable when new messages
+        may be waiting, so that the handler can select on it.
+
+        Configuration items:
+            email_name:     the email address of the server
+            send_name:      the name to send replies as
+        """
+        self.email_name = config['email_name']
+        self.send_name = config['send_name']
+        self.send_name_email = self.send_name + ' <%s>' % self.email_name
+
+        # Object items
+        self.notif_recv = None
+        self.metrics = mt.Metrics()
+
+    def not_from_self(self, msg_from):
+        # check to make sure someone else sent the message received.
+        # Assume that if the message has no "from" header that
+        # someone else sent it
+        if msg_from is None:
+            msg_from = ''
+
+        email_name = self.email_name
+        email_bracket = '<%s>' % self.email_name
+        from_self = msg_from == email_name or email_bracket in msg_from
+        return not from_self
+
+    def poll_new_messages(self):
+        """
+        Return the new messages waiting, without blocking, after
+        notif_recv became readable or timeout() ran out. Like
+        wait_new_messages, this returns message attributes with at
+        least an id and a threadId, to be passed to read_messages.
+        """
+        raise NotImplementedError
+
+    def read_messages(self, message_attrs):
+        """
+        Read messages, skipping those sent by the server itself, and
+        mark them as read. Returns a list of (message_attr, message)
+        pairs, with the sender, subject and text body of each message.
+        """
+        raise NotImplementedError
+
+    def render_message(self, message):
+        """
+        Render a message dictionary as an RFC 2822 string. A message may
+        carry its body already rendered by render_part in
+        message['part'].
+        """
+        part = message.get('part')
+        if part is None:
+            part = render_part(message['body'])
+        headers = Message()
+        headers['To'] = message['to']
+        headers['From'] = self.send_name_email
+        headers['Subject'] = message['subject']
+        return headers.as_string().rstrip('\n') + '\n' + part
+
+    def send_message(self, message, threadId=None):
+        raise NotImplementedError
+
+    def send_messages(self, messages):
+        """
+        Send several messages at once.
+        """
+        for message in messages:
+            self.send_message(message)
+
+    def setup(self, notif_process=True):
+        """
+        Start receiving new messages. With notif_process, a backend may
+        wait for them in a process of its own.
+        """
+        pass
+
+    def stop(self):
+        """
+        Stop receiving and finish sending messages.
+        """
+        pass
+
+    def timeout(self):
+        """
+        Seconds until poll_new_messages should be called even if
+        notif_recv isn't readable, or None.
+        """
+        return None
+
+    def wait_new_messages(self):
+        """
+        Block until there are new messages, and return them as
+        poll_new_messages does.
+        """
+        messages = []
+        while not len(messages):
+            self.notif_recv.poll(self.timeout())
+            messages = self.poll_new_messages()
+        return messages
+
+class MemoryMailbox(MailBackend):
+    def __init__(self, config):
+        """
+        Mailbox kept in memory, for running the handler offline and in
+        benchmarks. Messages come in through deliver(), which may be
+        called from any process sharing the mailbox, and sent messages
+        are rendered and kept in sent, in the process sending them.
+
+        Configuration items:
+            sent_size:      number of sent messages to keep
+        """
+        MailBackend.__init__(self, config)
+        self.sent_size = config.get('sent_size', 1000)
+
+        # Object items
+        self.notif_recv, self.notif_send = mp.Pipe(False)
+        self.deliver_lock = mp.Lock()
+        self.send_lock = threading.Lock()
+        self.msg_ids = itertools.count()
+        self.inbox = {}
+        self.new_ids = []
+        self.sent = deque(maxlen=self.sent_size)
+        self.n_sent = 0
+
+    def deliver(self, sender, subject, body, threadId=None):
+        """
+        Put a message in the mailbox. Returns its message ID.
+        """
+        msg_id = '%d.%d' % (os.getpid(), next(self.msg_ids))
+        message = {
+            'id': msg_id,
+            'threadId': threadId if threadId is not None else msg_id,
+            'from': sender,
+            'subject': subject,
+            'body': body,
+            'internalDate': time.time(),
+            }
+        with self.deliver_lock:
+            self.notif_send.send(message)
+        return msg_id
+
+    def poll_new_messages(self):
+        while self.notif_recv.poll(0):
+            message = self.notif_recv.recv()
+            self.inbox[message['id']] = message
+            self.new_ids.append(message['id'])
+        messages = [{'id': msg_id, 'threadId': self.inbox[msg_id]['threadId'],
+            'labelIds': ['INBOX', 'UNREAD']} for msg_id in self.new_ids]
+        self.new_ids = []
+        return messages
+
+    def read_messages(self, message_attrs):
+        # Reading a message marks it as read, which removes it.
+        messages = []
+        for message_attr in message_attrs:
+            message = self.inbox.pop(message_attr['id'], None)
+            if message is None:
+                continue
+            if not self.not_from_self(message['from']):
+                continue
+            msg_compact = {}
+            for key in ['from', 'subject', 'body', 'internalDate']:
+                msg_compact[key] = message[key]
+            messages.append((message_attr, msg_compact))
+        self.metrics.count('messages_read', len(messages))
+        return messages
+
+    def send_message(self, message, threadId=None):
+        msg_string = self.render_message(message)
+        with self.send_lock:
+            self.sent.append((message['to'], msg_string))
+            self.n_sent += 1
+        self.metrics.count('emails_queued')
+
+class MaildirMailbox(MailBackend):
+    def __init__(self, config):
+        """
+        Read orders from a local Maildir and save replies to another.
+        Mail delivered to the new/ directory by any local mail system
+        is picked up by a thread checking it every poll_interval
+        seconds. Reading a message moves it to cur/ as seen.
+
+        Configuration items:
+            maildir:        Maildir to read orders from
+            sent_maildir:   Maildir to save replies to, maildir/.Sent
+                            by default
+            poll_interval:  seconds between checks for new mail
+        """
+        MailBackend.__init__(self, config)
+        self.maildir = config['maildir']
+        self.sent_maildir = config.get('sent_maildir',
+                os.path.join(self.maildir, '.Sent'))
+        self.poll_interval = config.get('poll_interval', 0.5)
+
+        # Object items
+        self.inbox = mailbox.Maildir(self.maildir, factory=None, create=True)
+        self.outbox = mailbox.Maildir(self.sent_maildir, factory=None,
+                create=True)
+        self.notif_recv, self.notif_send = mp.Pipe(False)
+        self.send_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.poll_thread = None
+
+    def _poll_new(self):
+        """
+        Send the keys of messages appearing in new/ through the pipe,
+        each once.
+        """
+        new_dir = os.path.join(self.maildir, 'new')
+        notified = set()
+        while not self.stopped.is_set():
+            keys = set([name.split(':')[0] for name in os.listdir(new_dir)
+                if not name.startswith('.')])
+            added = sorted(keys - notified)
+            if len(added):
+                self.notif_send.send(added)
+            notified = keys
+            self.stopped.wait(self.poll_interval)
+
+    def poll_new_messages(self):
+        keys = []
+        while self.notif_recv.poll(0):
+            keys.extend(self.notif_recv.recv())
+        return [{'id': key, 'threadId': key, 'labelIds': ['INBOX', 'UNREAD']}
+                for key in keys]
+
+    def read_messages(self, message_attrs):
+        messages = []
+        for message_attr in message_attrs:
+            try:
+                mime_msg = self.inbox.get_message(message_attr['id'])
+            except KeyError:
+                continue
+            message_attr['threadId'] = thread_id(mime_msg, message_attr['id'])
+
+            # Mark as read
+            mime_msg.set_subdir('cur')
+            mime_msg.add_flag('S')
+            self.inbox[message_attr['id']] = mime_msg
+
+            if not self.not_from_self(mime_msg['From']):
+                continue
+            msg_compact = {}
+            msg_compact['from'] = mime_msg['From']
+            msg_compact['subject'] = mime_msg['Subject']
+            msg_compact['body'] = get_body(mime_msg)
+            msg_compact['internalDate'] = mime_msg.get_date()
+            messages.append((message_attr, msg_compact))
+        self.metrics.count('messages_read', len(messages))
+        return messages
+
+    def send_message(self, message, threadId=None):
+        msg_string = self.render_message(message)
+        with self.send_lock:
+            self.outbox.add(msg_string)
+        self.metrics.count('emails_queued')
+
+    def setup(self, notif_process=True):
+        # The pipe is shared with forked handler processes, so one
+        # thread here serves them all.
+        self.poll_thread = threading.Thread(target=self._poll_new)
+        self.poll_thread.daemon = True
+        self.poll_thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+def get_body(mime_msg):
+    # https://stackoverflow.com/questions/17874360/python-how-to-parse-the-body-from-a-raw-email-given-that-raw-email-does-not
+    body = ''
+    if mime_msg.is_multipart():
+        html = None
+        for part in mime_msg.walk():
+            ctype = part.get_content_type()
+            cdispo = str(part.get('Content-Disposition'))
+
+            # skip any text/plain (txt) attachments
+            if 'attachment' in cdispo:
+                continue
+            if ctype == 'text/plain':
+                body = part.get_payload(decode=True)  # decode
+                break
+            if ctype == 'text/html' and html is None:
+                html = part.get_payload(decode=True)
+
+        # HTML-only messages are turned into text by the thread filter.
+        else:
+            if html is not None:
+                body = html
+    # not multipart - i.e. plain text, no attachments, keeping fingers crossed
+    else:
+        body = mime_msg.get_payload(decode=True)
+    body = body.replace('\r\n', '\n')
+    return body
+
+def render_part(body):
+    """
+    Render the MIME headers and encoded payload of a text body. The
+    message headers are added in front of it by render_message.
+    """
+    return MIMEText(body).as_string()
+
+def thread_id(mime_msg, default):
+    """
+    Thread a message by the first message ID it refers to, or its own.
+    """
+    for header in ['References', 'In-Reply-To', 'Message-ID']:
+        value = mime_msg[header]
+        if value is not None and len(value.split()):
+            return value.split()[0]
+    return default
+
+BACKENDS = {
+    'memory': MemoryMailbox,
+    'maildir': MaildirMailbox,
+    }
+
+def open_mail_backend(conf_file, overrides=None):
+    """
+    Open the mail backend named by the backend item (default gmail)
+    of a json configuration file. Items in overrides take precedence,
+    and without a file the configuration is overrides alone.
+    """
+    config = {}
+    if conf_file is not None:
+        with open(conf_file) as f:
+            config = json.loads(f.read())
+    if overrides is not None:
+        config.update(overrides)
+
+    kind = config.get('backend', 'gmail')
+    if kind == 'gmail':
+        # Only the Gmail backend needs the Google API libraries.
+        import GmailWrapper as gw
+        return gw.GmailClient(conf_file, overrides)
+    if kind not in BACKENDS:
+        raise ValueError('Invalid mail backend: %s' % kind)
+    return BACKENDS[kind](config)
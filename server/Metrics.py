@@ -0,0 +1,249 @@
+#!/usr/bin/env python2
+
+################################################################################
+## Metrics.py: Timing, counters and a Prometheus endpoint for the handler.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+from ProcessLocal import ProcessLocal
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Histogram bucket upper bounds in seconds.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+        0.5, 1., 2.5, 5., 10.)
+
+class Metrics(ProcessLocal):
+    def __init__(self, prefix='obiwan', buckets=BUCKETS, trace_size=1024):
+        """
+        Count events and time the stages of the order pipeline, and
+        serve them over HTTP in the Prometheus text format.
+
+        Counters and histograms are keyed by name and a set of labels.
+        Stage timestamps are also kept for the last trace_size tickets.
+        Each process keeps its own metrics, so every handler process
+        serves them on its own port.
+
+        prefix:         prefix of every metric name
+        buckets:        histogram bucket upper bounds in seconds
+        trace_size:     number of tickets to keep stage traces for
+        """
+        ProcessLocal.__init__(self)
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.trace_size = trace_size
+
+        # Object items
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.traces = OrderedDict()
+        self.collectors = []
+        self.server = None
+        self.labels = {}
+
+    def add_collector(self, collect):
+        """
+        Add a function returning a dictionary of gauge values to render
+        along with the other metrics, e.g. SMTPPool.metrics.
+        """
+        self.collectors.append(collect)
+
+    def count(self, name, value=1, **labels):
+        """
+        Add to a counter.
+        """
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Add a duration to a histogram.
+        """
+        key = (name, _label_key(labels))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = [[0] * len(self.buckets), 0., 0]
+                self.histograms[key] = hist
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += seconds
+            hist[2] += 1
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted([(key, [list(h[0]), h[1], h[2]])
+                for key, h in self.histograms.items()])
+
+        lines = []
+        typed = set()
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, labels), value in counters:
+            name = '%s_%s_total' % (self.prefix, name)
+            declare(name, 'counter')
+            lines.append('%s%s %s' % (name, self._labels(labels), value))
+
+        for (name, labels), (buckets, total, n_obs) in histograms:
+            name = '%s_%s_seconds' % (self.prefix, name)
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, n_bucket in zip(self.buckets, buckets):
+                cumulative += n_bucket
+                le = labels + (('le', repr(bound)),)
+                lines.append('%s_bucket%s %d' % (name, self._labels(le),
+                    cumulative))
+            le = labels + (('le', '+Inf'),)
+            lines.append('%s_bucket%s %d' % (name, self._labels(le), n_obs))
+            lines.append('%s_sum%s %r' % (name, self._labels(labels), total))
+            lines.append('%s_count%s %d' % (name, self._labels(labels), n_obs))
+
+        for collect in self.collectors:
+            for key, value in sorted(collect().items()):
+                name = '%s_%s' % (self.prefix, key)
+                declare(name, 'gauge')
+                lines.append('%s%s %r' % (name, self._labels(()), value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1', **labels):
+        """
+        Serve /metrics and /traces from a background thread. A forked
+        child serves on its own port (see ProcessLocal). The labels are
+        added to every metric rendered.
+        """
+        self.start_process(self._serve, port, host, labels)
+
+    def _serve(self, port, host, labels):
+        self.lock = threading.Lock()
+        self.labels = labels
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics.render()
+                    ctype = 'text/plain; version=0.0.4'
+                elif self.path == '/traces':
+                    body = json.dumps(metrics.trace_items())
+                    ctype = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            self.server = HTTPServer((host, port), Handler)
+        except Exception as err:
+            print('Could not serve metrics on port %d:' % port, err,
+                    file=sys.stderr)
+            self.server = None
+            return
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.server is not None and self.owns_process():
+            self.server.shutdown()
+            self.server.server_close()
+        self.server = None
+        self.release_process()
+
+    def timer(self, name, **labels):
+        """
+        Context manager adding the time spent in it to a histogram.
+        """
+        return _Timer(self, name, labels)
+
+    def trace(self, ticket_id, stage, t=None):
+        """
+        Record the time a ticket reached a stage.
+        """
+        if t is None:
+            t = time.time()
+        with self.lock:
+            stages = self.traces.pop(ticket_id, None)
+            if stages is None:
+                stages = []
+                if len(self.traces) >= self.trace_size:
+                    self.traces.popitem(last=False)
+            stages.append((stage, t))
+            self.traces[ticket_id] = stages
+
+    def trace_items(self):
+        """
+        Stage timestamps of the recently traced tickets, oldest first.
+        """
+        with self.lock:
+            return [(ticket_id, list(stages))
+                    for ticket_id, stages in self.traces.items()]
+
+    def _labels(self, labels):
+        labels = tuple(sorted(self.labels.items())) + tuple(labels)
+        if not len(labels):
+            return ''
+        return '{%s}' % ','.join(['%s="%s"' % (k, _escape(v))
+            for k, v in labels])
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.t_start = None
+
+    def __enter__(self):
+        self.t_start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.time() - self.t_start,
+                **self.labels)
+        return False
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
@@ -24,34 +24,112 @@ import sys
 import json
 import time
 import zlib
-import gnupg
 import random
+import itertools
+import threading
+import select
 import socket
-import pickle as pkl
-import GmailWrapper as gw
+import email.utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir, 'common'))
+import Handshake as hs
+import WireCrypto as wc
+import WireFraming as wf
+import WireSchema as ws
+import TicketStore as ts
+import MailBackend as mb
+import ReplyCoalescer as rc
+import ReplyCache as rcache
+import DrinkMenu as dm
+import QuoteFilter as qf
+import TicketTimeline as tt
 import multiprocessing as mp
 
-class OrderHandler(gw.GmailClient):
-    def __init__(self, gmail_conf, bar_conf):
+_ticket_seq = itertools.count()
+
+# Fixed text of the automated replies.
+_CONFIRM_INTRO = ('We have received your order and are preparing your drink! '
+    'Your name will appear on the pickup screen near the bar when your drink '
+    'is ready.')
+_DENY_INTRO = ('We\'re sorry. Unfortunately we cannot complete your order. '
+    'Please see below for more details:')
+_FOOTER = ('If you\'d like to order another drink, please check the menu '
+    'message in your inbox for available drink options. If you don\'t have a '
+    'drink menu, reply to this message with the word "menu." We hope you have '
+    'a wonderful evening!')
+_NOPASSWD_BODY = '\r\n'.join([
+    'ERROR: Message subject does not contain the secret word. '
+    'Please send another order with the secret word in the subject.',
+    '',
+    '"Uh uh uh! You didn\'t say the magic word!" - Nedry'])
+
+class OrderHandler:
+    def __init__(self, gmail_conf, bar_conf, node_conf=None):
         """
-        Initialize the order handler from a gmail configuration file
+        Initialize the order handler from a mail configuration file
         and an order handler configuration file, both in json format.
+        Items in the node_conf dictionary override both files, which
+        is how ShardLauncher configures each node. The backend item of
+        the mail configuration picks the mail backend, Gmail by
+        default (see MailBackend.open_mail_backend).
 
         bar_conf configuration items:
             magic_word:         the required word in email subjects
             bar_acknowledge:    a word to check from the bar client
             port:               the network port to TCP over
-            buffer_size:        the size of the TCP buffer
+            buffer_size:        initial size of the TCP receive buffer
+            ticket_store:       open ticket storage (journal, pickle or memory)
+            mode:               multiprocess, or single for one process
+            ciphers:            space-separated ciphers the bar may use
+            bars:               number of bartender clients to wait for
+            node:               index of this handler node
+            n_nodes:            number of handler nodes sharing the inbox
+            shard_key:          split email between nodes by thread or message
+            reply_window:       seconds to hold replies for merging, 0 for off
+            reply_idle:         send merged replies after this long idle
+            menu_items:         json menu that orders are checked against
+            metrics_port:       local HTTP port for metrics, off if unset
+            timeline_log:       rolling log of closed ticket timelines
+            timeline_size:      bytes per timeline log file before rolling
+            max_backlog:        tickets not yet accepted by the bars at
+                                which to stop reading email, 0 for off
         """
-        gw.GmailClient.__init__(self, gmail_conf)
+        self.mail = mb.open_mail_backend(gmail_conf, node_conf)
+        self.email_name = self.mail.email_name
+        self.send_name = self.mail.send_name
+        self.metrics = self.mail.metrics
         with open(bar_conf) as f:
             config = json.loads(f.read())
+        if node_conf is not None:
+            config.update(node_conf)
         self.magic_word = config['magic_word']
         self.bar_acknowledge = config['bar_acknowledge']
         self.port = config['port']
         self.buffer_size = config['buffer_size']
         self.gpg_passwd = config['gpg_passwd']
         self.menu_file = config['menu_file']
+        self.menu_items = config.get('menu_items')
+        self.ticket_store = config.get('ticket_store', 'journal')
+        self.ciphers = config.get('ciphers', 'gpg aead').split()
+        self.mode = config.get('mode', 'multiprocess')
+        self.n_bars = config.get('bars', 1)
+        self.node = config.get('node', 0)
+        self.n_nodes = config.get('n_nodes', 1)
+        self.shard_key = config.get('shard_key', 'thread')
+        self.reply_window = config.get('reply_window', 0)
+        self.reply_idle = config.get('reply_idle', 2)
+        self.metrics_port = config.get('metrics_port')
+        self.timeline_log = config.get('timeline_log')
+        self.timeline_size = config.get('timeline_size', 1<<20)
+        self.max_backlog = config.get('max_backlog', 0)
+        if self.mode not in ['multiprocess', 'single']:
+            raise ValueError('Invalid handler mode: %s' % self.mode)
+        if self.ticket_store not in ts.STORES:
+            raise ValueError('Invalid ticket store: %s' % self.ticket_store)
+
+        # The email and bar processes share the open tickets.
+        if self.mode == 'multiprocess' and self.ticket_store == 'memory':
+            raise ValueError('The memory ticket store needs single mode.')
 
         # Set up the subjects for automated emails.
         self.drink_subj = {}
@@ -64,75 +142,303 @@ class OrderHandler(gw.GmailClient):
         self.drink_subj['deny'] += ': We\'re sorry. We cannot complete '
         self.drink_subj['deny'] += 'your order. '
         self.drink_subj['deny'] += '(magic word: %s)' % self.magic_word
+        self.drink_subj['digest'] = self.send_name
+        self.drink_subj['digest'] += ': Your drink orders '
+        self.drink_subj['digest'] += '(magic word: %s)' % self.magic_word
 
         # Object items.
-        self.gpg = None
-        self.active_tickets = '/tmp/' + self.email_name.split('@')[0] + '.pkl'
+        self.active_tickets = '/tmp/%s.%s' % (self.email_name.split('@')[0],
+                self.ticket_store)
+        if self.n_nodes > 1:
+            self.active_tickets = '/tmp/%s-%d.%s' % (
+                    self.email_name.split('@')[0], self.node, self.ticket_store)
+        if self.timeline_log is None:
+            self.timeline_log = os.path.splitext(self.active_tickets)[0]
+            self.timeline_log += '.timeline'
+        self.timeline = tt.TimelineLog(self.timeline_log, self.timeline_size)
+        self.node_name = str(self.node)
+        self.bar_host = '0.0.0.0'
+        self.tickets = None
         self.bar_sock = None
-        self.bar_conn = None
+        self.bar_conns = []
+        self.bar_ciphers = []
+        self.bar_codecs = []
+        self.bar_load = None
+        self.bar_send_lock = mp.Lock()
+        self.accepted = set()
+        self.accept_times = {}
+        self.menu = rcache.MenuReply(self.menu_file)
+        self.drink_menu = None
+        if self.menu_items is not None:
+            self.drink_menu = dm.DrinkMenu(self.menu_items)
+        self.nopasswd = rcache.StaticReply(_NOPASSWD_BODY)
+        self.replies = rc.ReplyCoalescer(self.send_replies, self.reply_window,
+                min(self.reply_idle, self.reply_window))
         self.recv_order_proc = None
         self.sock_notif_proc = None
 
+    def backlogged(self):
+        """
+        Check whether the connected bars have max_backlog or more tickets
+        they haven't accepted or declined yet.
+        """
+        if not self.max_backlog:
+            return False
+        loads = self.bar_load[:]
+        return sum([load for load in loads if load > 0]) >= self.max_backlog
+
+    def bar_handshake(self, conn):
+        """
+        Check the hello message from a bar and agree on a cipher and
+        a message encoding. Returns the cipher and the codec, or None
+        and None if the bar is rejected.
+        """
+        # A peer that doesn't frame its messages, such as an old client
+        # or a port scanner, is rejected like a wrong acknowledge word.
+        try:
+            word, options = hs.parse_hello(conn.recv_frame())
+        except (ValueError, socket.error) as err:
+            print('Invalid bar hello:', err)
+            return None, None
+        if word != self.bar_acknowledge:
+            return None, None
+        try:
+            reply, cipher = wc.server_select(options, self.ciphers,
+                    self.gpg_passwd)
+        except ValueError as err:
+            print(err)
+            return None, None
+        wire_reply, codec = ws.server_select(options, ws.PickleCodec())
+        reply.update(wire_reply)
+        try:
+            conn.send_frame(hs.format_hello(self.bar_acknowledge, reply))
+        except socket.error as err:
+            print('Bar hello failed:', err)
+            return None, None
+        return cipher, codec
+
+    def choose_bar(self):
+        """
+        Pick the connected bar with the fewest tickets that it has not
+        accepted or declined yet, and count a new ticket against it.
+        Returns None if no bar is connected.
+        """
+        with self.bar_load.get_lock():
+            loads = [(load, i) for i, load in enumerate(self.bar_load[:])
+                    if load >= 0]
+            if not len(loads):
+                return None
+            bar_idx = min(loads)[1]
+            self.bar_load[bar_idx] += 1
+        return bar_idx
+
+    def close_bar(self, bar_idx):
+        """
+        Stop using a bar that disconnected and hand its open tickets to
+        the remaining bars. Only the process that finds the bar still
+        open hands them over.
+        """
+        with self.bar_load.get_lock():
+            was_open = self.bar_load[bar_idx] >= 0
+            self.bar_load[bar_idx] = -1
+        self.bar_conns[bar_idx].close()
+        if not was_open:
+            return
+        print('Bar %d disconnected.' % bar_idx)
+
+        # A ticket may have moved on already, if sending it to another
+        # bar that is gone too closed that bar first.
+        for ticket_id, _ in self.tickets.items():
+            message = self.tickets.get(ticket_id)
+            if message is not None and message.get('bar') == bar_idx:
+                self.accepted.discard(ticket_id)
+                self.accept_times.pop(ticket_id, None)
+                self.dispatch_ticket(ticket_id, message)
+
+    def open_bars(self):
+        """
+        Sockets of the bars that are still connected.
+        """
+        loads = self.bar_load[:]
+        return [conn for i, conn in enumerate(self.bar_conns) if loads[i] >= 0]
+
     def cleanup(self):
         if self.recv_order_proc is not None:
             self.recv_order_proc.terminate()
         if self.sock_notif_proc is not None:
             self.sock_notif_proc.terminate()
-        if self.notif_proc is not None:
-            self.notif_proc.terminate()
-        if self.bar_conn is not None:
-            self.bar_conn.close()
+        for conn in self.bar_conns:
+            conn.close()
         if self.bar_sock is not None:
             self.bar_sock.close()
+        if self.tickets is not None:
+            self.tickets.close()
+        self.replies.stop(timeout=10)
+        self.mail.stop()
+        self.metrics.stop()
 
     def create_ticket(self, message):
         """
         Create an order ticket and send it to the bar.
         """
         # Store an order in the open order queue
-        ticket_id = str(int(time.time())) + '.'
-        ticket_id += str(random.randint(1 << 10, 1 << 20))
-
-        # Save to tickets file
-        with open(self.active_tickets, 'rb') as f:
-            tickets = pkl.load(f)
-        tickets[ticket_id] = message
-        with open(self.active_tickets, 'wb') as f:
-            pkl.dump(tickets, f)
+        ticket_id = make_ticket_id(self.node_name)
+        timeline = {}
+        timeline['gmail'] = message.pop('internalDate', None)
+        timeline['received'] = message.pop('t_received', None)
+        message['timeline'] = timeline
+        if timeline['received'] is not None:
+            self.metrics.trace(ticket_id, 'received', timeline['received'])
+        self.metrics.trace(ticket_id, 'created')
+        self.dispatch_ticket(ticket_id, message)
+
+    def dispatch_ticket(self, ticket_id, message):
+        """
+        Assign a ticket to the least loaded bar, save it to the ticket
+        store and send it to that bar.
+        """
+        message['bar'] = self.choose_bar()
+        if message['bar'] is not None:
+            message.setdefault('timeline', {})['delivered'] = time.time()
+        self.tickets.add(ticket_id, message)
+        if message['bar'] is not None:
+            self.send_ticket(ticket_id, message)
+
+    def restore_tickets(self):
+        """
+        Resend tickets left open by a previous run to the bars.
+        """
+        open_tickets = self.tickets.items()
+        for ticket_id, message in open_tickets:
+            self.dispatch_ticket(ticket_id, message)
+        if len(open_tickets):
+            print('Restored %d open tickets.' % len(open_tickets))
 
+    def send_ticket(self, ticket_id, message):
+        """
+        Send a stored ticket to the bar it is assigned to.
+        """
         # Create a pickle of minimal information to send to the bar
         order = {'id': ticket_id}
         if '<' in message['from'] and '>' in message['from']:
             order['from'] = message['from'].split('<')[0].strip()
         else:
             order['from'] = message['from']
+        order['email'] = email.utils.parseaddr(message['from'])[1]
         order['body'] = message['body']
-        order_pkl = zlib.compress(pkl.dumps(order, pkl.HIGHEST_PROTOCOL))
-        encrypted = self.gpg.encrypt(order_pkl, None, symmetric='AES256',
-                passphrase=self.gpg_passwd, armor=False)
+        if 'drinks' in message:
+            order['drinks'] = message['drinks']
+        bar_idx = message['bar']
+        cipher = self.bar_ciphers[bar_idx]
+        order_msg = self.bar_codecs[bar_idx].encode(order)
+        with self.metrics.timer('encrypt', cipher=cipher.__class__.__name__):
+            encrypted = cipher.encrypt(order_msg)
+
+        # Send the order. Both handler processes may send to the bars.
+        # A bar that has gone away is closed, which hands its tickets,
+        # this one included, to the other bars.
+        try:
+            with self.metrics.timer('bar_send'):
+                with self.bar_send_lock:
+                    self.bar_conns[bar_idx].send_frame(encrypted)
+        except socket.error as err:
+            print('Could not send ticket to bar %d:' % bar_idx, err)
+            self.close_bar(bar_idx)
+
+            # The other process may have closed the bar before this
+            # ticket was stored, and so not handed it over.
+            current = self.tickets.get(ticket_id)
+            if current is not None and current.get('bar') == bar_idx:
+                self.dispatch_ticket(ticket_id, current)
+            return
+        self.metrics.trace(ticket_id, 'sent_to_bar')
 
-        # Connect to the bar and send the order
-        self.bar_conn.send(encrypted.data)
+    def recv_bars(self, readable):
+        """
+        Process notifications from the bars with data waiting.
+        """
+        for bar_idx, conn in enumerate(self.bar_conns):
+            if conn not in readable:
+                continue
+            try:
+                notif = conn.recv_frame()
+            except socket.error as err:
+                print('Bar %d connection lost:' % bar_idx, err)
+                notif = None
+            if notif is None: # Bartender closed.
+                self.close_bar(bar_idx)
+                continue
+            self.process_notif(bar_idx, notif)
+            while conn.pending():
+                self.process_notif(bar_idx, conn.recv_frame())
 
     def run_handler(self):
         # Basic setup
-        self.gpg = gnupg.GPG()
-        with open(self.active_tickets, 'wb') as f:
-            pkl.dump({}, f)
+        self.tickets = ts.open_ticket_store(self.ticket_store,
+                self.active_tickets)
 
-        self.gmail_setup()
-        print('Gmail robot ready.')
+        self.mail.setup(notif_process=self.mode != 'single')
+        print('Email robot ready.')
         self.socket_init()
         print('Socket interface ready.')
+        self.restore_tickets()
 
-        self.recv_order_proc = mp.Process(target=self.recv_order)
-        self.daemon = True
-        self.recv_order_proc.start()
-
-        self.sock_notif()
+        if self.mode == 'single':
+            self.serve_metrics(0, 'handler')
+            self.run_event_loop()
+        else:
+            self.recv_order_proc = mp.Process(target=self.recv_order)
+            self.daemon = True
+            self.recv_order_proc.start()
+            self.serve_metrics(0, 'bar')
+            self.sock_notif()
         print('Closing connection.')
         self.cleanup()
 
+    def run_event_loop(self):
+        """
+        Handle inbox and bar notifications in this process, waiting on
+        both with select, and let the mail backend run its periodic
+        work (such as renewing the Gmail watch) when it is due. Replies
+        are sent by the SMTP worker threads. Inbox notifications that
+        are already waiting are coalesced, but there is no debounce, as
+        it would hold up the bars.
+
+        While the bars are behind, the inbox and the backend's periodic
+        work both wait, and only the bars are listened to, as only they
+        can bring the backlog down.
+
+        Bars are handled before new messages, so that a bar that has
+        disconnected is closed before any ticket is sent to it.
+        """
+        notif_recv = self.mail.notif_recv
+        while len(self.open_bars()):
+            if self.backlogged():
+                self.metrics.count('backlog_waits')
+                readable, _, _ = select.select(self.open_bars(), [], [])
+                self.recv_bars(readable)
+            else:
+                readable, _, _ = select.select([notif_recv] +
+                        self.open_bars(), [], [], self.mail.timeout())
+                self.recv_bars(readable)
+                if notif_recv in readable or self.mail.timeout() == 0:
+                    self.process_messages(self.mail.poll_new_messages())
+
+    def owns_message(self, message_attr):
+        """
+        Check whether a new message belongs to this node's shard. The
+        shard is picked from the thread or message ID, which are known
+        before the message is fetched. Sharding by thread keeps a
+        patron's replies to the menu on one node.
+        """
+        if self.n_nodes == 1:
+            return True
+        if self.shard_key == 'thread':
+            key = message_attr['threadId']
+        else:
+            key = message_attr['id']
+        return shard_index(key, self.n_nodes) == self.node
+
     def parse_message(self, message, threadId=None):
         """
         Parse a message.
@@ -142,108 +448,133 @@ class OrderHandler(gw.GmailClient):
 
         If the sender asks for a menu, send one.
 
-        If the sender orders a drink, send the order to the bar.
+        If the sender orders a drink, send the order to the bar. With a
+        structured menu, orders naming no drink from it, or a drink that
+        isn't available, are declined without going to the bar.
         """
         subject = message['subject'].lower()
         if self.magic_word not in subject:
+            self.metrics.count('emails', kind='nopasswd')
             self.reply_nopasswd(message['from'], message['subject'], threadId)
             return
 
-        message['body'] = filter_message_thread(message['body'])
+        with self.metrics.timer('filter_message_thread'):
+            message['body'] = filter_message_thread(message['body'])
+        message['threadId'] = threadId
         if 'menu' in message['body'].lower():
+            self.metrics.count('emails', kind='menu')
             self.reply_menu(message['from'], threadId)
-        else:
-            message['threadId'] = threadId
+        elif self.drink_menu is None:
+            self.metrics.count('emails', kind='order')
             self.create_ticket(message)
+        else:
+            drinks, unavailable = self.drink_menu.match(message['body'])
+            reason = None
+            if not len(drinks):
+                reason = 'We couldn\'t find a drink from the menu in your order.'
+            elif len(unavailable):
+                names = [self.drink_menu.name(d) for d in unavailable]
+                reason = 'Not available right now: %s.' % ', '.join(names)
+
+            if reason is None:
+                self.metrics.count('emails', kind='order')
+                message['drinks'] = drinks
+                self.create_ticket(message)
+            else:
+                self.metrics.count('emails', kind='not_on_menu')
+                self.mail.send_message(self.deny_message(message, reason),
+                        threadId)
         print('Sent reply.')
 
-    def reply_deny(self, ticket_id, reason):
+    def deny_message(self, ticket, reason):
         """
-        Reply when the drink cannot be completed.
+        Build the reply for when the drink cannot be completed.
         """
-        with open(self.active_tickets, 'rb') as f:
-            tickets = pkl.load(f)
-        sender = tickets[ticket_id]['from']
-        drink = tickets[ticket_id]['body'].replace('\r\n', '\n').split('\n')
+        drink = ticket['body'].replace('\r\n', '\n').split('\n')
         reply_msg = {}
-        reply_msg['to'] = sender
+        reply_msg['to'] = ticket['from']
         reply_msg['subject'] = self.drink_subj['deny']
-        reply_msg['body'] = '\r\n'.join([
-            'We\'re sorry. Unfortunately we cannot complete your order. Please'
-            ' see below for more details:',
-            '',
-            'Order Summary:'])
-        for line in drink:
-            reply_msg['body'] += '\r\n' + line
-        reply_msg['body'] += '\r\n'.join([
-            '',
-            'Cancellation reason:',
-            reason,
-            ])
-        reply_msg['body'] += '\r\n'.join([
-            '', '',
-            'If you\'d like to order another drink, please check the menu '
-            'message in your inbox for available drink options. If you don\'t '
-            'have a drink menu, reply to this message with the word "menu." '
-            'We hope you have a wonderful evening!',
-            ])
-        self.send_message(reply_msg)
+        reply_msg['body'] = '\r\n'.join([_DENY_INTRO, '', 'Order Summary:'] +
+                drink + ['Cancellation reason:', reason, '', _FOOTER])
+        return reply_msg
+
+    def digest_message(self, replies):
+        """
+        Build one reply covering several confirmed or denied drinks for
+        the same patron.
+        """
+        confirmed = [r for r in replies if r[0] == 'confirm']
+        denied = [r for r in replies if r[0] == 'deny']
+        if not len(denied):
+            subject = self.drink_subj['confirm']
+        elif not len(confirmed):
+            subject = self.drink_subj['deny']
+        else:
+            subject = self.drink_subj['digest']
+
+        lines = []
+        if len(confirmed):
+            lines.append('We have received your orders and are preparing '
+                'your drinks! Your name will appear on the pickup screen '
+                'near the bar when your drinks are ready.')
+            for _, ticket, _ in confirmed:
+                lines.extend(['', 'Order Summary:'])
+                lines.extend(ticket['body'].replace('\r\n', '\n').split('\n'))
+            lines.append('')
+        if len(denied):
+            lines.append('We\'re sorry. Unfortunately we cannot complete the '
+                'following orders:')
+            for _, ticket, reason in denied:
+                lines.extend(['', 'Order Summary:'])
+                lines.extend(ticket['body'].replace('\r\n', '\n').split('\n'))
+                lines.extend(['Cancellation reason:', reason])
+            lines.append('')
+        lines.append(_FOOTER)
+
+        reply_msg = {}
+        reply_msg['to'] = replies[0][1]['from']
+        reply_msg['subject'] = subject
+        reply_msg['body'] = '\r\n'.join(lines)
+        return reply_msg
+
+    def reply_message(self, replies):
+        """
+        Build the email for a list of (kind, ticket, reason) replies to
+        one patron.
+        """
+        if len(replies) > 1:
+            return self.digest_message(replies)
+        kind, ticket, reason = replies[0]
+        if kind == 'deny':
+            return self.deny_message(ticket, reason)
+        return self.processed_message(ticket)
 
     def reply_menu(self, sender, threadId=None):
         """
         Reply to a menu request
         """
-        reply_msg = {}
-        reply_msg['to'] = sender
-        reply_msg['subject'] = self.drink_subj['menu']
-        with open(self.menu_file) as f:
-            reply_msg['body'] = f.read()
-        if len(reply_msg['body'].split('\r\n')) == 1:
-            reply_msg['body'] = reply_msg['body'].replace('\n', '\r\n')
-        self.send_message(reply_msg, threadId)
+        reply_msg = self.menu.get().message(sender, self.drink_subj['menu'])
+        self.mail.send_message(reply_msg, threadId)
 
     def reply_nopasswd(self, sender, subject, threadId=None):
         """
         Reply when the user didn't put the magic word in the subject.
         """
+        reply_msg = self.nopasswd.message(sender,
+                'ERROR: Invalid Message Subject: ' + subject)
+        self.mail.send_message(reply_msg, threadId)
+
+    def processed_message(self, ticket):
+        """
+        Build the reply for when the drink is being processed.
+        """
+        drink = ticket['body'].replace('\r\n', '\n').split('\n')
         reply_msg = {}
-        reply_msg['to'] = sender
-        reply_msg['subject'] = 'ERROR: Invalid Message Subject: '
-        reply_msg['subject'] += subject
-        reply_msg['body'] = '\r\n'.join([
-            'ERROR: Message subject does not contain the secret word. '
-            'Please send another order with the secret word in the subject.',
-            '',
-            '"Uh uh uh! You didn\'t say the magic word!" - Nedry'])
-        self.send_message(reply_msg, threadId)
-
-    def reply_processed(self, ticket_id):
-        """
-        Reply when the drink is being processed.
-        """
-        with open(self.active_tickets, 'rb') as f:
-            tickets = pkl.load(f)
-        sender = tickets[ticket_id]['from']
-        drink = tickets[ticket_id]['body'].replace('\r\n', '\n').split('\n')
-        reply_msg = {}
-        reply_msg['to'] = sender
+        reply_msg['to'] = ticket['from']
         reply_msg['subject'] = self.drink_subj['confirm']
-        reply_msg['body'] = '\r\n'.join([
-            'We have received your order and are preparing your drink! '
-            'Your name will appear on the pickup screen near the bar when '
-            'your drink is ready.',
-            '',
-            'Order Summary:'])
-        for line in drink:
-            reply_msg['body'] += '\r\n' + line
-        reply_msg['body'] += '\r\n'.join([
-            '',
-            'If you\'d like to order another drink, please check the menu '
-            'message in your inbox for available drink options. If you don\'t '
-            'have a drink menu, reply to this message with the word "menu." '
-            'We hope you have a wonderful evening!',
-            ])
-        self.send_message(reply_msg)
+        reply_msg['body'] = '\r\n'.join([_CONFIRM_INTRO, '', 'Order Summary:'] +
+                drink + [_FOOTER])
+        return reply_msg
 
     #---------------------------------------------------------------------------
     # Handler Thread Functions
@@ -251,128 +582,160 @@ class OrderHandler(gw.GmailClient):
         """
         Receive orders from the email robot
         """
+        self.serve_metrics(1, 'email')
         while True:
-            new_messages = self.wait_new_messages()
-            for message_attr in new_messages:
-                # Make something that can be used for analytics.
-                print('Received message.')
-                message = self.read_message(message_attr)
-                self.parse_message(message, message_attr['threadId'])
+            self.wait_backlog()
+            self.process_messages(self.mail.wait_new_messages())
 
-    def sock_notif(self):
+    def wait_backlog(self):
         """
-        Get notifications from the bartender software
+        Stop reading new email while the bars are behind. Meanwhile
+        inbox notifications queue up to be coalesced, and Pub/Sub flow
+        control holds back further ones.
         """
-        while True:
-            notif = self.bar_conn.recv(self.buffer_size)
-            if not len(notif): # Bartender closed.
-                return
-            notif = self.gpg.decrypt(notif, passphrase=self.gpg_passwd)
-            notif = pkl.loads(zlib.decompress(notif.data))
+        if not self.backlogged():
+            return
+        self.metrics.count('backlog_waits')
+        with self.metrics.timer('backlog_wait'):
+            while self.backlogged():
+                time.sleep(0.1)
+
+    def log_timeline(self, notif, ticket, t_done):
+        """
+        Log the timeline of a ticket closed by a bar notification. The
+        bar reports how long before pickup the drink was made ready, so
+        no clock has to agree with the bar's.
+        """
+        timeline = dict(ticket.get('timeline', {}))
+        timeline['accepted'] = self.accept_times.pop(notif['id'], None)
+        if 'ready_for' in notif:
+            timeline['ready'] = t_done - notif['ready_for']
+        timeline['done'] = t_done
+        try:
+            self.timeline.append(notif['id'], ticket.get('bar'),
+                    notif['status'], timeline)
+        except (IOError, OSError) as err:
+            print('Could not log ticket timeline:', err, file=sys.stderr)
+
+    def process_messages(self, new_messages):
+        """
+        Read new messages owned by this node and act on them.
+        """
+        new_messages = [m for m in new_messages if self.owns_message(m)]
+        for message_attr, message in self.mail.read_messages(new_messages):
+            # Make something that can be used for analytics.
+            print('Received message.')
+            message['t_received'] = time.time()
+            self.parse_message(message, message_attr['threadId'])
+
+    def process_notif(self, bar_idx, notif):
+        """
+        Act on an encrypted notification from the bartender software.
+        A notification is either one {id, status} record or a list of
+        them.
+        """
+        cipher = self.bar_ciphers[bar_idx]
+        try:
+            with self.metrics.timer('decrypt',
+                    cipher=cipher.__class__.__name__):
+                notif = cipher.decrypt(notif)
+            records = self.bar_codecs[bar_idx].decode(notif)
+        except ValueError as err:
+            print('Invalid notification:', err)
+            return
+        if isinstance(records, dict):
+            records = [records]
+        self.process_records(bar_idx, records)
+
+    def process_records(self, bar_idx, records):
+        """
+        Act on notification records from a bar. The tickets are read
+        and closed with one ticket store operation each, and the
+        replies are queued together.
+
+        Accepting or declining a ticket takes it off the bar's load.
+        """
+        tickets = self.tickets.get_many([notif['id'] for notif in records])
+        replies = []
+        closed = []
+        t_now = time.time()
+        for notif in records:
             status = notif['status']
+            ticket = tickets.get(notif['id'])
+            self.metrics.count('bar_notifications', status=status)
+            self.metrics.trace(notif['id'], status)
             if status == 'accepted':
-                self.reply_processed(notif['id'])
+                self.accepted.add(notif['id'])
+                self.accept_times[notif['id']] = t_now
+                self.release_bar(bar_idx)
+                if ticket is not None:
+                    replies.append(('confirm', ticket, None))
                 continue
             elif status == 'cancelled':
-                self.reply_deny(notif['id'], notif['reason'])
+                if notif['id'] in self.accepted:
+                    self.accepted.discard(notif['id'])
+                else:
+                    self.release_bar(bar_idx)
+                if ticket is not None:
+                    replies.append(('deny', ticket, notif['reason']))
             elif status == 'pickup':
                 # Pickup just removes the drink from the ticket list.
-                pass
+                self.accepted.discard(notif['id'])
             else:
                 print('Invalid notification:')
                 print(notif)
                 continue
+            closed.append(notif['id'])
+            if ticket is not None:
+                self.log_timeline(notif, ticket, t_now)
 
-            with open(self.active_tickets, 'rb') as f:
-                tickets = pkl.load(f)
-            tickets.pop(notif['id'], None)
-            with open(self.active_tickets, 'wb') as f:
-                pkl.dump(tickets, f)
+        self.queue_replies(replies)
+        self.tickets.pop_many(closed)
 
-    def socket_init(self):
+    def queue_replies(self, replies):
         """
-        Initialize the network communications between the email robot
-        and the bar.
+        Send (kind, ticket, reason) replies, or hold them to be merged
+        with other replies to the same patron and thread.
         """
-        self.bar_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        host = '0.0.0.0'
-        self.bar_sock.bind((host, self.port))
-        self.bar_sock.listen(1)
-
-        # Wait for the bar to connect
-        self.bar_conn, addr = self.bar_sock.accept()
-        msg = self.bar_conn.recv(self.buffer_size)
-        while msg != self.bar_acknowledge:
-            self.bar_conn.close()
-            self.bar_conn, addr = self.bar_sock.accept()
-            msg = self.bar_conn.recv(self.buffer_size)
-        self.bar_conn.send(self.bar_acknowledge)
-        print('Bar address:', addr[0] + ':' + str(addr[1]))
+        if self.reply_window <= 0:
+            self.mail.send_messages([self.reply_message([reply])
+                for reply in replies])
+            return
+        for reply in replies:
+            ticket = reply[1]
+            self.replies.add((ticket['from'], ticket.get('threadId')), reply)
 
-class OfflineDebug:
-    def __init__(self, bar_conf):
+    def release_bar(self, bar_idx):
         """
-        Set up an offline debug simulator
+        Take a ticket off a bar's load.
         """
-        with open(bar_conf) as f:
-            config = json.loads(f.read())
-        self.magic_word = config['magic_word']
-        self.bar_acknowledge = config['bar_acknowledge']
-        self.port = config['port']
-        self.buffer_size = config['buffer_size']
-        self.gpg_passwd = config['gpg_passwd']
-        self.active_tickets = '/tmp/offline-debug-%d.pkl' % self.port
-
-        # Object items.
-        self.gpg = None
-        self.bar_sock = None
-        self.bar_conn = None
-        self.recv_order_proc = None
-        self.sock_notif_proc = None
+        with self.bar_load.get_lock():
+            if self.bar_load[bar_idx] > 0:
+                self.bar_load[bar_idx] -= 1
 
-    def cleanup(self):
-        if self.fake_order_proc is not None:
-            self.fake_order_proc.terminate()
-        if self.sock_notif_proc is not None:
-            self.sock_notif_proc.terminate()
-        if self.bar_conn is not None:
-            self.bar_conn.close()
-        if self.bar_sock is not None:
-            self.bar_sock.close()
-
-    def create_ticket(self):
+    def send_replies(self, key, replies):
         """
-        Create an order ticket and send it to the bar.
+        Send the replies held for one patron and thread as one email.
         """
-        # Store an order in the open order queue
-        ticket_id = str(int(time.time())) + '.'
-        ticket_id += str(random.randint(1 << 10, 1 << 20))
+        self.mail.send_message(self.reply_message(replies), key[1])
 
-        # Create a pickle of minimal information to send to the bar
-        order = {'id': ticket_id, 'from': 'OfflineDebug:'+str(self.port)}
-        order['from'] += '-' + str(random.random())
-        order['body'] = ticket_id
-
-        # Save to tickets file
-        with open(self.active_tickets, 'rb') as f:
-            tickets = pkl.load(f)
-        tickets[ticket_id] = order
-        with open(self.active_tickets, 'wb') as f:
-            pkl.dump(tickets, f)
-
-        order_pkl = zlib.compress(pkl.dumps(order, pkl.HIGHEST_PROTOCOL))
-        encrypted = self.gpg.encrypt(order_pkl, None, symmetric='AES256',
-                passphrase=self.gpg_passwd, armor=False)
-
-        # Connect to the bar and send the order
-        self.bar_conn.send(encrypted.data)
-        print('Sent simulated ticket:', ticket_id)
+    def serve_metrics(self, port_offset, process):
+        """
+        Serve this process's metrics on metrics_port plus port_offset,
+        if a metrics port is configured.
+        """
+        if self.metrics_port is None:
+            return
+        self.metrics.serve(self.metrics_port + port_offset,
+                node=self.node, process=process)
 
-    def fake_order(self):
-        while True:
-            time.sleep(4)
-            #time.sleep(random.randint(10,20))
-            self.create_ticket()
+    def sock_notif(self):
+        """
+        Get notifications from the bartender software
+        """
+        while len(self.open_bars()):
+            readable, _, _ = select.select(self.open_bars(), [], [])
+            self.recv_bars(readable)
 
     def socket_init(self):
         """
@@ -380,98 +743,100 @@ class OfflineDebug:
         and the bar.
         """
         self.bar_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        host = '127.0.0.1'
-        self.bar_sock.bind((host, self.port))
-        self.bar_sock.listen(1)
-
-        # Wait for the bar to connect
-        self.bar_conn, addr = self.bar_sock.accept()
-        msg = self.bar_conn.recv(self.buffer_size)
-        while msg != self.bar_acknowledge:
-            self.bar_conn.close()
-            self.bar_conn, addr = self.bar_sock.accept()
-            msg = self.bar_conn.recv(self.buffer_size)
-        self.bar_conn.send(self.bar_acknowledge)
-        print('Bar address:', addr[0] + ':' + str(addr[1]))
-
-    def run_handler(self):
-        self.gpg = gnupg.GPG()
-        with open(self.active_tickets, 'wb') as f:
-            pkl.dump({}, f)
-
-        print('Waiting for bartender connection.')
-        self.socket_init()
-        print('Socket interface ready.')
-
-        self.fake_order_proc = mp.Process(target=self.fake_order)
-        self.fake_order_proc.daemon = True
-        self.fake_order_proc.start()
+        self.bar_sock.bind((self.bar_host, self.port))
+        self.bar_sock.listen(self.n_bars)
+
+        # Wait for the bars to connect
+        while len(self.bar_conns) < self.n_bars:
+            conn, addr = self.bar_sock.accept()
+            conn = wf.FramedSocket(conn, self.buffer_size)
+            cipher, codec = self.bar_handshake(conn)
+            if cipher is None:
+                conn.close()
+                continue
+            self.bar_conns.append(conn)
+            self.bar_ciphers.append(cipher)
+            self.bar_codecs.append(codec)
+            print('Bar address:', addr[0] + ':' + str(addr[1]))
 
-        self.sock_notif()
-        print('Closing connection.')
-        self.cleanup()
+        # Unacknowledged tickets per bar, shared with recv_order. A
+        # disconnected bar has a load of -1.
+        self.bar_load = mp.Array('i', self.n_bars)
 
-    def sock_notif(self):
+class OfflineDebug(OrderHandler):
+    def __init__(self, bar_conf, interval=4.):
         """
-        Get notifications from the bartender software
+        Set up an offline debug simulator: the order handler in one
+        process on an in-memory mailbox, which gets a fake order email
+        every interval seconds. Replies are kept in the mailbox.
+
+        Each simulator is keyed by its port, so that several can run at
+        once, and only listens on localhost. Tickets are kept in memory
+        unless the configuration picks a ticket store, so that fake
+        orders are not restored on the next run.
         """
-        while True:
-            notif = self.bar_conn.recv(self.buffer_size)
-            if not len(notif): # Bartender closed.
-                return
-            notif = self.gpg.decrypt(notif, passphrase=self.gpg_passwd)
-            notif = pkl.loads(zlib.decompress(notif.data))
+        with open(bar_conf) as f:
+            config = json.loads(f.read())
+        port = config['port']
+        ticket_store = config.get('ticket_store', 'memory')
+        overrides = {
+            'backend': 'memory',
+            'email_name': 'offline-debug@localhost',
+            'send_name': 'Offline Debug',
+            'mode': 'single',
+            'ticket_store': ticket_store,
+            'menu_file': config.get('menu_file', os.devnull),
+            'timeline_log': config.get('timeline_log',
+                '/tmp/offline-debug-%d.timeline' % port),
+            }
+        OrderHandler.__init__(self, None, bar_conf, overrides)
+        self.active_tickets = '/tmp/offline-debug-%d.%s' % (port, ticket_store)
+        self.node_name = str(port)
+        self.bar_host = '127.0.0.1'
+        self.interval = interval
+        self.n_fake = itertools.count()
 
-            print(notif)
-            status = notif['status']
-            if status == 'accepted':
-                continue
-            elif status == 'cancelled' or status == 'pickup':
-                pass
-            else:
-                print('Invalid notification:')
-                print(notif)
-                continue
+    def fake_order(self):
+        while True:
+            time.sleep(self.interval)
+            #time.sleep(random.randint(10,20))
+            self.send_fake_order()
 
-            with open(self.active_tickets, 'rb') as f:
-                tickets = pkl.load(f)
-            tickets.pop(notif['id'], None)
-            with open(self.active_tickets, 'wb') as f:
-                pkl.dump(tickets, f)
+    def run_handler(self):
+        fake_order_thread = threading.Thread(target=self.fake_order)
+        fake_order_thread.daemon = True
+        fake_order_thread.start()
+        OrderHandler.run_handler(self)
 
+    def send_fake_order(self, body=None):
+        """
+        Email a fake order to the handler. Returns the message ID.
+        """
+        sender = 'OfflineDebug:%d-%s <offline@localhost>' % (self.port,
+                random.random())
+        subject = 'Offline debug order (%s)' % self.magic_word
+        if body is None:
+            body = 'Fake order %d' % next(self.n_fake)
+        msg_id = self.mail.deliver(sender, subject, body)
+        print('Sent simulated order:', msg_id)
+        return msg_id
+
+def make_ticket_id(node):
+    """
+    Create a ticket ID that is unique across handler nodes from the
+    node name, the time in milliseconds and a sequence number.
+    """
+    return '%s.%d.%d' % (node, int(time.time() * 1000), next(_ticket_seq))
+
+def shard_index(key, n_nodes):
+    """
+    Map a key to a node index, the same way in every process.
+    """
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % n_nodes
 
 def filter_message_thread(msg_body):
     # Select only the most recent message in a thread.
-    msg_body = msg_body.replace('\r\n', '\n')
-    msg_lines = msg_body.split('\n')
-    msg_lines = [l for l in msg_lines if len(l)]
-    msg_lines = [l for l in msg_lines if l[0] != '>']
-
-    # Check if "On <stuff> YEAR" is in a line. If it is, assume that's
-    # the divider between current message and the old messages
-    def check_match(line):
-        match = False
-        year = time.localtime().tm_year
-        if line.find('on '):
-            return False
-
-        for y in range(year-1, year+2):
-            match += line[3:].find(str(y)) != -1
-        return match
-
-    # any lines after the line_idx check fails are previous messages
-    line_idx = 0
-    while not check_match(msg_lines[line_idx].lower()):
-        line_idx += 1
-        if line_idx == len(msg_lines):
-            break
-
-    # blank out any lines after the message is done
-    if line_idx < len(msg_lines):
-        for i in range(line_idx, len(msg_lines)):
-            msg_lines[i] = ''
-    filtered_body = '\r\n'.join(msg_lines)
-    return filtered_body
+    return qf.strip_quotes(msg_body)
 
 if __name__ == '__main__':
     # Quick test to send an instant reply to a message
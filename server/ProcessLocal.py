@@ -0,0 +1,67 @@
+#!/usr/bin/env python2
+
+################################################################################
+## ProcessLocal.py: Background threads that follow the handler across forks.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import os
+import threading
+
+# One start lock per process. A lock inherited through a fork may have
+# been held by a thread that doesn't exist in the child, so each process
+# makes its own, which setdefault does atomically.
+_start_locks = {}
+
+class ProcessLocal:
+    def __init__(self):
+        """
+        Base class for objects that start background threads lazily.
+        The handler forks after they are created, and threads do not
+        survive a fork, so each process that uses the object starts its
+        own threads and replaces any lock that may have been held by
+        another thread mid-fork.
+        """
+        self.pid = None
+
+    def start_process(self, start, *args):
+        """
+        Call start(*args) to start the object's threads, unless that
+        was already done in this process. Other threads calling at the
+        same time wait, and the object only counts as started once
+        start has returned, so nothing uses it half started.
+        """
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with _start_locks.setdefault(pid, threading.Lock()):
+            if self.pid == pid:
+                return
+            start(*args)
+            self.pid = pid
+
+    def owns_process(self):
+        """
+        Whether the object's threads were started in this process.
+        """
+        return self.pid == os.getpid()
+
+    def release_process(self):
+        """
+        Mark the object as stopped, so that it starts again if used.
+        """
+        self.pid = None
@@ -0,0 +1,118 @@
+#!/usr/bin/env python2
+
+################################################################################
+## QuoteFilter.py: Strip quoted replies from incoming email bodies.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import re
+try:
+    from html import unescape as _html_unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    _html_unescape = HTMLParser().unescape
+
+# Lines that start the quoted part of a reply. Replies are written
+# above the quote, so everything from the first one on is dropped.
+_QUOTE_DIVIDER = re.compile(r'\s*(-{2,}\s*original message\s*-{2,}'
+        r'|-{2,}\s*forwarded message\s*-{2,}|begin forwarded message:'
+        r'|_{10,})\s*$', re.I)
+
+# "On <date>, <name> wrote:" (Gmail, Apple Mail, Thunderbird), which
+# Gmail may wrap over two lines. A line starting with "On" and giving a
+# year is taken as the same divider, as it always was.
+_ON_LINE = re.compile(r'\s*on\s', re.I)
+_ON_YEAR = re.compile(r'\s*on\s.*\b(19|20)\d\d\b', re.I)
+_WROTE = re.compile(r'.*\bwrote:\s*$', re.I)
+
+# Outlook's "From: ... / Sent: ..." header block
+_FROM_LINE = re.compile(r'\s*\*?from:\*?\s', re.I)
+_SENT_LINE = re.compile(r'\s*\*?(sent|date):\*?\s', re.I)
+
+# Signature delimiter
+_SIGNATURE = re.compile(r'--\s*$')
+
+# HTML bodies: where the quoted part of the common clients starts, and
+# the markup to turn into line breaks or drop.
+_HTML_TAG = re.compile(r'<(html|body|div|p|br|blockquote|table|span)\b', re.I)
+_HTML_QUOTE = re.compile(r'<blockquote\b|<div[^>]*\b(class="gmail_quote"'
+        r'|id="appendonsend"|id="divRplyFwdMsg")', re.I)
+_HTML_HIDDEN = re.compile(r'<(head|style|script)\b.*?</\1\s*>', re.I|re.S)
+_HTML_BREAK = re.compile(r'<br\b[^>]*>|</(p|div|li|tr|h\d)\s*>', re.I)
+_HTML_MARKUP = re.compile(r'<!--.*?-->|<[^>]*>', re.S)
+
+def html_to_text(html):
+    """
+    Convert an HTML body to plain text, dropping everything from the
+    start of the quoted reply on.
+    """
+    match = _HTML_QUOTE.search(html)
+    if match is not None:
+        html = html[:match.start()]
+    html = _HTML_HIDDEN.sub('', html)
+    html = html.replace('\r\n', ' ').replace('\n', ' ')
+    html = _HTML_BREAK.sub('\n', html)
+    text = _HTML_MARKUP.sub('', html)
+    return unescape(text)
+
+def is_quote_start(line, next_line):
+    """
+    Check whether a line starts the quoted part of a reply. The next
+    line is needed for headers that span two lines.
+    """
+    if _QUOTE_DIVIDER.match(line) or _SIGNATURE.match(line):
+        return True
+    if _ON_LINE.match(line):
+        if _ON_YEAR.match(line) or _WROTE.match(line):
+            return True
+        return _WROTE.match(next_line) is not None
+    if _FROM_LINE.match(line):
+        return _SENT_LINE.match(next_line) is not None
+    return False
+
+def strip_quotes(body):
+    """
+    Keep only the newest message of an email thread: drop quoted lines,
+    blank lines and everything from the first reply header on. Each
+    line is looked at once, so long reply chains take linear time.
+    HTML bodies are converted to text first.
+    """
+    if _HTML_TAG.search(body):
+        body = html_to_text(body)
+    lines = body.replace('\r\n', '\n').split('\n')
+
+    kept = []
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if not len(stripped) or stripped[0] == '>':
+            continue
+        next_line = lines[i+1] if i + 1 < len(lines) else ''
+        if is_quote_start(line, next_line):
+            break
+        kept.append(line)
+    return '\r\n'.join(kept)
+
+def unescape(text):
+    """
+    Replace HTML character references.
+    """
+    if '&' not in text:
+        return text
+    if isinstance(text, bytes) and bytes is str:
+        # Python 2 byte strings have to go through unicode.
+        return _html_unescape(text.decode('utf-8', 'replace')).encode('utf-8')
+    return _html_unescape(text)
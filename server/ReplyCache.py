@@ -0,0 +1,68 @@
+#!/usr/bin/env python2
+
+################################################################################
+## ReplyCache.py: Pre-rendered bodies for automated replies.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import os
+import threading
+import MailBackend as mb
+
+class StaticReply:
+    def __init__(self, body):
+        """
+        A reply body that doesn't change between messages, with its
+        MIME part rendered once.
+        """
+        self.body = body
+        self.part = mb.render_part(body)
+
+    def message(self, to, subject):
+        """
+        Build a reply message for send_message.
+        """
+        return {'to': to, 'subject': subject, 'body': self.body,
+                'part': self.part}
+
+class MenuReply:
+    def __init__(self, path):
+        """
+        The drink menu, read once and read again only when the file
+        changes, so a menu request costs one stat() call.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.reply = None
+
+    def get(self):
+        """
+        Return the menu as a StaticReply, reloading it if the file's
+        modification time, size or inode changed.
+        """
+        st = os.stat(self.path)
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+        with self.lock:
+            if stamp != self.stamp:
+                with open(self.path) as f:
+                    body = f.read()
+                if len(body.split('\r\n')) == 1:
+                    body = body.replace('\n', '\r\n')
+                self.reply = StaticReply(body)
+                self.stamp = stamp
+            return self.reply
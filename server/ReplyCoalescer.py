@@ -0,0 +1,136 @@
+#!/usr/bin/env python2
+
+################################################################################
+## ReplyCoalescer.py: Merge automated replies to the same patron.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import time
+import threading
+from ProcessLocal import ProcessLocal
+
+class ReplyCoalescer(ProcessLocal):
+    def __init__(self, flush_replies, window=10., idle=2.):
+        """
+        Hold automated replies per key (a patron and email thread) and
+        hand them over together, so a patron who orders several drinks
+        gets one email instead of one per drink.
+
+        A key's replies are flushed once no new reply for it has come
+        in for idle seconds, and at the latest window seconds after its
+        first held reply.
+
+        flush_replies:  function(key, replies) called from a background
+                        thread with the replies held for a key
+        window:         longest time to hold a reply
+        idle:           flush a key after this long without new replies
+        """
+        ProcessLocal.__init__(self)
+        self.flush_replies = flush_replies
+        self.window = window
+        self.idle = idle
+
+        # Object items
+        self.groups = {}
+        self.thread = None
+        self.stopping = False
+        self.cond = threading.Condition()
+
+    def _deadline(self, group):
+        _, t_first, t_last = group
+        return min(t_first + self.window, t_last + self.idle)
+
+    def _flusher(self):
+        """
+        Flush groups as their deadlines pass, until stop() is called.
+        """
+        while True:
+            with self.cond:
+                due = self._pop_due(time.time())
+                while not len(due) and not self.stopping:
+                    deadlines = [self._deadline(group)
+                            for group in self.groups.values()]
+                    timeout = None
+                    if len(deadlines):
+                        timeout = max(0, min(deadlines) - time.time())
+                    self.cond.wait(timeout)
+                    due = self._pop_due(time.time())
+                stopping = self.stopping
+            self._flush(due)
+            if stopping:
+                return
+
+    def _flush(self, due):
+        for key, replies in due:
+            self.flush_replies(key, replies)
+
+    def _pop_due(self, now):
+        """
+        Remove and return the groups whose deadline has passed. Must be
+        called with the condition held.
+        """
+        due = []
+        for key, group in list(self.groups.items()):
+            if self._deadline(group) <= now:
+                due.append((key, group[0]))
+                del self.groups[key]
+        return due
+
+    def _start(self):
+        self.cond = threading.Condition()
+        self.groups = {}
+        self.stopping = False
+        self.thread = threading.Thread(target=self._flusher)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, key, reply):
+        """
+        Hold a reply for a key.
+        """
+        self.start()
+        now = time.time()
+        with self.cond:
+            group = self.groups.get(key)
+            if group is None:
+                self.groups[key] = [[reply], now, now]
+            else:
+                group[0].append(reply)
+                group[2] = now
+            self.cond.notify()
+
+    def start(self):
+        """
+        Start the flusher thread in this process (see ProcessLocal).
+        """
+        self.start_process(self._start)
+
+    def stop(self, timeout=None):
+        """
+        Flush everything still held and stop the flusher thread.
+        """
+        if not self.owns_process():
+            return
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join(timeout)
+        with self.cond:
+            due = list(self.groups.items())
+            self.groups = {}
+        self._flush([(key, group[0]) for key, group in due])
+        self.release_process()
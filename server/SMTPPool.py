@@ -0,0 +1,219 @@
+#!/usr/bin/env python2
+
+################################################################################
+## SMTPPool.py: Persistent SMTP connections with a background send queue.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+
+from __future__ import print_function
+import sys
+import time
+import socket
+import smtplib
+import threading
+from ProcessLocal import ProcessLocal
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class SMTPPool(ProcessLocal):
+    def __init__(self, host, username, password, n_workers=2,
+            queue_size=256, max_retries=3, idle_timeout=120):
+        """
+        Send email from a bounded queue drained by worker threads, each
+        holding a long-lived SMTP session that reconnects when dropped.
+
+        send() returns as soon as the message is queued. It only blocks
+        when the queue is full, which pushes back on the caller instead
+        of buffering mail without limit.
+
+        host:           SMTP server as "host:port"
+        n_workers:      number of worker threads/SMTP sessions
+        queue_size:     maximum number of queued messages
+        max_retries:    attempts to resend a message after an error
+        idle_timeout:   close sessions idle for longer than this
+        """
+        ProcessLocal.__init__(self)
+        self.host = host
+        self.username = username
+        self.password = password
+        self.n_workers = n_workers
+        self.max_retries = max_retries
+        self.idle_timeout = idle_timeout
+
+        # Object items
+        self.queue = queue.Queue(queue_size)
+        self.workers = []
+        self.lock = threading.Lock()
+        self.stats = {
+            'sent': 0,
+            'failed': 0,
+            'retries': 0,
+            'connects': 0,
+            'latency_total': 0.,
+            'latency_max': 0.,
+            }
+
+    def _connect(self):
+        """
+        Open and log in to an SMTP session.
+        """
+        server = smtplib.SMTP(self.host)
+        server.ehlo()
+        if server.has_extn('starttls'):
+            server.starttls()
+            server.ehlo()
+        if self.password and server.has_extn('auth'):
+            server.login(self.username, self.password)
+        self._count('connects')
+        return server
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def _send(self, server, message):
+        """
+        Send a message, reconnecting and retrying on transient errors.
+        Permanent errors, such as a refused address, fail right away.
+        Returns the session to use for the next message.
+        """
+        from_addr, to_addrs, msg_string, t_queued = message
+        for attempt in range(self.max_retries + 1):
+            try:
+                if server is None:
+                    server = self._connect()
+                server.sendmail(from_addr, to_addrs, msg_string)
+            except (smtplib.SMTPException, socket.error) as err:
+                _quit(server)
+                server = None
+                if attempt == self.max_retries or not _transient(err):
+                    print('Failed to send message to %s:' % to_addrs, err,
+                            file=sys.stderr)
+                    self._count('failed')
+                    return server
+                self._count('retries')
+                time.sleep(min(2 ** attempt, 30))
+                continue
+
+            latency = time.time() - t_queued
+            with self.lock:
+                self.stats['sent'] += 1
+                self.stats['latency_total'] += latency
+                self.stats['latency_max'] = max(self.stats['latency_max'],
+                        latency)
+            return server
+
+    def _start(self):
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.lock = threading.Lock()
+        self.workers = []
+        for i in range(self.n_workers):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _worker(self):
+        """
+        Send queued messages until stop() queues a None.
+        """
+        server = None
+        while True:
+            try:
+                message = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                # Let idle sessions go rather than have the server drop
+                # them. The next message reconnects.
+                _quit(server)
+                server = None
+                continue
+
+            if message is None:
+                self.queue.task_done()
+                _quit(server)
+                return
+            try:
+                server = self._send(server, message)
+            finally:
+                self.queue.task_done()
+
+    def metrics(self):
+        """
+        Queue depth and send statistics.
+        """
+        with self.lock:
+            metrics = dict(self.stats)
+        metrics['queue_depth'] = self.queue.qsize()
+        if metrics['sent']:
+            metrics['latency_mean'] = metrics['latency_total'] / metrics['sent']
+        else:
+            metrics['latency_mean'] = 0.
+        return metrics
+
+    def send(self, from_addr, to_addrs, msg_string):
+        """
+        Queue a message to be sent by the workers.
+        """
+        self.start()
+        self.queue.put((from_addr, to_addrs, msg_string, time.time()))
+
+    def start(self):
+        """
+        Start the workers in this process (see ProcessLocal).
+        """
+        self.start_process(self._start)
+
+    def stop(self, timeout=None):
+        """
+        Send everything still queued, then close the sessions.
+        """
+        if not self.owns_process():
+            return
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+        self.release_process()
+        self.workers = []
+
+def _transient(err):
+    """
+    Whether a send error may go away on retrying: a lost connection or
+    a 4xx reply. SMTP errors are checked first, as they are socket
+    errors too in Python 3.
+    """
+    if isinstance(err, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, msg in err.recipients.values()]
+    elif isinstance(err, smtplib.SMTPResponseException):
+        codes = [err.smtp_code]
+    elif isinstance(err, smtplib.SMTPException):
+        return False
+    else:
+        return isinstance(err, socket.error)
+    return len(codes) > 0 and all([400 <= code < 500 for code in codes])
+
+def _quit(server):
+    if server is None:
+        return
+    try:
+        server.quit()
+    except (smtplib.SMTPException, socket.error):
+        server.close()
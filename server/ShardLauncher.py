@@ -0,0 +1,99 @@
+#!/usr/bin/env python2
+
+################################################################################
+## ShardLauncher.py: Run several order handler nodes on one machine.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+
+from __future__ import print_function
+import os
+import sys
+import json
+import OrderHandler as oh
+import multiprocessing as mp
+
+class ShardLauncher:
+    def __init__(self, shard_conf):
+        """
+        Read the shard map, a json file with the following items:
+            gmail_conf:     the gmail configuration file
+            bar_conf:       the order handler configuration file
+            nodes:          list of per-node configuration overrides
+
+        Each node needs at least its own port for the bartender clients
+        and its own Pub/Sub subscription_name, so that every node hears
+        every inbox notification. Paths are relative to the shard map.
+        """
+        shard_conf = os.path.abspath(shard_conf)
+        with open(shard_conf) as f:
+            config = json.loads(f.read())
+        conf_dir = os.path.dirname(shard_conf)
+        self.gmail_conf = os.path.join(conf_dir, config['gmail_conf'])
+        self.bar_conf = os.path.join(conf_dir, config['bar_conf'])
+        self.nodes = config['nodes']
+
+        # Object items
+        self.node_procs = []
+
+    def cleanup(self):
+        """
+        Give the nodes time to clean up after Ctrl-C, then stop them.
+        """
+        for proc in self.node_procs:
+            proc.join(15)
+            if proc.is_alive():
+                proc.terminate()
+
+    def node_conf(self, node_idx):
+        """
+        Configuration overrides for one node.
+        """
+        node_conf = dict(self.nodes[node_idx])
+        node_conf['node'] = node_idx
+        node_conf['n_nodes'] = len(self.nodes)
+        return node_conf
+
+    def run(self):
+        """
+        Start one handler process per node and wait for them.
+        """
+        for i in range(len(self.nodes)):
+            proc = mp.Process(target=run_node,
+                    args=(self.gmail_conf, self.bar_conf, self.node_conf(i)))
+            proc.start()
+            self.node_procs.append(proc)
+            print('Started node %d on port %d.' % (i, self.nodes[i]['port']))
+
+        for proc in self.node_procs:
+            proc.join()
+
+def run_node(gmail_conf, bar_conf, node_conf):
+    handler = oh.OrderHandler(gmail_conf, bar_conf, node_conf)
+    try:
+        handler.run_handler()
+    except KeyboardInterrupt:
+        handler.cleanup()
+
+if __name__ == '__main__':
+    assert len(sys.argv) == 2, 'Need shard map file.'
+    launcher = ShardLauncher(sys.argv[1])
+
+    try:
+        launcher.run()
+    except KeyboardInterrupt:
+        print()
+        launcher.cleanup()
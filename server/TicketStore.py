@@ -0,0 +1,467 @@
+#!/usr/bin/env python2
+
+################################################################################
+## TicketStore.py: Storage backends for open drink tickets.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import os
+import sys
+import time
+import zlib
+import fcntl
+import struct
+import threading
+import pickle as pkl
+
+# Journal records are a (length, crc32) header followed by a pickled
+# (operation, ticket_id, ticket) tuple.
+_HEADER = struct.Struct('!II')
+
+class TicketStore:
+    def __init__(self, path):
+        """
+        Base class for the open ticket storage. Tickets are keyed by
+        ticket ID and behave like a small dictionary.
+        """
+        self.path = path
+
+    def __contains__(self, ticket_id):
+        return self.get(ticket_id) is not None
+
+    def __getitem__(self, ticket_id):
+        ticket = self.get(ticket_id)
+        if ticket is None:
+            raise KeyError(ticket_id)
+        return ticket
+
+    def add(self, ticket_id, ticket):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def get(self, ticket_id, default=None):
+        raise NotImplementedError
+
+    def get_many(self, ticket_ids):
+        """
+        Return a dictionary of the open tickets among ticket_ids.
+        """
+        tickets = {}
+        for ticket_id in ticket_ids:
+            ticket = self.get(ticket_id)
+            if ticket is not None:
+                tickets[ticket_id] = ticket
+        return tickets
+
+    def items(self):
+        raise NotImplementedError
+
+    def pop(self, ticket_id, default=None):
+        raise NotImplementedError
+
+    def pop_many(self, ticket_ids):
+        """
+        Remove the tickets among ticket_ids and return them as a
+        dictionary.
+        """
+        tickets = {}
+        for ticket_id in ticket_ids:
+            ticket = self.pop(ticket_id)
+            if ticket is not None:
+                tickets[ticket_id] = ticket
+        return tickets
+
+class JournalTicketStore(TicketStore):
+    def __init__(self, path, fsync_every=16, fsync_interval=1.0,
+            compact_min=256, compact_ratio=4):
+        """
+        Append-only ticket journal with an in-memory index.
+
+        Every add/remove appends one record to the journal, so ticket
+        operations cost O(1) regardless of how many tickets are open.
+        The index is rebuilt from the journal when the store is opened,
+        and a torn record left behind by a crash is truncated away.
+
+        The journal is shared between the handler processes, so every
+        operation takes an flock and first replays records appended by
+        the other process since the last operation. The flock does not
+        exclude threads sharing the descriptor, so a thread lock is
+        taken first.
+
+        Options:
+            fsync_every:    fsync after this many unsynced records
+            fsync_interval: fsync if the last one is older than this
+            compact_min:    minimum dead records before compacting
+            compact_ratio:  compact when records > ratio * open tickets
+        """
+        TicketStore.__init__(self, path)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_min = compact_min
+        self.compact_ratio = compact_ratio
+
+        # Object items
+        self.fd = None
+        self.pid = None
+        self.thread_lock = threading.RLock()
+        self.tickets = {}
+        self.n_records = 0
+        self.offset = 0
+        self.n_unsynced = 0
+        self.last_sync = time.time()
+
+        self._acquire()
+        self._release()
+
+    def _acquire(self):
+        """
+        Lock the journal and replay any records written elsewhere.
+        """
+        # A forked child shares the parent's file description, which
+        # would make the flock useless, so it gets its own.
+        if self.pid != os.getpid():
+            self.thread_lock = threading.RLock()
+            self._reopen()
+
+        self.thread_lock.acquire()
+        while True:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                inode = os.stat(self.path).st_ino
+            except OSError:
+                inode = None
+            if inode == os.fstat(self.fd).st_ino:
+                break
+
+            # Another process compacted the journal into a new file.
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self._reopen()
+        self._replay()
+
+    def _append(self, records):
+        """
+        Append records to the journal and apply them to the index.
+        """
+        self._acquire()
+        try:
+            for record in records:
+                self._apply(record)
+            data = b''.join([_encode(record) for record in records])
+            os.write(self.fd, data)
+            self.offset += len(data)
+            self.n_unsynced += len(records)
+
+            if self.n_unsynced >= self.fsync_every or \
+                    time.time() - self.last_sync >= self.fsync_interval:
+                self._sync()
+
+            n_dead = self.n_records - len(self.tickets)
+            if n_dead >= self.compact_min and \
+                    self.n_records > self.compact_ratio * len(self.tickets):
+                self._compact()
+        finally:
+            self._release()
+
+    def _apply(self, record):
+        """
+        Apply a single journal record to the in-memory index.
+        """
+        op, ticket_id, ticket = record
+        if op == 'add':
+            self.tickets[ticket_id] = ticket
+        else:
+            self.tickets.pop(ticket_id, None)
+        self.n_records += 1
+
+    def _compact(self):
+        """
+        Rewrite the journal with only the open tickets. Must be called
+        with the journal locked.
+        """
+        tmp_path = self.path + '.tmp'
+        tmp_fd = os.open(tmp_path, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600)
+        data = b''.join([_encode(('add', ticket_id, ticket))
+            for ticket_id, ticket in self.tickets.items()])
+        os.write(tmp_fd, data)
+        os.fsync(tmp_fd)
+        os.close(tmp_fd)
+        os.rename(tmp_path, self.path)
+
+        # Lock the new journal before releasing the old one so that the
+        # other process reloads from the compacted file.
+        new_fd = os.open(self.path, os.O_RDWR|os.O_CREAT|os.O_APPEND, 0o600)
+        fcntl.flock(new_fd, fcntl.LOCK_EX)
+        os.close(self.fd)
+        self.fd = new_fd
+        self.n_records = len(self.tickets)
+        self.offset = len(data)
+        self.n_unsynced = 0
+        self.last_sync = time.time()
+
+    def _release(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def _reopen(self):
+        """
+        Open the journal file and reset the index, which gets rebuilt
+        on the next lock.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR|os.O_CREAT|os.O_APPEND, 0o600)
+        self.pid = os.getpid()
+        self.tickets = {}
+        self.n_records = 0
+        self.offset = 0
+
+    def _replay(self):
+        """
+        Read journal records past the current offset. Must be called
+        with the journal locked, so a short or corrupt record at the
+        end can only be left over from a crash and is truncated.
+        """
+        size = os.fstat(self.fd).st_size
+        if size == self.offset:
+            return
+        os.lseek(self.fd, self.offset, os.SEEK_SET)
+        data = b''
+        while len(data) < size - self.offset:
+            chunk = os.read(self.fd, size - self.offset - len(data))
+            if not len(chunk):
+                break
+            data += chunk
+
+        pos = 0
+        while pos + _HEADER.size <= len(data):
+            length, crc = _HEADER.unpack_from(data, pos)
+            start = pos + _HEADER.size
+            payload = data[start:start+length]
+            if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            self._apply(pkl.loads(payload))
+            pos = start + length
+
+        self.offset += pos
+        if self.offset != size:
+            print('Truncating torn ticket journal record:', self.path,
+                    file=sys.stderr)
+            os.ftruncate(self.fd, self.offset)
+
+    def _sync(self):
+        os.fsync(self.fd)
+        self.n_unsynced = 0
+        self.last_sync = time.time()
+
+    def add(self, ticket_id, ticket):
+        self._append([('add', ticket_id, ticket)])
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.pid == os.getpid():
+            self.flush()
+            os.close(self.fd)
+        self.fd = None
+
+    def flush(self):
+        if not self.n_unsynced or self.pid != os.getpid():
+            return
+        self._acquire()
+        try:
+            self._sync()
+        finally:
+            self._release()
+
+    def get(self, ticket_id, default=None):
+        self._acquire()
+        self._release()
+        return self.tickets.get(ticket_id, default)
+
+    def get_many(self, ticket_ids):
+        self._acquire()
+        self._release()
+        return dict([(ticket_id, self.tickets[ticket_id])
+            for ticket_id in ticket_ids if ticket_id in self.tickets])
+
+    def items(self):
+        self._acquire()
+        self._release()
+        return list(self.tickets.items())
+
+    def pop(self, ticket_id, default=None):
+        ticket = self.get(ticket_id)
+        if ticket is None:
+            return default
+        self._append([('del', ticket_id, None)])
+        return ticket
+
+    def pop_many(self, ticket_ids):
+        # One journal write for all of the removals.
+        tickets = self.get_many(ticket_ids)
+        if len(tickets):
+            self._append([('del', ticket_id, None) for ticket_id in tickets])
+        return tickets
+
+class MemoryTicketStore(TicketStore):
+    def __init__(self, path=None):
+        """
+        Keep tickets in a dictionary only. Tickets are lost when the
+        handler exits, and the store cannot be shared between processes,
+        so it is only useful in the single-process handler mode.
+        """
+        TicketStore.__init__(self, path)
+        self.tickets = {}
+
+    def add(self, ticket_id, ticket):
+        self.tickets[ticket_id] = ticket
+
+    def get(self, ticket_id, default=None):
+        return self.tickets.get(ticket_id, default)
+
+    def items(self):
+        return list(self.tickets.items())
+
+    def pop(self, ticket_id, default=None):
+        return self.tickets.pop(ticket_id, default)
+
+class PickleTicketStore(TicketStore):
+    def __init__(self, path):
+        """
+        Store all tickets as a single pickled dictionary, rewritten in
+        full on every change. Kept for compatibility.
+
+        Like the journal, the file is shared between the handler
+        processes, so every operation takes an flock on a lock file
+        next to it as well as a thread lock.
+        """
+        TicketStore.__init__(self, path)
+        self.fd = None
+        self.pid = None
+        self.thread_lock = threading.Lock()
+        self._acquire()
+        try:
+            if not os.path.exists(self.path):
+                self._save({})
+        finally:
+            self._release()
+
+    def _acquire(self):
+        # A forked child shares the parent's file description, which
+        # would make the flock useless, so it gets its own.
+        if self.pid != os.getpid():
+            if self.fd is not None:
+                os.close(self.fd)
+            self.fd = os.open(self.path + '.lock', os.O_RDWR|os.O_CREAT, 0o600)
+            self.pid = os.getpid()
+            self.thread_lock = threading.Lock()
+        self.thread_lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            return pkl.load(f)
+
+    def _release(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def _save(self, tickets):
+        # Write a new file and rename it over the old one, so that a
+        # crash never leaves a torn pickle behind.
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pkl.dump(tickets, f)
+        os.rename(tmp_path, self.path)
+
+    def add(self, ticket_id, ticket):
+        self._acquire()
+        try:
+            tickets = self._load()
+            tickets[ticket_id] = ticket
+            self._save(tickets)
+        finally:
+            self._release()
+
+    def close(self):
+        if self.fd is not None and self.pid == os.getpid():
+            os.close(self.fd)
+        self.fd = None
+        self.pid = None
+
+    def get(self, ticket_id, default=None):
+        self._acquire()
+        try:
+            return self._load().get(ticket_id, default)
+        finally:
+            self._release()
+
+    def items(self):
+        self._acquire()
+        try:
+            return list(self._load().items())
+        finally:
+            self._release()
+
+    def pop(self, ticket_id, default=None):
+        self._acquire()
+        try:
+            tickets = self._load()
+            ticket = tickets.pop(ticket_id, default)
+            self._save(tickets)
+        finally:
+            self._release()
+        return ticket
+
+    def pop_many(self, ticket_ids):
+        self._acquire()
+        try:
+            tickets = self._load()
+            popped = dict([(ticket_id, tickets.pop(ticket_id))
+                for ticket_id in ticket_ids if ticket_id in tickets])
+            if len(popped):
+                self._save(tickets)
+        finally:
+            self._release()
+        return popped
+
+def _encode(record):
+    """
+    Encode a journal record with its length and checksum header.
+    """
+    payload = pkl.dumps(record, pkl.HIGHEST_PROTOCOL)
+    crc = zlib.crc32(payload) & 0xffffffff
+    return _HEADER.pack(len(payload), crc) + payload
+
+STORES = {
+    'journal': JournalTicketStore,
+    'memory': MemoryTicketStore,
+    'pickle': PickleTicketStore,
+    }
+
+def open_ticket_store(kind, path):
+    """
+    Open a ticket store by name (see STORES).
+    """
+    if kind not in STORES:
+        raise ValueError('Invalid ticket store: %s' % kind)
+    return STORES[kind](path)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python2
+
+################################################################################
+## TicketTimeline.py: Rolling log of ticket timelines and a wait report.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+
+# Stages of a ticket's timeline, in order:
+#   gmail:      Gmail received the email (internalDate)
+#   received:   the handler read the email
+#   delivered:  the ticket was sent to a bar
+#   accepted:   the bartender accepted the order
+#   ready:      the bartender sent the drink to pickup
+#   done:       the drink was picked up or the order cancelled
+STAGES = ('gmail', 'received', 'delivered', 'accepted', 'ready', 'done')
+
+# Report intervals as (name, start stage, end stage).
+INTERVALS = (
+    ('email_to_bar', 'gmail', 'delivered'),
+    ('queue_wait', 'delivered', 'accepted'),
+    ('service_time', 'accepted', 'ready'),
+    ('pickup_wait', 'ready', 'done'),
+    ('total', 'gmail', 'done'),
+    )
+
+class TimelineLog:
+    def __init__(self, path, max_bytes=1<<20, backups=3):
+        """
+        Append closed ticket timelines to a rolling log of json lines.
+        When the log grows past max_bytes it is moved to path.1, older
+        logs move up by one, and at most backups old logs are kept.
+
+        Each line holds the ticket ID, bar index, final status and the
+        STAGES times in order, in seconds since the epoch rounded to the
+        millisecond, with null for stages that never happened.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def append(self, ticket_id, bar_idx, status, timeline):
+        """
+        Log the timeline dictionary of a closed ticket.
+        """
+        times = [timeline.get(stage) for stage in STAGES]
+        times = [None if t is None else round(t, 3) for t in times]
+        record = [ticket_id, bar_idx, status, times]
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with open(self.path, 'a') as f:
+            f.write(line)
+            size = f.tell()
+        if size >= self.max_bytes:
+            self.rotate()
+
+    def paths(self):
+        """
+        The log files, oldest first.
+        """
+        paths = ['%s.%d' % (self.path, i) for i in range(self.backups, 0, -1)]
+        return [p for p in paths + [self.path] if os.path.exists(p)]
+
+    def read(self):
+        """
+        Yield the logged timelines, oldest first, as dictionaries with
+        the id, bar and status and a time for each stage.
+        """
+        for path in self.paths():
+            with open(path) as f:
+                for line in f:
+                    try:
+                        ticket_id, bar_idx, status, times = json.loads(line)
+                    except ValueError:
+                        continue # Torn line left by a crash.
+                    record = dict(zip(STAGES, times))
+                    record.update({'id': ticket_id, 'bar': bar_idx,
+                        'status': status})
+                    yield record
+
+    def rotate(self):
+        """
+        Move the current log to path.1 and shift the older ones up.
+        """
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.path, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (self.path, i + 1))
+        if self.backups > 0:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+def distribution(values):
+    """
+    Summarize a list of durations in seconds.
+    """
+    values = sorted(values)
+    def pct(p):
+        return values[min(len(values)-1, int(p * len(values)))]
+    return {
+        'n': len(values),
+        'p50': pct(0.50),
+        'p90': pct(0.90),
+        'p99': pct(0.99),
+        'max': values[-1],
+        'mean': sum(values) / len(values),
+        }
+
+def report(records):
+    """
+    Interval distributions per bar, from picked up tickets only.
+    Returns {bar: {'tickets': n, 'cancelled': n, interval: stats}}.
+    """
+    bars = {}
+    durations = {}
+    for record in records:
+        bar = bars.setdefault(record['bar'], {'tickets': 0, 'cancelled': 0})
+        bar['tickets'] += 1
+        if record['status'] != 'pickup':
+            bar['cancelled'] += 1
+            continue
+        for name, start, end in INTERVALS:
+            if record[start] is not None and record[end] is not None:
+                key = (record['bar'], name)
+                durations.setdefault(key, []).append(record[end] -
+                        record[start])
+    for (bar_idx, name), values in durations.items():
+        bars[bar_idx][name] = distribution(values)
+    return bars
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report how long patrons '
+            'waited for their drinks, per bar, from a ticket timeline log.')
+    parser.add_argument('log', help='timeline log path (without .1, .2...)')
+    parser.add_argument('--backups', type=int, default=3,
+            help='number of old logs kept next to the log')
+    parser.add_argument('--json', action='store_true',
+            help='print the report as json')
+    args = parser.parse_args()
+
+    results = report(TimelineLog(args.log, backups=args.backups).read())
+    if args.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+        sys.exit(0)
+    for bar_idx in sorted(results, key=str):
+        bar = results[bar_idx]
+        print('Bar %s: %d tickets, %d cancelled' % (bar_idx, bar['tickets'],
+            bar['cancelled']))
+        for name, _, _ in INTERVALS:
+            if name not in bar:
+                continue
+            stats = bar[name]
+            print('    %-13s n %5d  p50 %7.1fs  p90 %7.1fs  p99 %7.1fs  '
+                    'max %7.1fs' % (name, stats['n'], stats['p50'],
+                        stats['p90'], stats['p99'], stats['max']))
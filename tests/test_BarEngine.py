@@ -0,0 +1,81 @@
+#!/usr/bin/env python2
+
+################################################################################
+## test_BarEngine.py: Tests for the bar client engine.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import os
+import sys
+import unittest
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(os.path.join(root_dir, 'client'))
+from BarEngine import BarEngine
+
+class PickupCursorTest(unittest.TestCase):
+    def setUp(self):
+        self.notifs = []
+        self.engine = BarEngine(lambda node, notifs: self.notifs.extend(notifs),
+                lambda drink: None, pu_win_rows=5)
+        self.n_orders = 0
+
+    def add(self):
+        """
+        Send a new order straight to the pickup queue.
+        """
+        self.n_orders += 1
+        order = {'id': str(self.n_orders), 'node': 0, 'body': 'drink',
+                'from': 'Patron %d' % self.n_orders}
+        self.engine.add_order(order)
+        self.engine.send_to_pickup()
+
+    def picked_up(self):
+        return [n['id'] for n in self.notifs if n['status'] == 'pickup']
+
+    def test_scroll_empty_queue(self):
+        # add, down, pickup, down, add, pickup
+        engine = self.engine
+        self.add()
+        engine.scroll(1)
+        engine.pickup()
+        engine.scroll(1)
+        self.assertEqual(engine.cursor_pos, 0)
+        self.add()
+        engine.pickup()
+        self.assertEqual(self.picked_up(), ['1', '2'])
+        self.assertEqual(len(engine.drinks_pickup), 0)
+
+    def test_scroll_up_empty_queue(self):
+        engine = self.engine
+        engine.scroll(-1)
+        engine.scroll(1)
+        self.add()
+        engine.pickup()
+        self.assertEqual(self.picked_up(), ['1'])
+
+class LaneTest(unittest.TestCase):
+    def test_vip_address(self):
+        engine = BarEngine(lambda node, notifs: None, lambda drink: None,
+                vip_senders=['Boss@Example.com'])
+        order = {'id': '1', 'node': 0, 'body': 'drink', 'from': 'The Boss',
+                'email': 'boss@example.com'}
+        self.assertEqual(engine.classify(order), 'vip')
+        order['email'] = 'someone@example.com'
+        self.assertEqual(engine.classify(order), 'normal')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python2
+
+################################################################################
+## test_DrinkMenu.py: Tests for matching orders against the drink menu.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import os
+import sys
+import json
+import tempfile
+import unittest
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(os.path.join(root_dir, 'server'))
+from DrinkMenu import DrinkMenu
+
+class LoadTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.menu = DrinkMenu(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, text):
+        with open(self.path, 'w') as f:
+            f.write(text)
+
+    def test_keeps_last_good_menu(self):
+        self.write(json.dumps({'drinks': [{'id': 'gin_tonic',
+            'name': 'Gin and tonic', 'aliases': ['g&t']}]}))
+        self.assertEqual(self.menu.match('A G&T please')[0], ['gin_tonic'])
+
+        # Half written, then a drink without a name.
+        self.write('{"drinks": [{"id": "negroni", "na')
+        self.assertEqual(self.menu.match('A G&T please')[0], ['gin_tonic'])
+        self.write(json.dumps({'drinks': [{'id': 'negroni'}]}))
+        self.assertEqual(self.menu.match('A G&T please')[0], ['gin_tonic'])
+
+        # Fixed on the next change.
+        self.write(json.dumps({'drinks': [{'id': 'negroni',
+            'name': 'Negroni'}]}))
+        self.assertEqual(self.menu.match('A negroni please')[0], ['negroni'])
+
+    def test_no_good_menu(self):
+        self.write('not json')
+        self.assertEqual(self.menu.match('A G&T please'), ([], []))
+
+if __name__ == '__main__':
+    unittest.main()
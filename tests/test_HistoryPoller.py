@@ -0,0 +1,57 @@
+#!/usr/bin/env python2
+
+################################################################################
+## test_HistoryPoller.py: Tests for polling the mailbox history.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import os
+import sys
+import unittest
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(os.path.join(root_dir, 'server'))
+from HistoryPoller import HistoryPoller
+
+class PollTest(unittest.TestCase):
+    def setUp(self):
+        # History IDs with whether each added a message to the inbox.
+        self.history = []
+        self.notifs = []
+        def list_changes(start_id):
+            added = [a for h, a in self.history if h > start_id]
+            return len(self.history), any(added)
+        self.poller = HistoryPoller(list_changes, self.notifs.append, 0,
+                min_interval=1., max_interval=4., backoff=2.)
+
+    def test_own_changes(self):
+        # Replies and read marks move the history ID along only.
+        self.history.extend([(1, False), (2, False)])
+        self.assertFalse(self.poller.poll())
+        self.assertEqual(self.poller.last_id, 2)
+        self.assertEqual(self.poller.interval, 2.)
+
+        self.history.append((3, True))
+        self.assertTrue(self.poller.poll())
+        self.assertEqual(self.notifs[-1]['historyId'], 3)
+        self.assertEqual(self.poller.interval, 1.)
+
+        self.history.append((4, False))
+        self.assertFalse(self.poller.poll())
+        self.assertEqual(len(self.notifs), 1)
+
+if __name__ == '__main__':
+    unittest.main()
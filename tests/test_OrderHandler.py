@@ -0,0 +1,180 @@
+#!/usr/bin/env python2
+
+################################################################################
+## test_OrderHandler.py: Tests for the server order handler.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import tempfile
+import unittest
+import threading
+import multiprocessing as mp
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for subdir in ['common', 'server']:
+    sys.path.append(os.path.join(root_dir, subdir))
+import WireFraming as wf
+import WireSchema as ws
+import OrderHandler as oh
+
+class PlainCipher:
+    def decrypt(self, data):
+        return data
+
+    def encrypt(self, data):
+        return data
+
+def open_handler(**overrides):
+    """
+    Create a single-process order handler on an in-memory mailbox.
+    Returns the handler and its configuration file, to be removed.
+    """
+    conf_fd, conf_file = tempfile.mkstemp(suffix='.conf')
+    with os.fdopen(conf_fd, 'w') as f:
+        f.write(json.dumps({
+            'magic_word': 'test',
+            'bar_acknowledge': 'test-ack',
+            'port': 0,
+            'buffer_size': 4096,
+            'gpg_passwd': 'test-passwd',
+            'menu_file': os.devnull,
+            }))
+    config = {
+        'backend': 'memory',
+        'email_name': 'handler-test@localhost',
+        'send_name': 'Handler Test',
+        'mode': 'single',
+        'ticket_store': 'memory',
+        'timeline_log': os.devnull,
+        }
+    config.update(overrides)
+    return oh.OrderHandler(None, conf_file, config), conf_file
+
+class HandshakeTest(unittest.TestCase):
+    def setUp(self):
+        self.handler, self.conf_file = open_handler()
+
+    def tearDown(self):
+        self.handler.cleanup()
+        os.remove(self.conf_file)
+
+    def handshake(self, data):
+        sock, peer = socket.socketpair()
+        peer.sendall(data)
+        peer.close()
+        result = self.handler.bar_handshake(wf.FramedSocket(sock))
+        sock.close()
+        return result
+
+    def test_unframed_peer(self):
+        self.assertEqual(self.handshake(b'test-ack\n'), (None, None))
+
+    def test_invalid_utf8(self):
+        frame = struct.pack('!I', 2) + b'\xff\xfe'
+        self.assertEqual(self.handshake(frame), (None, None))
+
+class DispatchTest(unittest.TestCase):
+    def setUp(self):
+        self.handler, self.conf_file = open_handler()
+        self.handler.tickets = oh.ts.open_ticket_store('memory', None)
+
+        # Two bars, and the least loaded one has gone away.
+        self.bars = []
+        conns = []
+        for i in range(2):
+            sock, bar = socket.socketpair()
+            conns.append(wf.FramedSocket(sock))
+            self.bars.append(wf.FramedSocket(bar))
+        self.bars[0].close()
+        self.handler.bar_conns = conns
+        self.handler.bar_ciphers = [PlainCipher(), PlainCipher()]
+        self.handler.bar_codecs = [ws.CompactCodec(), ws.CompactCodec()]
+        self.handler.bar_load = mp.Array('i', [0, 1])
+
+    def tearDown(self):
+        self.bars[1].close()
+        self.handler.cleanup()
+        os.remove(self.conf_file)
+
+    def test_closed_bar(self):
+        handler = self.handler
+        handler.dispatch_ticket('ticket', {
+            'from': 'Patron <patron@localhost>',
+            'body': 'One drink',
+            })
+        self.assertEqual(handler.bar_load[0], -1)
+        self.assertEqual(handler.tickets.get('ticket')['bar'], 1)
+        order = ws.CompactCodec().decode(self.bars[1].recv_frame())
+        self.assertEqual(order['id'], 'ticket')
+
+class BacklogTest(unittest.TestCase):
+    def setUp(self):
+        self.handler, self.conf_file = open_handler(max_backlog=2)
+        self.handler.tickets = oh.ts.open_ticket_store('memory', None)
+        self.handler.mail.setup()
+
+        # One bar, already behind by max_backlog tickets.
+        sock, self.bar = socket.socketpair()
+        self.bar = wf.FramedSocket(self.bar)
+        self.handler.bar_conns = [wf.FramedSocket(sock)]
+        self.handler.bar_ciphers = [PlainCipher()]
+        self.handler.bar_codecs = [ws.CompactCodec()]
+        self.handler.bar_load = mp.Array('i', [2])
+
+        # A backend with periodic work due all the time, like polling.
+        self.n_polls = 0
+        poll_new_messages = self.handler.mail.poll_new_messages
+        def count_polls():
+            self.n_polls += 1
+            return poll_new_messages()
+        self.handler.mail.poll_new_messages = count_polls
+        self.handler.mail.timeout = lambda: 0
+
+    def tearDown(self):
+        self.bar.close()
+        self.handler.cleanup()
+        os.remove(self.conf_file)
+
+    def test_ingest_pauses(self):
+        handler = self.handler
+        loop = threading.Thread(target=handler.run_event_loop)
+        loop.daemon = True
+        loop.start()
+        handler.mail.deliver('Patron <patron@localhost>', 'Order (test)',
+                'One drink')
+        time.sleep(0.3)
+        self.assertEqual(self.n_polls, 0)
+        self.assertEqual(len(handler.tickets.items()), 0)
+
+        # The bar catches up, and the email is read.
+        handler.bar_load[0] = 0
+        self.bar.send_frame(ws.CompactCodec().encode([]))
+        order = ws.CompactCodec().decode(self.bar.recv_frame())
+        self.assertEqual(order['body'], 'One drink')
+        self.assertGreater(self.n_polls, 0)
+
+        self.bar.close()
+        loop.join(5)
+        self.assertFalse(loop.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+
+################################################################################
+## test_ProcessLocal.py: Tests for starting background threads per process.
+## Copyright (C) 2018   Rachel Domagalski (domagalski@astro.utoronto.ca)
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <https://www.gnu.org/licenses/>.
+################################################################################
+
+from __future__ import print_function
+import os
+import sys
+import time
+import unittest
+import threading
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(os.path.join(root_dir, 'server'))
+from ProcessLocal import ProcessLocal
+from SMTPPool import SMTPPool
+
+class StartTest(unittest.TestCase):
+    def test_concurrent_start(self):
+        # Every caller returns only once the object is fully started.
+        obj = ProcessLocal()
+        started = []
+        seen = []
+        def start():
+            time.sleep(0.1)
+            started.append(True)
+        def use():
+            obj.start_process(start)
+            seen.append(len(started))
+        threads = [threading.Thread(target=use) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(started, [True])
+        self.assertEqual(seen, [1] * 8)
+
+    def test_first_sends(self):
+        # Messages sent while the workers start all reach a worker.
+        pool = SMTPPool('localhost:25', 'user', 'passwd', n_workers=2)
+        sent = []
+        def send(server, message):
+            sent.append(message[2])
+        pool._send = send
+        threads = [threading.Thread(target=pool.send, args=('a', ['b'], i))
+                for i in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.stop(5)
+        self.assertEqual(sorted(sent), list(range(16)))
+
+if __name__ == '__main__':
+    unittest.main()